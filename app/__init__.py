@@ -15,6 +15,9 @@ socketio = SocketIO(manage_sessions=False, engineio_logger=True)
 
 class DefaultConfig:
     SESSION_TYPE = 'redis'
+    # URL of the message queue (e.g. redis://redis:6379/0) used to route socket.io emits between multiple app
+    # processes; None for a single process
+    SOCKETIO_MESSAGE_QUEUE = None
 
 
 def create_app(test_config=None):
@@ -28,7 +31,7 @@ def create_app(test_config=None):
     app.register_blueprint(interactive.bp)
     session.init_app(app)
     bootstrap.init_app(app)
-    socketio.init_app(app, cors_allowed_origins='*')
+    socketio.init_app(app, cors_allowed_origins='*', message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'])
 
     return app
 
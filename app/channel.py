@@ -0,0 +1,64 @@
+"""
+Structured output channel of jobs.
+
+Next to plain text written to stdout, job targets can send typed events which the browser renders incrementally:
+* progress(done, total): updates a progress bar
+* row(dict): appends a row to a table
+* metric(name, value): updates a named value
+
+Events travel as FRAME_EVENT frames (see framing) over the same pipe as stdout and are emitted to the session's
+socket.io room together with the output lines of a batch. Within a batch only the latest progress per bar and the
+latest value per metric are sent. Outside of a job (stdout not redirected to a job) events are printed as text.
+"""
+from typing import Any, Dict, Optional
+
+from . import stdoutproxy
+
+PROGRESS = 'progress'
+ROW = 'row'
+METRIC = 'metric'
+
+
+def send(event: Dict[str, Any]) -> None:
+    """
+    Send an event on the channel of the current context
+    :param event: event; needs to be JSON serializable
+    :return: None
+    """
+    target = stdoutproxy.proxy()
+    send_event = getattr(target, 'send_event', None)
+    if send_event is None:
+        print(event)
+    else:
+        send_event(event)
+
+
+def progress(done: int, total: Optional[int] = None, label: str = '') -> None:
+    """
+    Report progress
+    :param done: number of items done
+    :param total: total number of items; None if not known (yet)
+    :param label: identifies the progress bar
+    :return: None
+    """
+    send(dict(type=PROGRESS, label=label, done=done, total=total))
+
+
+def row(data: Dict[str, Any], table: str = 'default') -> None:
+    """
+    Add a row to a table
+    :param data: values by column name; the columns of a table are determined by its first row
+    :param table: identifies the table
+    :return: None
+    """
+    send(dict(type=ROW, table=table, row=data))
+
+
+def metric(name: str, value: Any) -> None:
+    """
+    Set a metric
+    :param name: name of the metric
+    :param value: value
+    :return: None
+    """
+    send(dict(type=METRIC, name=name, value=value))
@@ -0,0 +1,105 @@
+"""
+Adaptive concurrency limit for API requests.
+
+The limit is adjusted at runtime in the spirit of TCP congestion control (AIMD): while requests succeed with normal
+latency the limit grows by one per round of requests (additive increase); on congestion signals (429, 502, latency
+spikes) the limit is cut (multiplicative decrease).
+"""
+import asyncio
+import logging
+import time
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+
+class AdaptiveLimit:
+    """
+    Async context manager limiting the number of concurrent requests to an adaptive limit. Not thread safe; an
+    instance has to be used from a single event loop.
+    """
+    MIN_LIMIT = 1
+    MAX_LIMIT = 500
+    # factor applied to the limit on congestion
+    DECREASE_FACTOR = 0.5
+    # don't decrease more than once within this many seconds: a burst of 429s is a single congestion event
+    DECREASE_INTERVAL = 1.0
+    # latency above this multiple of the average latency is treated as congestion
+    LATENCY_FACTOR = 3.0
+    # weight of a new sample in the exponentially weighted moving average of the latency
+    LATENCY_WEIGHT = 0.1
+
+    def __init__(self, initial: int, min_limit: int = MIN_LIMIT, max_limit: int = MAX_LIMIT, name: str = ''):
+        """
+
+        :param initial: initial limit
+        :param min_limit: limit never drops below this value
+        :param max_limit: limit never grows above this value
+        :param name: name for logging
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self._limit = float(max(min_limit, min(initial, max_limit)))
+        self.name = name
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+        # average latency of successful requests
+        self.latency: Optional[float] = None
+        self.last_decrease = 0.0
+
+    @property
+    def limit(self) -> int:
+        """
+        Current limit
+        """
+        return int(self._limit)
+
+    async def __aenter__(self) -> 'AdaptiveLimit':
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        async with self.condition:
+            self.in_flight -= 1
+            free = self.limit - self.in_flight
+            if free > 0:
+                self.condition.notify(free)
+
+    def success(self, latency: float) -> None:
+        """
+        Record a successful request
+        :param latency: latency of the request in seconds
+        :return: None
+        """
+        if self.latency is None:
+            self.latency = latency
+            return
+        spike = latency > self.LATENCY_FACTOR * self.latency
+        self.latency += self.LATENCY_WEIGHT * (latency - self.latency)
+        if spike:
+            self._decrease('latency spike')
+        elif 2 * self.in_flight >= self.limit:
+            # only grow the limit if it actually is being used
+            self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+
+    def congestion(self, reason: str) -> None:
+        """
+        Record a congestion signal (429, 502, ...)
+        :param reason: reason for logging
+        :return: None
+        """
+        self._decrease(reason)
+
+    def _decrease(self, reason: str) -> None:
+        now = time.monotonic()
+        if now - self.last_decrease < self.DECREASE_INTERVAL:
+            return
+        self.last_decrease = now
+        old = self.limit
+        self._limit = max(self.min_limit, self._limit * self.DECREASE_FACTOR)
+        log.debug(f'{self}: {reason}, limit {old} -> {self.limit}')
+
+    def __repr__(self):
+        return f'AdaptiveLimit({self.name}, limit={self.limit}, in_flight={self.in_flight})'
@@ -1,16 +1,19 @@
 import uuid
 import time
-import random
+import aiohttp
 import webexteamssdk
 import logging
 import asyncio
-import aiohttp
 import sys
+from collections import Counter
 from datetime import timedelta
-from typing import Callable, Optional, List
+from typing import Callable, Iterable, Optional
 
-from .webexteamsasyncapi import WebexTeamsAsyncAPI
+from . import channel
+from .provisioning import FAILED, SKIPPED, Provisioner, ProvisioningSummary, run_stages, with_retries
+from .webexteamsasyncapi import WebexTeamsAsyncAPI, record_factory
 from .interactive import Token
+from .peopledirectory import PeopleDirectory
 
 log = logging.getLogger(__name__)
 
@@ -22,90 +25,149 @@ class MyException(Exception):
 PEOPLE_IN_EACH_SPACE = 100
 ONLY_GET_1ST_FEW = 2000
 SPACE_PREFIX = 'zz auto generated'
+# number of concurrent deletes when cleaning up
+DELETE_WORKERS = 10
+# state of deleted spaces
+DELETED = 'deleted'
 
-async def add_membership(api: WebexTeamsAsyncAPI, space_id: str, member: webexteamssdk.Person) -> None:
-    await api.create_membership(p_roomId=space_id, p_personId=member.id)
-    log.debug('Added {} to space'.format(member.displayName))
-    await api.create_message(p_roomId=space_id, p_text=f' New message after added {member.displayName} to space')
-    log.debug(f'Added {member.displayName} to space and posted message')
-    return
 
-
-async def create_memberships(api: WebexTeamsAsyncAPI, space_id: str, members: List[webexteamssdk.Person]) -> None:
+async def create_memberships(api: WebexTeamsAsyncAPI, space_id: str, members: Iterable[webexteamssdk.Person],
+                             running: Optional[Callable[[], bool]] = None) -> ProvisioningSummary:
     log.info('Adding members to space...')
-    tasks = [add_membership(api, space_id=space_id, member=m) for m in members]
-    try:
-        await asyncio.gather(*tasks)
-    except aiohttp.ClientResponseError as e:
-        log.error('ClientResponseError headers {}'.format(e.headers))
-        raise
-    except:
-        raise
-    return
+    provisioner = Provisioner(api, running=running)
+    summary = await provisioner.provision(
+        space_id, members, message=lambda member: f' New message after added {member.displayName} to space')
+    log.info(f'Provisioning summary: {summary.as_dict()}')
+    return summary
 
 
-async def clean_up_spaces(api: WebexTeamsAsyncAPI) -> None:
+async def clean_up_spaces(api: WebexTeamsAsyncAPI, running: Optional[Callable[[], bool]] = None,
+                          workers: int = DELETE_WORKERS, stop_at_page_without_matches: bool = False) -> Counter:
     """
-    Delete all auto generated spaces
+    Delete all auto generated spaces. Deletion starts as soon as the first matching spaces are listed; a fixed pool of
+    workers deletes the spaces with retries on transient errors. Progress and throughput are reported on the job
+    channel.
     :param api:
-    :return:
+    :param running: no more spaces are deleted once this returns False
+    :param workers: number of concurrent deletes
+    :param stop_at_page_without_matches: stop listing at the first page w/o auto generated spaces. Spaces are listed
+        newest first; auto generated spaces are assumed to be the newest spaces
+    :return: number of spaces by state
     """
-    spaces = []
-    async for space in api.list_spaces():
-        spaces.append(space)
-
-    log.info(f'Found {len(spaces)} spaces')
-    spaces = [s for s in spaces if s.title.startswith(SPACE_PREFIX)]
-    log.info(f'Found {len(spaces)} auto generated spaces')
-    log.info(f'Deleting {len(spaces)} spaces')
-
-    async def delete_space(space: webexteamssdk.Room) -> None:
-        await api.delete_space(p_roomId=space.id)
-        log.info(f'deleted space \'{space.title}\'')
+    running = running or (lambda: True)
+    results = Counter()
+    listed = 0
+    found = 0
+    retries = 0
+    started = time.monotonic()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=2 * workers)
+
+    def report() -> None:
+        done = sum(results.values())
+        channel.progress(done, found, label='deleted spaces')
+        elapsed = time.monotonic() - started
+        if elapsed:
+            channel.metric('spaces deleted/s', round(results[DELETED] / elapsed, 1))
+
+    def on_retry() -> None:
+        nonlocal retries
+        retries += 1
+        channel.metric('delete retries', retries)
+
+    async def worker() -> None:
+        while (space := await queue.get()) is not None:
+            if not running():
+                results[SKIPPED] += 1
+                report()
+                continue
+            try:
+                await with_retries(lambda: api.delete_space(p_roomId=space.id), attempts=Provisioner.ATTEMPTS,
+                                   delay=Provisioner.RETRY_DELAY, retry_status=Provisioner.RETRY_STATUS,
+                                   on_retry=on_retry)
+            except aiohttp.ClientResponseError as e:
+                if e.status == 404:
+                    # deleted concurrently
+                    results[DELETED] += 1
+                else:
+                    results[FAILED] += 1
+                    log.warning(f'failed to delete space \'{space.title}\': {e.status} {e.message}')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                results[FAILED] += 1
+                log.warning(f'failed to delete space \'{space.title}\': {e}')
+            else:
+                results[DELETED] += 1
+                log.info(f'deleted space \'{space.title}\'')
+            report()
+
+    async def producer() -> None:
+        nonlocal listed, found
+        pages = api.pages(api.rooms_endpoint, params=dict(max=1000, sortBy='created'),
+                          factory=record_factory('Room', ('id', 'title')), read_ahead=1, running=running)
+        try:
+            async for page in pages:
+                listed += len(page)
+                matches = [s for s in page if s.title and s.title.startswith(SPACE_PREFIX)]
+                found += len(matches)
+                report()
+                if not matches and stop_at_page_without_matches:
+                    log.info('No auto generated spaces on last page; stopped listing')
+                    break
+                for space in matches:
+                    await queue.put(space)
+        finally:
+            await pages.aclose()
+        log.info(f'Found {found} auto generated spaces in {listed} spaces')
+        for _ in tasks:
+            await queue.put(None)
+        await asyncio.gather(*tasks)
 
-    await asyncio.gather(*[delete_space(s) for s in spaces])
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    await run_stages(producer(), tasks)
+    elapsed = time.monotonic() - started
+    log.info(f'Deleted {results[DELETED]} spaces in {elapsed:.1f}s, failed: {results[FAILED]}, '
+             f'skipped: {results[SKIPPED]}, retries: {retries}')
+    return results
 
 
 async def as_create_spaces(access_token: str, running: Callable[[], bool], clean_up: bool):
-    api = WebexTeamsAsyncAPI(access_token)
+    async with WebexTeamsAsyncAPI(access_token) as api:
+        await create_or_clean_up_spaces(api, running, clean_up)
 
+
+async def create_or_clean_up_spaces(api: WebexTeamsAsyncAPI, running: Callable[[], bool], clean_up: bool):
     if clean_up:
-        await clean_up_spaces(api)
+        await clean_up_spaces(api, running=running)
         return
 
     # who am I?
     me = await api.me()
     me_id = me.id
 
-    # get all people
-    log.info('Getting list of people...')
-    people = []
-    i = 0
-    async for pp in api.list_people(p_max=100):
-        people.append(pp)
-        i += 1
-        if i >= ONLY_GET_1ST_FEW - 1:
-            break
-
-    # we don't want to create spaces with myself
-    people = [p for p in people if p.id != me_id]
-
-    log.info('Found {} people: {}'.format(len(people), ', '.join((p.displayName for p in people))))
-    while running():
-        # create random rooms with some people
-        random.shuffle(people)
-        title = f'{SPACE_PREFIX} {str(uuid.uuid4())}'
-        log.info('Creating space: {}'.format(title))
-        r = await api.create_space(p_title=title)
-        space_id = r.id
-
-        await create_memberships(api, space_id=space_id, members=(p for p in people[:PEOPLE_IN_EACH_SPACE]))
-        log.info('Created memberships and messages. Sleeping...')
-
-        await asyncio.sleep(3)
+    # random people are drawn from the snapshot of the people directory of the org which is shared by all jobs
+    directory = PeopleDirectory(me.orgId)
+    log.info('Getting people directory...')
+    refresh = await directory.ensure(api, running=running, max_people=ONLY_GET_1ST_FEW)
+    log.info(f'Found {await directory.count()} people')
+    try:
+        while running():
+            # create random rooms with some people; we don't want to create spaces with myself
+            members = await directory.sample(PEOPLE_IN_EACH_SPACE, exclude={me_id})
+            title = f'{SPACE_PREFIX} {str(uuid.uuid4())}'
+            log.info('Creating space: {}'.format(title))
+            r = await api.create_space(p_title=title)
+            space_id = r.id
+
+            await create_memberships(api, space_id=space_id, members=members, running=running)
+            log.info('Created memberships and messages. Sleeping...')
+
+            await asyncio.sleep(3)
+    finally:
+        if refresh is not None and not refresh.done():
+            # the refresh uses the API session of this job
+            refresh.cancel()
 
 
-def create_spaces(sid: str, running: Callable[[], bool], user_id: str, clean_up: Optional[bool] = False):
+async def create_spaces(job_id: str, running: Callable[[], bool], user_id: str, clean_up: Optional[bool] = False):
     # add a log.handler to stdout; log.output will be sent to the client via websocket
     format = logging.Formatter(fmt='{levelname:8s} create_spaces: {message}', style='{')
     handler = logging.StreamHandler(stream=sys.stdout)
@@ -114,11 +176,11 @@ def create_spaces(sid: str, running: Callable[[], bool], user_id: str, clean_up:
     log.addHandler(handler)
 
     try:
-        log.debug(f'user_id={user_id}, sid={sid}')
+        log.debug(f'user_id={user_id}, job_id={job_id}')
 
         # First get an access token
         log.debug(f'trying to get access token')
-        access_token = Token.get_token(user_id=user_id)
+        access_token = await Token.aget_token(user_id=user_id)
         if access_token is None:
             log.error(f'Failed to get access token for {user_id}')
             raise MyException
@@ -128,13 +190,13 @@ def create_spaces(sid: str, running: Callable[[], bool], user_id: str, clean_up:
 
         # need to make sure that the access token is good for another 10 minutes
         if lifetime_remaining.total_seconds() < 600:
-            access_token.refresh()
+            await access_token.arefresh()
             log.debug(
                 f'had to refresh access token. New lifetime: '
                 f'{timedelta(seconds=access_token.lifetime_remaining_seconds)}')
 
         # run asynchronous task
-        asyncio.run(as_create_spaces(access_token.access_token, running, clean_up))
+        await as_create_spaces(access_token.access_token, running, clean_up)
         return
 
     except MyException:
@@ -1,14 +1,19 @@
 """
 Handling of websocket events
 """
-import functools
 import logging
+import uuid
+from typing import Dict
 
 from flask import session, request
+from flask_socketio import emit, join_room, leave_room
 from functools import partial
 
 from . import socketio
 from .flaskthread import FlaskThread
+from .jobregistry import JobExists, JobRegistry
+from .outputlog import OutputLog, START
+from .scheduler import scheduler
 from .list_spaces import list_spaces
 from .create_spaces import create_spaces
 
@@ -20,22 +25,140 @@ def connect():
     log.debug(f'connect for session {request.sid}')
 
 
+# a client is attached to at most one job: job id by session id of the clients connected to this process
+attached: Dict[str, str] = dict()
+
+# a job w/o attached clients is stopped after this many seconds; allows clients to reconnect (page reload, network
+# issues) w/o losing the job
+DETACHED_GRACE_PERIOD = 300
+
+
+def attach(job_id: str) -> None:
+    """
+    Attach the client of the current request context to a job: the client receives the live output of the job
+    :param job_id: job id
+    :return: None
+    """
+    sid = request.sid
+    previous = attached.get(sid)
+    if previous == job_id:
+        return
+    leave()
+    join_room(FlaskThread.room(job_id))
+    attached[sid] = job_id
+    JobRegistry.attach(job_id, sid)
+
+
+def leave() -> None:
+    """
+    Detach the client of the current request context from its job (if any)
+    :return: None
+    """
+    sid = request.sid
+    previous = attached.pop(sid, None)
+    if previous is not None:
+        leave_room(FlaskThread.room(previous))
+        JobRegistry.detach(previous, sid)
+
+
+def start_job(event: str, target) -> None:
+    """
+    Start a job for the current user unless a job of the user is running already
+    :param event: event name for logging
+    :param target: job target
+    :return: None
+    """
+    log.debug(f'{event} {request.sid}')
+    user_id = session['user_id']
+    jobs = JobRegistry.jobs_of_user(user_id)
+    if jobs:
+        log.warning(f'{event}, job {jobs[0]} already running for {user_id}')
+        replay(jobs[0], START, reset=True)
+        return
+    # create FlaskThread; pass user id as additional parameter to target
+    job_id = uuid.uuid4().hex
+    try:
+        thread = FlaskThread.for_job(job_id=job_id, target=target, name=f'task-{job_id}', user_id=user_id)
+    except JobExists:
+        log.warning(f'{event}, job {job_id} already exists')
+        return
+    # attach before starting the job so that no output is missed
+    emit('job', {'job_id': job_id, 'reset': True})
+    attach(job_id)
+    log.debug(f'{event}, submitting job for {request.sid}: {job_id}')
+    # the scheduler starts the job as soon as the concurrency limits allow
+    scheduler.submit(thread)
+
+
+def send_output(job_id: str, offset: str) -> str:
+    """
+    Send the batches of the output log of a job following a given offset to the client of the current request
+    :param job_id: job id
+    :param offset: offset of the last batch the client has seen
+    :return: offset of the last batch sent
+    """
+    for offset, batch in OutputLog.replay(job_id, after=offset):
+        batch['id'] = offset
+        emit('output_batch', batch)
+    return offset
+
+
+def replay(job_id: str, offset: str, reset: bool = False) -> None:
+    """
+    Attach the client of the current request context to a job and send the output following the given offset
+    :param job_id: job id
+    :param offset: offset of the last batch the client has seen
+    :param reset: client has to discard the output it has (replay starts from the beginning)
+    :return: None
+    """
+    emit('job', {'job_id': job_id, 'reset': reset})
+    # send the output log before joining the room: live batches emitted while the log is read would overtake
+    # older replayed batches. Batches emitted between the replay and joining the room are sent by a 2nd replay;
+    # these can still arrive after live batches; the client keeps track of the batches it has seen
+    leave()
+    offset = send_output(job_id, offset)
+    attach(job_id)
+    send_output(job_id, offset)
+    position = scheduler.position(job_id)
+    if position is not None:
+        emit('queue_position', {'job_id': job_id, 'position': position})
+
+
+@socketio.on('resume')
+def resume(data: dict) -> None:
+    """
+    Client (re-)connected: continue with the output of the job the client has been attached to, or with the
+    running job of the user
+    :param data: job_id and offset of the last batch seen by the client; both can be None
+    :return: None
+    """
+    log.debug(f'resume {request.sid}: {data}')
+    user_id = session.get('user_id')
+    job_id = data.get('job_id')
+    offset = data.get('offset') or START
+    if job_id is not None:
+        job = JobRegistry.lookup(job_id)
+        # output of terminated jobs can be replayed as long as it is in the output log; the job id (an unguessable
+        # uuid) has been obtained by the client from the job event
+        if job is not None and job['user_id'] != user_id:
+            log.warning(f'resume {request.sid}: job {job_id} not owned by {user_id}')
+            job_id = None
+    if job_id is None:
+        jobs = JobRegistry.jobs_of_user(user_id) if user_id else []
+        if not jobs:
+            return
+        job_id, offset = jobs[0], START
+    replay(job_id, offset, reset=offset == START)
+
+
 @socketio.on('start_space_stats')
 def start_space_stats() -> None:
     """
     Start button has been pressed
     :return: None
     """
-    log.debug(f'start_space_stats {request.sid}')
-    thread = FlaskThread.get(request.sid)
-    if thread is None:
-        # create FlaskThread; pass user id as additional parameter to list_paces()
-        thread = FlaskThread.for_session(sid=request.sid, target=list_spaces, name=f'task-{request.sid}',
-                                         user_id=session['user_id'])
-        log.debug(f'start_space_stats, starting thread for {request.sid}')
-        thread.start()
-    else:
-        log.warning(f'start_space_stats, thread already running for {request.sid}')
+    start_job('start_space_stats', list_spaces)
+
 
 @socketio.on('start_create_spaces')
 def start_create_spaces() -> None:
@@ -43,16 +166,7 @@ def start_create_spaces() -> None:
     Start button has been pressed
     :return: None
     """
-    log.debug(f'start_create_spaces {request.sid}')
-    thread = FlaskThread.get(request.sid)
-    if thread is None:
-        # create FlaskThread; pass user id as additional parameter to list_paces()
-        thread = FlaskThread.for_session(sid=request.sid, target=create_spaces, name=f'task-{request.sid}',
-                                         user_id=session['user_id'])
-        log.debug(f'start_create_spaces, starting thread for {request.sid}')
-        thread.start()
-    else:
-        log.warning(f'start_create_spaces, thread already running for {request.sid}')
+    start_job('start_create_spaces', create_spaces)
 
 
 @socketio.on('start_delete_spaces')
@@ -61,28 +175,35 @@ def start_delete_spaces() -> None:
     Start button has been pressed
     :return: None
     """
-    log.debug(f'start_delete_spaces {request.sid}')
-    thread = FlaskThread.get(request.sid)
-    if thread is None:
-        # create FlaskThread; pass user id as additional parameter to list_paces()
-        thread = FlaskThread.for_session(sid=request.sid, target=partial(create_spaces, clean_up=True),
-                                         name=f'task-{request.sid}', user_id=session['user_id'])
-        log.debug(f'start_delete_spaces, starting thread for {request.sid}')
-        thread.start()
+    start_job('start_delete_spaces', partial(create_spaces, clean_up=True))
+
+
+def stop_job(job_id: str) -> None:
+    """
+    Stop a job; the job might be running in another process
+    :param job_id: job id
+    :return: None
+    """
+    log.debug(f'stopping job {job_id}')
+    if FlaskThread.get(job_id) is not None:
+        # a queued job is cancelled right away
+        if not scheduler.cancel(job_id):
+            FlaskThread.stop(job_id)
     else:
-        log.warning(f'start_delete_spaces, thread already running for {request.sid}')
+        JobRegistry.request_stop(job_id)
 
 
-def stop_thread() -> None:
+def stop_if_detached(job_id: str) -> None:
     """
-    Stop thread based on current request context
+    Stop a job if no client has attached to the job within the grace period
+    :param job_id: job id
     :return: None
     """
-    thread = FlaskThread.get(request.sid)
-    if thread:
-        # request thread to stop
-        log.debug(f'stopping thread for {request.sid}')
-        thread.set_stop_event()
+    socketio.sleep(DETACHED_GRACE_PERIOD)
+    if job_id in attached.values() or JobRegistry.clients(job_id):
+        return
+    log.debug(f'no client attached to job {job_id} for {DETACHED_GRACE_PERIOD} seconds')
+    stop_job(job_id)
 
 
 @socketio.on('stop_request')
@@ -93,14 +214,20 @@ def stop_request() -> None:
     :return: None
     """
     log.debug(f'stop_request {request.sid}')
-    stop_thread()
+    job_id = attached.get(request.sid)
+    if job_id is not None:
+        stop_job(job_id)
 
 
 @socketio.on('disconnect')
 def disconnect():
     """
-    Websocket connection disconnected (browser tab closed)
+    Websocket connection disconnected (browser tab closed, page reload, network issues). The job keeps running for
+    the grace period so that the client can reconnect
     :return:
     """
     log.debug(f'disconnect {request.sid} ')
-    stop_thread()
+    job_id = attached.get(request.sid)
+    leave()
+    if job_id is not None:
+        socketio.start_background_task(stop_if_detached, job_id)
@@ -0,0 +1,109 @@
+"""
+Job executor: fixed pool of long-lived worker threads each running a persistent asyncio event loop. Jobs are
+coroutines scheduled onto these loops as tasks; many jobs share a single loop.
+"""
+import asyncio
+import concurrent.futures
+import logging
+from threading import Event, Lock, Thread
+from typing import Coroutine, List, Optional
+
+log = logging.getLogger(__name__)
+
+
+class LoopWorker(Thread):
+    """
+    Daemon thread running an asyncio event loop forever
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name=name, daemon=True)
+        self.loop = asyncio.new_event_loop()
+        self.ready = Event()
+        # number of jobs currently scheduled on the loop of this worker
+        self.jobs = 0
+
+    def run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.ready.set()
+        log.debug(f'{self.name}: loop running')
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+        log.debug(f'{self.name}: loop closed')
+
+    def submit(self, coro: Coroutine) -> concurrent.futures.Future:
+        """
+        Schedule a coroutine as task on the loop of this worker
+        :param coro: coroutine
+        :return: future for the result of the coroutine
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class JobExecutor:
+    """
+    Pool of LoopWorkers. New jobs are scheduled on the worker with the least jobs.
+    """
+    WORKERS = 4
+
+    def __init__(self, workers: int = WORKERS):
+        self.size = workers
+        self.workers: List[LoopWorker] = []
+        self.lock = Lock()
+
+    def _start(self) -> None:
+        """
+        Start the worker threads. Needs to be called with the lock held
+        """
+        for i in range(self.size):
+            worker = LoopWorker(name=f'job-loop-{i}')
+            worker.start()
+            worker.ready.wait()
+            self.workers.append(worker)
+        log.debug(f'started {self.size} job loops')
+
+    def submit(self, coro: Coroutine) -> concurrent.futures.Future:
+        """
+        Schedule a job on one of the worker loops. Worker threads are started on first use.
+        :param coro: job coroutine
+        :return: future for the result of the job
+        """
+        with self.lock:
+            if not self.workers:
+                self._start()
+            worker = min(self.workers, key=lambda w: w.jobs)
+            worker.jobs += 1
+        future = worker.submit(coro)
+        future.add_done_callback(lambda _: self._job_done(worker))
+        return future
+
+    def _job_done(self, worker: LoopWorker) -> None:
+        with self.lock:
+            worker.jobs -= 1
+
+    @property
+    def loops(self) -> List[asyncio.AbstractEventLoop]:
+        with self.lock:
+            return [w.loop for w in self.workers]
+
+    def shutdown(self, timeout: Optional[float] = None) -> None:
+        """
+        Stop all worker loops
+        :param timeout: time to wait for each worker thread to terminate
+        :return: None
+        """
+        with self.lock:
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.join(timeout)
+
+
+# process wide executor used by FlaskThread
+executor = JobExecutor()
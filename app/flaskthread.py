@@ -1,95 +1,256 @@
+import asyncio
+import concurrent.futures
+import functools
+import inspect
 import logging
-from threading import Lock, Thread, Event
-import base64
+from threading import Lock, Event
 import io
+import json
 import socket
-from typing import Dict, Optional
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
 import eventlet
 import eventlet.greenio
 
+from . import channel
+from . import framing
+from . import outputqueue
+from .executor import executor
+from .jobregistry import JobRegistry
+from .outputlog import OutputLog
 from . import stdoutproxy
 from . import socketio
 
 log = logging.getLogger(__name__)
 io_log = logging.getLogger(f'{__name__}.io')
 
-END_OF_PIPE_MAGIC = '\x00\x01\x05'
-
 
 class PipeIO(io.TextIOBase):
     """
-    Text IO sending each line as message over a pipe terminated by a zero string.
+    Text IO sending each line as frame over a pipe (see framing). Frames are sent through a bounded output queue so
+    that writing never blocks on a slow reader (see outputqueue).
     """
 
-    def __init__(self, pipe):
-        self.pipe = pipe
-        self.buffer = ''
+    def __init__(self, pipe, max_lines: int, policy: str = outputqueue.POLICY_DROP_OLDEST,
+                 name: Optional[str] = None):
+        """
+
+        :param pipe: pipe to write to. Ownership of the pipe is passed to the output queue
+        :param max_lines: max number of lines held in the output queue
+        :param policy: overflow policy of the output queue
+        :param name: name for the output queue
+        """
+        self.queue = outputqueue.OutputQueue(pipe, max_lines=max_lines, policy=policy, name=name)
+        # partial line(s) not yet terminated by \n
+        self.pending: List[str] = []
 
     def write(self, s: str) -> int:
         """
-        Write a string. Each line is sent to the pipe individually.
+        Write a string. Each line is sent to the pipe as individual frame.
         :param s: string to write
         :return: return number of characters written
         """
-        io_log.debug(f'{self}.write: s={s.encode()}')
-        self.buffer = f'{self.buffer}{s}'
-        lines = self.buffer.split('\n')
-        if lines[-1]:
-            # if the last line is not empty then we are missing the \n at the end and thus we should not send the
-            # last line and instead buffer it for the future
-            self.buffer = lines[-1]
-        else:
-            self.buffer = ''
+        if io_log.isEnabledFor(logging.DEBUG):
+            io_log.debug(f'{self}.write: s={s.encode()}')
+        if '\n' not in s:
+            # no complete line: buffer and wait for continuation (or \n)
+            if s:
+                self.pending.append(s)
+            return len(s)
+        lines = s.split('\n')
+        if self.pending:
+            self.pending.append(lines[0])
+            lines[0] = ''.join(self.pending)
+            self.pending.clear()
         # last line never needs to be sent. It's either
         # * empty if string ended with \n -> no need to send an empty line
         # * not empty -> don't send line. Instead buffer it and wait or continuation (or \n)
-        lines = lines[:-1]
+        if lines[-1]:
+            self.pending.append(lines[-1])
 
-        # now send all lines
-        for line in lines:
-            self._send_to_pipe(line)
+        self.queue.put(map(framing.encode_line, lines[:-1]))
         return len(s)
 
+    def send_event(self, event: Dict[str, Any]) -> None:
+        """
+        Send a structured event (see channel)
+        :param event: event
+        :return: None
+        """
+        self.queue.put((framing.encode_event(event),))
+
     def shutdown(self) -> None:
         """
-        Ask other end to terminate
+        Ask other end to terminate. A pending partial line is sent before the end frame. The pipe is closed once
+        everything has been sent.
+        :return: None
+        """
+        if self.pending:
+            self.queue.put((framing.encode_line(''.join(self.pending)),))
+            self.pending.clear()
+        self.queue.close()
+
+
+class OutputBatcher:
+    """
+    Collect output lines and structured events of a job and emit them as a single output_batch event once the
+    batch is due: either the oldest item in the batch has waited for the batch interval or the batch has reached the
+    byte budget. Progress and metric events are coalesced: only the latest one per progress bar/metric is sent.
+    Each batch is appended to the output log of the job before it is emitted; the offset in the output log is sent
+    with the batch so that reconnecting clients can resume (see outputlog).
+    """
+
+    def __init__(self, job_id: str, interval: float, max_bytes: int):
+        """
+
+        :param job_id: job id; batches are emitted to the room of the job
+        :param interval: max time in seconds a line is held back
+        :param max_bytes: batch size (in characters) triggering an immediate emit
+        """
+        self.job_id = job_id
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.lines: List[str] = []
+        self.events: List[dict] = []
+        # index of coalesced events in the events list by (type, label/name)
+        self.coalesced: Dict[Tuple[str, str], int] = {}
+        self.size = 0
+        # time the 1st line of the current batch was added
+        self.started = 0.0
+
+    def add(self, line: str) -> None:
+        """
+        Add a line to the current batch
+        :param line: line to add
+        :return: None
+        """
+        if not self.pending:
+            self.started = time.monotonic()
+        self.lines.append(line)
+        self.size += len(line)
+
+    def add_event(self, payload: str) -> None:
+        """
+        Add a structured event to the current batch
+        :param payload: JSON encoded event
+        :return: None
+        """
+        event = json.loads(payload)
+        if not self.pending:
+            self.started = time.monotonic()
+        event_type = event.get('type')
+        if event_type == channel.PROGRESS:
+            key = (event_type, event.get('label'))
+        elif event_type == channel.METRIC:
+            key = (event_type, event.get('name'))
+        else:
+            key = None
+        if key is not None:
+            i = self.coalesced.get(key)
+            if i is not None:
+                self.events[i] = event
+                return
+            self.coalesced[key] = len(self.events)
+        self.events.append(event)
+        self.size += len(payload)
+
+    @property
+    def pending(self) -> bool:
+        return bool(self.lines or self.events)
+
+    @property
+    def full(self) -> bool:
+        return self.size >= self.max_bytes
+
+    @property
+    def due(self) -> bool:
+        return self.pending and (self.full or time.monotonic() - self.started >= self.interval)
+
+    def timeout(self) -> Optional[float]:
+        """
+        Time until the current batch is due
+        :return: time in seconds; None if there is no pending batch
+        """
+        if not self.pending:
+            return None
+        # never return 0: a zero timeout would make the socket non-blocking
+        return max(self.started + self.interval - time.monotonic(), 0.001)
+
+    def flush(self) -> None:
+        """
+        Emit the current batch (if any)
         :return: None
         """
-        self._send_to_pipe(END_OF_PIPE_MAGIC)
+        if not self.pending:
+            return
+        self._emit({'data': self.lines, 'events': self.events})
+        self.lines = []
+        self.events = []
+        self.coalesced = {}
+        self.size = 0
 
-    def _send_to_pipe(self, line: str) -> None:
+    def finish(self) -> None:
         """
-        Send a line to the pipe as base64 encoded and zero terminated string
+        Emit the current batch (if any) followed by the end marker
+        :return: None
         """
-        io_log.debug(f'{self}.send_to_pipe: line="{line}"')
-        # each line should be sent as base64 string terminated by a zero string
-        data = base64.b64encode(line.encode()) + b'\x00'
-        io_log.debug(f'{self}.send_to_pipe: base64="{data}"')
-        self.pipe.sendall(data)
+        self.flush()
+        self._emit({'data': [], 'events': [], 'end': True})
+        try:
+            OutputLog.finish(self.job_id)
+        except Exception as e:
+            log.warning(f'OutputBatcher({self.job_id}): failed to finish output log: {e}')
 
+    def _emit(self, batch: dict) -> None:
+        try:
+            offset = OutputLog.append(self.job_id, batch)
+        except Exception as e:
+            # output can't be replayed, but clients still get the live output
+            log.warning(f'OutputBatcher({self.job_id}): failed to append to output log: {e}')
+            offset = None
+        batch['id'] = offset
+        socketio.emit('output_batch', batch, room=FlaskThread.room(self.job_id))
 
-class FlaskThread(Thread):
+
+class FlaskThread:
     """
-    Thread with stdout redirected to a socket linked to an eventlet sending all data received from the socket as
-    messages to a webesocket so that it can then be displayed on a web page
+    Job with stdout redirected to a socket linked to an eventlet sending all data received from the socket as
+    messages to a webesocket so that it can then be displayed on a web page.
+    Jobs don't get an OS thread of their own: they are scheduled as tasks on the persistent asyncio loops of the
+    shared job executor (see executor). Coroutine targets run directly on the loop; plain function targets are
+    run in the default thread pool of the loop.
     https://stackoverflow.com/questions/14890997/redirect-stdout-to-a-file-only-for-a-specific-thread
     https://docs.python.org/3/library/socket.html#socket.socket.makefile
     """
+    # output lines are emitted to the websocket in batches. A batch is emitted after this many seconds or ..
+    OUTPUT_BATCH_INTERVAL = 0.05
+    # .. as soon as the batch has reached this size (characters)
+    OUTPUT_BATCH_BYTES = 32 * 1024
+    # max number of output lines queued for a job which can't be sent to the websocket fast enough
+    OUTPUT_QUEUE_LINES = 10000
+    # what to do if the output queue is full; see outputqueue.POLICIES. POLICY_BLOCK is not supported for coroutine
+    # targets: a blocked write would stall all jobs on the same executor loop
+    OUTPUT_OVERFLOW_POLICY = outputqueue.POLICY_DROP_OLDEST
 
-    def __init__(self, sid: str, target=None, name: Optional[str] = None, *args, **kwargs):
+    def __init__(self, job_id: str, target=None, name: Optional[str] = None, *args, **kwargs):
         """
 
-        :param sid: session id
-        :param target: target for thread. First two parameters to target when called are session id and a method to
-        determine whether the thread should continue to run
-        :param name: name of thread
+        :param job_id: job id
+        :param target: target for job; either a coroutine function or a plain function. First two parameters to
+        target when called are job id and a method to determine whether the job should continue to run
+        :param name: name of job
         :param args: arguments for target
         :param kwargs: arguments for target
         """
-        self.sid = sid
+        self.job_id = job_id
+        self.name = name or f'job-{job_id}'
         self.stop_event = Event()
         self.flask_target = target
+        self.args = args
+        self.kwargs = kwargs
+        self.user_id: Optional[str] = kwargs.get('user_id')
+        self.future: Optional[concurrent.futures.Future] = None
         log.debug(f'FlaskThread.__init__: {self}')
 
         # need to spawn an eventlet worker reading from a socket and sending to websocket
@@ -98,40 +259,85 @@ class FlaskThread(Thread):
         self.pipe: socket.SocketType = s1
         self.green_pipe = s2
         self.green_thread = eventlet.spawn(self._pipe_processor)
-        super().__init__(target=self._wrapped_target, name=name, args=args, kwargs=kwargs)
 
-    # registry mapping from sid to FlaskThread
+    # registry mapping from job id to FlaskThread
     _registry: Dict[str, 'FlaskThread'] = {}
     _lock = Lock()
 
     @staticmethod
-    def get(sid: str) -> Optional['FlaskThread']:
+    def room(job_id: str) -> str:
+        """
+        socket.io room of a job; all clients attached to the job join this room
+        :param job_id: job id
+        :return: room name
+        """
+        return f'job-{job_id}'
+
+    @staticmethod
+    def get(job_id: str) -> Optional['FlaskThread']:
         """
-        Get Thread registered for given session id
-        :param sid: session id
+        Get Thread registered for given job id
+        :param job_id: job id
         :return: registered FlaskThread or None
         """
-        return FlaskThread._registry.get(sid)
+        return FlaskThread._registry.get(job_id)
 
     @staticmethod
-    def for_session(sid: str, target=None, name: Optional[str] = None, *args, **kwargs) -> 'FlaskThread':
+    def for_job(job_id: str, target=None, name: Optional[str] = None, *args, **kwargs) -> 'FlaskThread':
         """
-        Factory function to create a FlaskThread for a given session id. The thread also gets registered for the
-        given session id
-        :param sid: session id
-        :param target: target for thread. First two parameters to target when called are session id and a method to
+        Factory function to create a FlaskThread for a given job id. The thread also gets registered for the
+        given job id
+        :param job_id: job id
+        :param target: target for thread. First two parameters to target when called are job id and a method to
         determine whether the thread should continue to run
         :param name: name for the thread
         :param args: arguments for target
         :param kwargs: arguments for target
         :return: FlaskThread
+        :raises JobExists: if a job with the same id is already running in another process
         """
         with FlaskThread._lock:
-            assert FlaskThread.get(sid) is None
-            thread = FlaskThread(sid=sid, target=target, name=name, *args, **kwargs)
-            FlaskThread._registry[sid] = thread
+            assert FlaskThread.get(job_id) is None
+            # also register in the registry shared by all processes
+            JobRegistry.register(job_id, name=name or f'job-{job_id}', user_id=kwargs.get('user_id'))
+            thread = FlaskThread(job_id=job_id, target=target, name=name, *args, **kwargs)
+            FlaskThread._registry[job_id] = thread
         return thread
 
+    @staticmethod
+    def stop(job_id: str) -> None:
+        """
+        Ask a job to stop
+        :param job_id: job id
+        :return: None
+        """
+        thread = FlaskThread.get(job_id)
+        if thread is not None:
+            thread.set_stop_event()
+
+    def start(self) -> None:
+        """
+        Schedule the job on the job executor
+        :return: None
+        """
+        assert self.future is None, 'job already started'
+        assert not (self.OUTPUT_OVERFLOW_POLICY == outputqueue.POLICY_BLOCK
+                    and inspect.iscoroutinefunction(self.flask_target)), \
+            'blocking output queue would stall the executor loop of a coroutine target'
+        self.future = executor.submit(self._wrapped_target())
+
+    def is_alive(self) -> bool:
+        return self.future is not None and not self.future.done()
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        """
+        Wait for the job to terminate
+        :param timeout: max time to wait
+        :return: None
+        """
+        if self.future is not None:
+            concurrent.futures.wait((self.future,), timeout=timeout)
+
     def set_stop_event(self) -> None:
         """
         Ask thread to stop
@@ -148,43 +354,53 @@ class FlaskThread(Thread):
         """
         return not self.stop_event.is_set()
 
-    def _wrapped_target(self, *args, **kwargs) -> None:
+    async def _wrapped_target(self) -> None:
         """
-        Target for the thread. Creates the environment for the actual target, executes the target, and handles
-        cleanup
-        :param args: args for target
-        :param kwargs: kwargs for target
+        Job coroutine. Creates the environment for the actual target, executes the target, and handles cleanup
         :return: None
         """
         log.debug(f'{self}.wrapped_target: starting target code')
 
-        # redirect stdout of thread to pipe to communicate with eventlet pushing output to the web page via websocket
-        pipe_io = PipeIO(self.pipe)
-        stdoutproxy.redirect(pipe_io)
+        # redirect stdout of the job's task to pipe to communicate with eventlet pushing output to the web page via
+        # websocket. The redirection is bound to the context of the task and is inherited by tasks and threads
+        # started by the target.
+        pipe_io = PipeIO(self.pipe, max_lines=self.OUTPUT_QUEUE_LINES, policy=self.OUTPUT_OVERFLOW_POLICY,
+                         name=self.job_id)
+        redirect_token = stdoutproxy.redirect(pipe_io)
 
         # call the target. First two parameters are:
-        # * sid
-        # * a method to check whether the thread should terminate
+        # * job id
+        # * a method to check whether the job should terminate
+        target = functools.partial(self.flask_target, self.job_id, self.running, *self.args, **self.kwargs)
         try:
-            self.flask_target(self.sid, self.running, *args, **kwargs)
+            if not self.running():
+                # cancelled before the job has been admitted (see scheduler)
+                print('Job cancelled')
+            elif inspect.iscoroutinefunction(self.flask_target):
+                await target()
+            else:
+                await asyncio.to_thread(target)
         except Exception as e:
-            log.error(f'Execution failed {e}')
+            log.exception(f'Execution failed {e}')
             print(f'Execution failed {e}')
-            raise
-
-        log.debug(f'{self}.wrapped_target: target code terminated')
+        finally:
+            log.debug(f'{self}.wrapped_target: target code terminated')
 
-        # remove thread from registry
-        with FlaskThread._lock:
-            t = FlaskThread._registry.pop(self.sid)
-            assert t is not None
-        log.debug(f'{self}.wrapped_target: removed thread from registry')
+            # remove job from registry
+            with FlaskThread._lock:
+                t = FlaskThread._registry.pop(self.job_id)
+                assert t is not None
+            try:
+                await asyncio.to_thread(JobRegistry.unregister, self.job_id, user_id=self.user_id)
+            except Exception as e:
+                # registration expires anyway
+                log.warning(f'{self}.wrapped_target: failed to unregister job: {e}')
+            log.debug(f'{self}.wrapped_target: removed job from registry')
 
-        stdoutproxy.end_redirect()
+            stdoutproxy.end_redirect(redirect_token)
 
-        # ask processor to terminate
-        pipe_io.shutdown()
-        self.pipe.close()
+            # ask processor to terminate; pipe gets closed after all queued output has been sent
+            pipe_io.shutdown()
 
     def _pipe_processor(self) -> None:
         """
@@ -192,25 +408,41 @@ class FlaskThread(Thread):
         :return: None
         """
         # read from socket and emit data to websocket
-        # records on the pipe are base64 encoded strings which are separated by zero (\x00)
-        log.debug(f'pipe_processor {self.sid}: starting')
-        while True:
-            buffer = b''
-            # read until some data has been received and the received data end with zero termination
-            while not (buffer and buffer[-1] == 0):
-                buffer += self.green_pipe.recv(1024)
-            # now send each line separately to web page
-            for data in buffer.split(b'\x00')[:-1]:
-                io_log.debug(f'pipe_processor {self.sid}: base64="{data}"')
-                data = base64.b64decode(data).decode()
-                io_log.debug(f'pipe_processor {self.sid}: str="{data}"')
-                if data == END_OF_PIPE_MAGIC:
+        # records on the pipe are frames (see framing); the end frame terminates the processor
+        log.debug(f'pipe_processor {self.job_id}: starting')
+        reader = framing.FrameReader(self.green_pipe)
+        batcher = OutputBatcher(self.job_id, interval=self.OUTPUT_BATCH_INTERVAL, max_bytes=self.OUTPUT_BATCH_BYTES)
+        done = False
+        while not done:
+            # only wait for more data until the pending batch is due
+            self.green_pipe.settimeout(batcher.timeout())
+            try:
+                if not reader.read():
+                    break
+            except socket.timeout:
+                batcher.flush()
+                continue
+            for frame_type, data in reader.frames():
+                if frame_type == framing.FRAME_END:
+                    done = True
                     break
-                socketio.emit('output', {'data': data}, room=self.sid)
-            if data == END_OF_PIPE_MAGIC:
-                break
+                if io_log.isEnabledFor(logging.DEBUG):
+                    io_log.debug(f'pipe_processor {self.job_id}: str="{data}"')
+                if frame_type == framing.FRAME_EVENT:
+                    batcher.add_event(data)
+                else:
+                    batcher.add(data)
+                if batcher.full:
+                    batcher.flush()
+            if batcher.due:
+                batcher.flush()
+        batcher.finish()
         self.green_pipe.close()
-        log.debug(f'pipe_processor {self.sid}: done')
+        log.debug(f'pipe_processor {self.job_id}: done')
 
     def __repr__(self):
-        return f'FlaskThread(sid={self.sid})'
+        return f'FlaskThread(job_id={self.job_id})'
+
+
+# stop requests for jobs of this process might be received by other processes
+JobRegistry.on_stop(FlaskThread.stop)
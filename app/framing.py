@@ -0,0 +1,123 @@
+"""
+Wire format of the records sent over the pipe between a FlaskThread and its pipe processor greenlet.
+
+Each record is a frame consisting of a fixed size header followed by the raw payload:
+* frame type: 1 byte
+* payload length: 4 bytes, network byte order
+* payload: UTF-8 encoded text
+"""
+import json
+import struct
+from typing import List, Tuple
+
+HEADER = struct.Struct('!BI')
+
+# a line of output; the payload is the line w/o terminating \n
+FRAME_LINE = 1
+# end of output; the pipe processor terminates when receiving this frame. No payload
+FRAME_END = 2
+# structured event (progress, row, metric; see channel); the payload is a JSON object
+FRAME_EVENT = 3
+
+
+def encode(frame_type: int, payload: bytes = b'') -> bytes:
+    """
+    Encode a frame
+    :param frame_type: type of the frame
+    :param payload: payload
+    :return: encoded frame
+    """
+    return HEADER.pack(frame_type, len(payload)) + payload
+
+
+def encode_line(line: str) -> bytes:
+    """
+    Encode a line of output as frame
+    :param line: line w/o terminating \n
+    :return: encoded frame
+    """
+    payload = line.encode()
+    return HEADER.pack(FRAME_LINE, len(payload)) + payload
+
+
+def encode_event(event: dict) -> bytes:
+    """
+    Encode a structured event as frame
+    :param event: event; needs to be JSON serializable
+    :return: encoded frame
+    """
+    payload = json.dumps(event, separators=(',', ':'), default=str).encode()
+    return HEADER.pack(FRAME_EVENT, len(payload)) + payload
+
+
+END_FRAME = encode(FRAME_END)
+
+
+class FrameReader:
+    """
+    Read frames from a socket. Data is received directly into a re-used bytearray and frames are parsed in place; the
+    buffer only grows if a single frame does not fit into it.
+    """
+    INITIAL_SIZE = 64 * 1024
+
+    def __init__(self, sock, size: int = INITIAL_SIZE):
+        """
+
+        :param sock: socket to read from. Needs to support recv_into()
+        :param size: initial buffer size
+        """
+        self.sock = sock
+        self.buffer = bytearray(size)
+        # start of unparsed data in the buffer
+        self.start = 0
+        # end of valid data in the buffer
+        self.end = 0
+
+    def read(self) -> bool:
+        """
+        Receive the next chunk of data from the socket into the buffer
+        :return: False if the other end closed the socket
+        """
+        if self.end == len(self.buffer):
+            self._make_room()
+        with memoryview(self.buffer) as view:
+            received = self.sock.recv_into(view[self.end:])
+        if not received:
+            return False
+        self.end += received
+        return True
+
+    def _make_room(self) -> None:
+        """
+        Move unparsed data to the start of the buffer. The buffer is doubled in size if it still is full after that.
+        :return: None
+        """
+        pending = self.end - self.start
+        if self.start:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        if self.end == len(self.buffer):
+            self.buffer.extend(bytes(len(self.buffer)))
+
+    def frames(self) -> List[Tuple[int, str]]:
+        """
+        Parse all complete frames from the buffer. A partial frame at the end of the buffer stays in the buffer
+        until the remaining data has been received.
+        :return: list of (frame type, decoded payload)
+        """
+        result = []
+        buffer, start, end = self.buffer, self.start, self.end
+        header_size = HEADER.size
+        with memoryview(buffer) as view:
+            while end - start >= header_size:
+                frame_type, length = HEADER.unpack_from(buffer, start)
+                payload_end = start + header_size + length
+                if payload_end > end:
+                    break
+                result.append((frame_type, str(view[start + header_size:payload_end], 'utf-8', 'replace')))
+                start = payload_end
+        if start == end:
+            # everything parsed: next read can start at the beginning of the buffer
+            start = end = 0
+        self.start, self.end = start, end
+        return result
@@ -1,15 +1,24 @@
 from urllib.parse import urlencode, parse_qs
 from uuid import uuid4
 from functools import wraps
-from typing import Dict, Optional
-from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime, timedelta, timezone
+import asyncio
 import os
 import logging
 import json
+import threading
 
-from requests import post, get
+import requests
+from requests.adapters import HTTPAdapter
+from eventlet import tpool
 from flask import Blueprint, render_template, session, current_app, request, redirect
 from redis import Redis
+from redis.exceptions import ResponseError
+
+from . import redisclient
+from .tokencache import CHANNEL, InvalidationListener, TTLCache, invalidation_message
+from .tokenrefresh import RefreshCoordinator
 
 log = logging.getLogger(__name__)
 token_log = logging.getLogger(f'{__name__}.token')
@@ -21,10 +30,26 @@ class Token:
     # Redis connection to save tokens
     _redis: Redis = None
 
+    # in-process cache of decoded tokens: max number of tokens and time to live in seconds. The TTL bounds staleness
+    # if invalidations from other processes get lost
+    CACHE_SIZE = 1000
+    CACHE_TTL = 60
+    _cache = TTLCache(max_size=CACHE_SIZE, ttl=CACHE_TTL)
+    _listener: InvalidationListener = None
+
+    # refreshes are deduplicated per user across threads and processes
+    _refresher = RefreshCoordinator(refresh=lambda user_id: Token._locked_refresh(user_id),
+                                    due=lambda: Token._refresh_due())
+
     @staticmethod
     def set_redis(redis: Redis) -> None:
         token_log.debug(f'Redis connection set: {redis}')
         Token._redis = redis
+        Token._cache.clear()
+        # tokens cached by this process are invalidated when other processes commit tokens
+        Token._listener = InvalidationListener(redis, invalidate=Token._cache.invalidate, clear=Token._cache.clear)
+        Token._listener.start()
+        Token._refresher.set_redis(redis)
 
     @staticmethod
     def _redis_key(user_id: str) -> str:
@@ -51,31 +76,162 @@ class Token:
         :return: token registered for that user .. or None
         """
         assert Token._redis is not None
+        token = Token._cache.get(user_id)
+        if token is not None:
+            return token
+        return Token._read(user_id)
+
+    @staticmethod
+    def _read(user_id: str) -> Optional["Token"]:
+        """
+        Read token for given user id from Redis bypassing the cache; the token read is cached
+        :param user_id: user id
+        :return: token registered for that user .. or None
+        """
+        try:
+            d = Token._redis.hgetall(Token._redis_key(user_id))
+        except ResponseError:
+            # token has been stored as JSON string by an older version
+            return Token._migrate(user_id)
+        token = Token.from_redis_hash(d)
+        token_log.debug(f'get_token: {user_id}:{token and token.access_token}')
+        if token is not None:
+            Token._cache.put(user_id, token)
+        return token
+
+    @staticmethod
+    def get_tokens(user_ids: List[str]) -> Dict[str, Optional["Token"]]:
+        """
+        Obtain tokens for multiple users with a single Redis round trip
+        :param user_ids: user ids to obtain tokens for
+        :return: dict of tokens (or None) by user id
+        """
+        assert Token._redis is not None
+        tokens = {user_id: Token._cache.get(user_id) for user_id in user_ids}
+        missing = [user_id for user_id, token in tokens.items() if token is None]
+        if not missing:
+            return tokens
+        pipeline = Token._redis.pipeline(transaction=False)
+        for user_id in missing:
+            pipeline.hgetall(Token._redis_key(user_id))
+        for user_id, d in zip(missing, pipeline.execute(raise_on_error=False)):
+            if isinstance(d, ResponseError):
+                tokens[user_id] = Token._migrate(user_id)
+            else:
+                token = tokens[user_id] = Token.from_redis_hash(d)
+                if token is not None:
+                    Token._cache.put(user_id, token)
+        return tokens
+
+    @staticmethod
+    async def aget_token(user_id: str) -> Optional["Token"]:
+        """
+        Obtain token for given user id; for use on asyncio loops
+        :param user_id: user id to obtain token for
+        :return: token registered for that user .. or None
+        """
+        assert Token._redis is not None
+        token = Token._cache.get(user_id)
+        if token is not None:
+            return token
+        try:
+            d = await redisclient.async_client(Token._redis).hgetall(Token._redis_key(user_id))
+        except ResponseError:
+            return await asyncio.to_thread(Token._migrate, user_id)
+        token = Token.from_redis_hash(d)
+        token_log.debug(f'aget_token: {user_id}:{token and token.access_token}')
+        if token is not None:
+            Token._cache.put(user_id, token)
+        return token
+
+    @staticmethod
+    def _migrate(user_id: str) -> Optional["Token"]:
+        """
+        Read a token stored as JSON string and store it again as hash
+        :param user_id: user id
+        :return: token
+        """
         jd = Token._redis.get(Token._redis_key(user_id))
         if jd is None:
-            token_log.debug(f'get_token: {user_id}:None')
-        else:
-            token_log.debug(f'get_token: {user_id}:{jd}')
-            return Token.from_json(jd, commit=False)
-        return None
+            return None
+        token_log.debug(f'migrating token: {user_id}:{jd}')
+        token = Token.from_json(jd, commit=False)
+        token.commit()
+        return token
+
+    def to_redis_hash(self) -> Dict[str, str]:
+        """
+        Representation of the token as Redis hash
+        :return: dict of str values
+        """
+        return dict(user_id=self.user_id,
+                    access_token=self.access_token,
+                    expires_in=str(self.expires_in),
+                    refresh_token=self.refresh_token,
+                    refresh_token_expires_in=str(self.refresh_token_expires_in),
+                    access_token_expires_at=self.access_token_expires_at.isoformat(),
+                    refresh_token_expires_at=self.refresh_token_expires_at.isoformat())
+
+    @staticmethod
+    def from_redis_hash(d: Dict[bytes, bytes]) -> Optional["Token"]:
+        """
+        Create token from Redis hash
+        :param d: hash as returned by HGETALL
+        :return: token; None if the hash is empty
+        """
+        if not d:
+            return None
+        d = {k.decode(): v.decode() for k, v in d.items()}
+        return Token(user_id=d['user_id'],
+                     access_token=d['access_token'],
+                     expires_in=int(d['expires_in']),
+                     refresh_token=d['refresh_token'],
+                     refresh_token_expires_in=int(d['refresh_token_expires_in']),
+                     access_token_expires_at=datetime.fromisoformat(d['access_token_expires_at']),
+                     refresh_token_expires_at=datetime.fromisoformat(d['refresh_token_expires_at']))
+
+    def _queue_commit(self, pipeline) -> None:
+        """
+        Queue the commands to store the token in a pipeline. The key expires together with the refresh token.
+        Other processes are notified to drop the token from their caches.
+        :param pipeline: sync or asyncio Redis pipeline
+        :return: None
+        """
+        key = self.redis_key
+        # replace the complete key; also takes care of keys stored as JSON string by older versions
+        pipeline.delete(key)
+        pipeline.hset(key, mapping=self.to_redis_hash())
+        pipeline.expireat(key, int(self.refresh_token_expires_at.replace(tzinfo=timezone.utc).timestamp()))
+        pipeline.publish(CHANNEL, invalidation_message(self.user_id))
 
     def commit(self) -> None:
         """
         Commit a Token to Redis
         :return: None
         """
-        jd = {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
-        # convert datetimes to str
-        for k in jd:
-            if k.endswith('_at'):
-                jd[k] = jd[k].isoformat()
-        jd = json.dumps(jd)
-        token_log.debug(f'commit: {self.redis_key}/{jd}')
-        Token._redis.set(self.redis_key, jd)
+        token_log.debug(f'commit: {self.redis_key}/{self.access_token}')
+        pipeline = Token._redis.pipeline(transaction=True)
+        self._queue_commit(pipeline)
+        pipeline.execute()
+        Token._cache.put(self.user_id, self)
+
+    async def acommit(self) -> None:
+        """
+        Commit a Token to Redis; for use on asyncio loops
+        :return: None
+        """
+        token_log.debug(f'acommit: {self.redis_key}/{self.access_token}')
+        pipeline = redisclient.async_client(Token._redis).pipeline(transaction=True)
+        self._queue_commit(pipeline)
+        await pipeline.execute()
+        Token._cache.put(self.user_id, self)
 
     # minimal remaining token lifetime; minimum time before token will be refreshed
     MIN_TOKEN_LIFETIME = 300
 
+    # tokens used recently are refreshed in the background once their remaining lifetime drops below this value
+    PROACTIVE_REFRESH_LIFETIME = 3 * MIN_TOKEN_LIFETIME
+
     def __init__(self, user_id, access_token, expires_in, refresh_token, refresh_token_expires_in,
                  access_token_expires_at=None, refresh_token_expires_at=None, **kwargs):
         assert Token._redis is not None
@@ -134,14 +290,50 @@ class Token:
 
     def refresh(self) -> None:
         """
-        Refresh the access token
+        Refresh the access token. Concurrent refreshes for the same user (in any process) result in a single call to
+        the identity service.
+        :return: None
+        """
+        token = Token._refresher.refresh(self.user_id)
+        if token is not None and token is not self:
+            self.__dict__.update(token.__dict__)
+
+    async def arefresh(self) -> None:
+        """
+        Refresh the access token; for use on asyncio loops
         :return: None
         """
-        tokens = WxHelper.access_token(self.refresh_token)
+        token = await Token._refresher.arefresh(self.user_id)
+        if token is not None and token is not self:
+            self.__dict__.update(token.__dict__)
+
+    @staticmethod
+    def _locked_refresh(user_id: str) -> Optional["Token"]:
+        """
+        Refresh the token of a user; called by the refresh coordinator holding the refresh lock of the user
+        :param user_id: user id
+        :return: refreshed token
+        """
+        # another process might have refreshed the token while we were waiting for the lock
+        token = Token._read(user_id)
+        if token is None or token.lifetime_remaining_seconds >= Token.PROACTIVE_REFRESH_LIFETIME:
+            return token
+        token_log.debug(f'refresh: {user_id}')
+        tokens = WxHelper.access_token(token.refresh_token)
         for k, v in tokens.items():
-            self.__dict__[k] = v
-        self.update_expiry()
-        self.commit()
+            token.__dict__[k] = v
+        token.update_expiry()
+        token.commit()
+        return token
+
+    @staticmethod
+    def _refresh_due() -> List[str]:
+        """
+        User ids of cached tokens which should be refreshed proactively
+        :return: list of user ids
+        """
+        return [token.user_id for token in Token._cache.values()
+                if token.lifetime_remaining_seconds < Token.PROACTIVE_REFRESH_LIFETIME]
 
     @staticmethod
     def assert_token(user_id: str, refresh_token: str) -> "Token":
@@ -155,7 +347,7 @@ class Token:
         token = Token.get_token(user_id)
         if token is None:
             token_log.debug(f'creating new access token from refresh token: {user_id}:{refresh_token}')
-            token = WxHelper.access_token(refresh_token)
+            token = tpool.execute(WxHelper.access_token, refresh_token)
             token = Token.from_dict(user_id, token)
         return token
 
@@ -176,7 +368,42 @@ class WxHelper:
     REDIRECT_URI = os.getenv("REDIRECT_URI")
     SCOPE = os.getenv("SCOPE")
 
-    BASE_URL = 'https://api.ciscospark.com'
+    BASE_URL = os.getenv('WEBEX_BASE_URL', 'https://api.ciscospark.com')
+
+    # timeouts in seconds for requests to the identity service
+    CONNECT_TIMEOUT = float(os.getenv('OAUTH_CONNECT_TIMEOUT', 5))
+    READ_TIMEOUT = float(os.getenv('OAUTH_READ_TIMEOUT', 20))
+    # max number of pooled connections
+    POOL_SIZE = 20
+    # user details are cached by access token for this many seconds
+    ME_CACHE_TTL = 300
+
+    _session: requests.Session = None
+    _session_lock = threading.Lock()
+    _me_cache = TTLCache(max_size=1000, ttl=ME_CACHE_TTL)
+
+    @staticmethod
+    def session() -> requests.Session:
+        """
+        Process wide session with a pool of keep-alive connections to the identity service. Created on first use.
+        :return: session
+        """
+        if WxHelper._session is None:
+            with WxHelper._session_lock:
+                if WxHelper._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=WxHelper.POOL_SIZE)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    WxHelper._session = session
+        return WxHelper._session
+
+    @staticmethod
+    def _request(method: str, path: str, **kwargs) -> dict:
+        r = WxHelper.session().request(method, f'{WxHelper.BASE_URL}{path}',
+                                       timeout=(WxHelper.CONNECT_TIMEOUT, WxHelper.READ_TIMEOUT), **kwargs)
+        r.raise_for_status()
+        return r.json()
 
     @staticmethod
     def auth_url(state: Optional[str] = None) -> str:
@@ -197,38 +424,51 @@ class WxHelper:
         return f'{WxHelper.BASE_URL}/v1/authorize?{qs}'
 
     @staticmethod
-    def get_tokens(code: str) -> dict:
-        data = dict(
+    def _code_data(code: str) -> dict:
+        return dict(
             grant_type='authorization_code',
             client_id=WxHelper.CLIENT_ID,
             client_secret=WxHelper.CLIENT_SECRET,
             code=code,
             redirect_uri=WxHelper.REDIRECT_URI
         )
-        r = post(f'{WxHelper.BASE_URL}/v1/access_token', data=data)
-        r.raise_for_status()
-        tokens = r.json()
-        return tokens
-
-    @staticmethod
-    def me(access_token: str) -> dict:
-        headers = {'Authorization': f'Bearer {access_token}'}
-        r = get(f'{WxHelper.BASE_URL}/v1/people/me', headers=headers)
-        r.raise_for_status()
-        return r.json()
 
     @staticmethod
-    def access_token(refresh_token: str):
-        data = dict(
+    def _refresh_data(refresh_token: str) -> dict:
+        return dict(
             grant_type='refresh_token',
             client_id=WxHelper.CLIENT_ID,
             client_secret=WxHelper.CLIENT_SECRET,
             refresh_token=refresh_token
         )
-        r = post(f'{WxHelper.BASE_URL}/v1/access_token', data=data)
-        r.raise_for_status()
-        tokens = r.json()
-        return tokens
+
+    @staticmethod
+    def get_tokens(code: str) -> dict:
+        return WxHelper._request('POST', '/v1/access_token', data=WxHelper._code_data(code))
+
+    @staticmethod
+    def me(access_token: str) -> dict:
+        user = WxHelper._me_cache.get(access_token)
+        if user is None:
+            headers = {'Authorization': f'Bearer {access_token}'}
+            user = WxHelper._request('GET', '/v1/people/me', headers=headers)
+            WxHelper._me_cache.put(access_token, user)
+        return user
+
+    @staticmethod
+    def access_token(refresh_token: str):
+        return WxHelper._request('POST', '/v1/access_token', data=WxHelper._refresh_data(refresh_token))
+
+    @staticmethod
+    def login(code: str) -> Tuple[dict, dict]:
+        """
+        Exchange an authorization code for tokens and get the details of the authenticated user. Both requests use
+        the same pooled connection.
+        :param code: authorization code
+        :return: tokens, user details
+        """
+        tokens = WxHelper.get_tokens(code)
+        return tokens, WxHelper.me(tokens['access_token'])
 
 
 def auth_required(f):
@@ -280,15 +520,14 @@ def redirect_url():
     assert state == session['state']
     session.pop('state')
 
-    # use code to obtain tokens
-    tokens = WxHelper.get_tokens(code)
+    # use code to obtain tokens and then use token to get user info. The blocking requests are executed in a native
+    # thread so that the eventlet hub can serve other clients in the meantime
+    tokens, user = tpool.execute(WxHelper.login, code)
     log.debug(f'redirect: sid={session.sid}, exchanged code for tokens: {tokens}')
 
     session['access_token'] = tokens['access_token']
     session['refresh_token'] = tokens['refresh_token']
 
-    # use token to get user info
-    user = WxHelper.me(tokens['access_token'])
     session['user'] = f'{user["displayName"]} ({user["emails"][0]})'
     session['user_id'] = user['id']
 
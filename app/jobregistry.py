@@ -0,0 +1,317 @@
+"""
+Registry of running jobs shared by all app processes.
+
+Each job is registered in Redis under its job id together with the id of the worker process running it. Stop
+requests are published on a channel; the worker owning the job stops it. Registrations expire unless the owning worker
+keeps refreshing them, so jobs of a crashed worker don't stay registered forever.
+
+Admission of jobs (see scheduler) is also tracked in Redis so that the concurrency limits hold across all app
+processes: admitted jobs are kept in a single hash and a Lua script checks the limits and admits a job atomically.
+Admitted jobs whose registration has expired are removed by the script.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from redis import Redis
+from redis.exceptions import ConnectionError, TimeoutError
+
+log = logging.getLogger(__name__)
+
+# identifies this app process
+WORKER_ID = f'{socket.gethostname()}-{os.getpid()}'
+
+
+# results of JobRegistry.admit()
+ADMITTED = 1
+LIMIT_REACHED = 0
+USER_LIMIT_REACHED = -1
+
+# KEYS[1]: hash of admitted jobs (job id -> user id)
+# ARGV: job id, user id, max running jobs, max running jobs per user, key prefix of job registrations
+ADMIT_SCRIPT = """
+local admitted = redis.call('HGETALL', KEYS[1])
+local running, running_of_user = 0, 0
+for i = 1, #admitted, 2 do
+    if redis.call('EXISTS', ARGV[5] .. admitted[i]) == 0 then
+        -- registration expired: the worker running the job is gone
+        redis.call('HDEL', KEYS[1], admitted[i])
+    else
+        running = running + 1
+        if admitted[i + 1] == ARGV[2] then
+            running_of_user = running_of_user + 1
+        end
+    end
+end
+if running >= tonumber(ARGV[3]) then
+    return 0
+end
+if running_of_user >= tonumber(ARGV[4]) then
+    return -1
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return 1
+"""
+
+
+class JobExists(Exception):
+    """
+    A job with the same id is already registered
+    """
+    pass
+
+
+class JobRegistry:
+    """
+    Cross-process job registry. W/o Redis connection jobs are only tracked locally by FlaskThread.
+    """
+    # Redis connection to register jobs
+    _redis: Redis = None
+
+    # registrations expire after this many seconds if not refreshed by the owning worker
+    TTL = 60
+    # interval in seconds between refreshes of the registrations of local jobs
+    HEARTBEAT_INTERVAL = 20
+    # channel stop requests are published on
+    STOP_CHANNEL = 'Job:stop'
+    # hash of the admitted jobs of all workers: job id -> user id
+    ADMITTED_KEY = 'Jobs:admitted'
+
+    # user ids by job id of jobs running in this process
+    _local: Dict[str, Optional[str]] = dict()
+    _lock = threading.Lock()
+    _listener: Optional[threading.Thread] = None
+    # called with the job id of a local job to stop
+    _stop: Optional[Callable[[str], None]] = None
+    _admit_script = None
+
+    @staticmethod
+    def set_redis(redis: Redis) -> None:
+        log.debug(f'Redis connection set: {redis}')
+        JobRegistry._redis = redis
+        JobRegistry._admit_script = redis.register_script(ADMIT_SCRIPT)
+        # start listening for stop requests
+        if JobRegistry._listener is None:
+            JobRegistry._listener = threading.Thread(target=JobRegistry._listen, name='job-registry', daemon=True)
+            JobRegistry._listener.start()
+
+    @staticmethod
+    def on_stop(stop: Callable[[str], None]) -> None:
+        """
+        Set the handler for stop requests of local jobs
+        :param stop: called with the job id of the job to stop
+        :return: None
+        """
+        JobRegistry._stop = stop
+
+    @staticmethod
+    def _redis_key(job_id: str) -> str:
+        return f'Job:{job_id}'
+
+    @staticmethod
+    def _user_key(user_id: str) -> str:
+        return f'Jobs:user:{user_id}'
+
+    @staticmethod
+    def _clients_key(job_id: str) -> str:
+        return f'Job:{job_id}:clients'
+
+    @staticmethod
+    def register(job_id: str, name: str, user_id: Optional[str] = None) -> None:
+        """
+        Register a job of this worker
+        :param job_id: job id
+        :param name: job name
+        :param user_id: user running the job
+        :return: None
+        :raises JobExists: if a job with the same id is already registered (by any worker)
+        """
+        if JobRegistry._redis is None:
+            return
+        job = json.dumps(dict(worker=WORKER_ID, name=name, user_id=user_id, started=time.time()))
+        if not JobRegistry._redis.set(JobRegistry._redis_key(job_id), job, nx=True, ex=JobRegistry.TTL):
+            raise JobExists(job_id)
+        if user_id is not None:
+            pipeline = JobRegistry._redis.pipeline(transaction=False)
+            pipeline.sadd(JobRegistry._user_key(user_id), job_id)
+            pipeline.expire(JobRegistry._user_key(user_id), JobRegistry.TTL)
+            pipeline.execute()
+        with JobRegistry._lock:
+            JobRegistry._local[job_id] = user_id
+        log.debug(f'register: {job_id} on {WORKER_ID}')
+
+    @staticmethod
+    def unregister(job_id: str, user_id: Optional[str] = None) -> None:
+        """
+        Remove the registration of a job of this worker
+        :param job_id: job id
+        :param user_id: user running the job
+        :return: None
+        """
+        if JobRegistry._redis is None:
+            return
+        with JobRegistry._lock:
+            JobRegistry._local.pop(job_id, None)
+        pipeline = JobRegistry._redis.pipeline(transaction=False)
+        pipeline.delete(JobRegistry._redis_key(job_id), JobRegistry._clients_key(job_id))
+        if user_id is not None:
+            pipeline.srem(JobRegistry._user_key(user_id), job_id)
+        pipeline.execute()
+        log.debug(f'unregister: {job_id} on {WORKER_ID}')
+
+    @staticmethod
+    def lookup(job_id: str) -> Optional[dict]:
+        """
+        Get the registration of a job
+        :param job_id: job id
+        :return: dict with worker, name, user_id, and started; None if no job is registered with that id
+        """
+        if JobRegistry._redis is None:
+            return None
+        job = JobRegistry._redis.get(JobRegistry._redis_key(job_id))
+        return job and json.loads(job)
+
+    @staticmethod
+    def jobs_of_user(user_id: str) -> List[str]:
+        """
+        Job ids of all registered jobs of a user
+        :param user_id: user id
+        :return: list of job ids
+        """
+        if JobRegistry._redis is None:
+            return []
+        job_ids = [job_id.decode() for job_id in JobRegistry._redis.smembers(JobRegistry._user_key(user_id))]
+        if not job_ids:
+            return job_ids
+        # the set might contain job ids of jobs which expired
+        pipeline = JobRegistry._redis.pipeline(transaction=False)
+        for job_id in job_ids:
+            pipeline.exists(JobRegistry._redis_key(job_id))
+        return [job_id for job_id, exists in zip(job_ids, pipeline.execute()) if exists]
+
+    @staticmethod
+    def admit(job_id: str, user_id: Optional[str], max_running: int, max_running_per_user: int) -> Optional[int]:
+        """
+        Admit a job if the number of admitted jobs of all workers and the number of admitted jobs of the user are
+        below the given limits
+        :param job_id: job id; the job needs to be registered
+        :param user_id: user running the job
+        :param max_running: max number of admitted jobs
+        :param max_running_per_user: max number of admitted jobs per user
+        :return: ADMITTED, LIMIT_REACHED, or USER_LIMIT_REACHED; None w/o Redis connection
+        """
+        if JobRegistry._redis is None:
+            return None
+        return JobRegistry._admit_script(keys=[JobRegistry.ADMITTED_KEY],
+                                         args=[job_id, user_id or '', max_running, max_running_per_user,
+                                               JobRegistry._redis_key('')])
+
+    @staticmethod
+    def release(job_id: str) -> None:
+        """
+        End the admission of a job
+        :param job_id: job id
+        :return: None
+        """
+        if JobRegistry._redis is None:
+            return
+        JobRegistry._redis.hdel(JobRegistry.ADMITTED_KEY, job_id)
+
+    @staticmethod
+    def attach(job_id: str, sid: str) -> None:
+        """
+        Record that a client (socket.io session) is attached to a job
+        :param job_id: job id
+        :param sid: session id of the client
+        :return: None
+        """
+        if JobRegistry._redis is None:
+            return
+        pipeline = JobRegistry._redis.pipeline(transaction=False)
+        pipeline.sadd(JobRegistry._clients_key(job_id), sid)
+        pipeline.expire(JobRegistry._clients_key(job_id), JobRegistry.TTL)
+        pipeline.execute()
+
+    @staticmethod
+    def detach(job_id: str, sid: str) -> None:
+        """
+        Record that a client is not attached to a job any more
+        :param job_id: job id
+        :param sid: session id of the client
+        :return: None
+        """
+        if JobRegistry._redis is None:
+            return
+        JobRegistry._redis.srem(JobRegistry._clients_key(job_id), sid)
+
+    @staticmethod
+    def clients(job_id: str) -> int:
+        """
+        Number of clients attached to a job
+        :param job_id: job id
+        :return: number of clients
+        """
+        if JobRegistry._redis is None:
+            return 0
+        return JobRegistry._redis.scard(JobRegistry._clients_key(job_id))
+
+    @staticmethod
+    def request_stop(job_id: str) -> None:
+        """
+        Ask the worker running a job to stop the job
+        :param job_id: job id
+        :return: None
+        """
+        if JobRegistry._redis is None:
+            return
+        log.debug(f'request_stop: {job_id}')
+        JobRegistry._redis.publish(JobRegistry.STOP_CHANNEL, job_id)
+
+    @staticmethod
+    def _heartbeat() -> None:
+        with JobRegistry._lock:
+            jobs = list(JobRegistry._local.items())
+        if not jobs:
+            return
+        pipeline = JobRegistry._redis.pipeline(transaction=False)
+        for job_id, user_id in jobs:
+            pipeline.expire(JobRegistry._redis_key(job_id), JobRegistry.TTL)
+            pipeline.expire(JobRegistry._clients_key(job_id), JobRegistry.TTL)
+            if user_id is not None:
+                pipeline.expire(JobRegistry._user_key(user_id), JobRegistry.TTL)
+        pipeline.execute()
+
+    @staticmethod
+    def _listen() -> None:
+        """
+        Listen for stop requests and refresh the registrations of local jobs
+        :return: None
+        """
+        while True:
+            try:
+                pubsub = JobRegistry._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(JobRegistry.STOP_CHANNEL)
+                next_heartbeat = time.monotonic()
+                while True:
+                    message = pubsub.get_message(timeout=max(next_heartbeat - time.monotonic(), 0))
+                    if message is not None:
+                        job_id = message['data'].decode()
+                        with JobRegistry._lock:
+                            local = job_id in JobRegistry._local
+                        if local and JobRegistry._stop is not None:
+                            log.debug(f'stop request for {job_id}')
+                            JobRegistry._stop(job_id)
+                    if time.monotonic() >= next_heartbeat:
+                        JobRegistry._heartbeat()
+                        next_heartbeat = time.monotonic() + JobRegistry.HEARTBEAT_INTERVAL
+            except (ConnectionError, TimeoutError) as e:
+                log.warning(f'lost connection to Redis: {e}')
+                time.sleep(JobRegistry.HEARTBEAT_INTERVAL / 4)
+            except Exception as e:
+                # w/o this thread stop requests are ignored and registrations of local jobs expire
+                log.exception(f'listener failed: {e}')
+                time.sleep(JobRegistry.HEARTBEAT_INTERVAL / 4)
@@ -2,15 +2,24 @@ import logging
 import sys
 from datetime import timedelta
 import asyncio
-from typing import Callable, Tuple
+from typing import Callable, Optional, Tuple
 
 import webexteamssdk
 
+from . import channel
+from . import spacestats
+from .spacestats import SpaceStats
+from .statscache import CacheEntry, StatsCache
 from .webexteamsasyncapi import WebexTeamsAsyncAPI
 from .interactive import Token
 
 log = logging.getLogger(__name__)
 
+# count all messages in each space; if False then only earliest and latest message are determined
+COUNT_MESSAGES = True
+# updated stats are written to the cache in batches of this size
+CACHE_FLUSH_SIZE = 50
+
 
 class MyException(Exception):
     pass
@@ -18,55 +27,96 @@ class MyException(Exception):
 
 async def space_stats(api: WebexTeamsAsyncAPI,
                       space: webexteamssdk.Room,
-                      running: Callable[[], bool]) -> Tuple[webexteamssdk.Room, dict]:
-    # try to count all messages in the space
-    message_count = 0
-    earliest = '9'
-    latest = '0'
-    async for message in api.list_messages(p_roomId=space.id, p_max=500):
-        message_count += 1
-        if not running():
-            return space, None
-        earliest = min(earliest, str(message.created))
-        latest = max(latest, str(message.created))
-    result = dict(
-        message_count=message_count,
-        earliest=earliest,
-        latest=latest
-    )
-    return space, result
-
-
-async def as_list_spaces(access_token: str, running: Callable[[], bool]):
-    api = WebexTeamsAsyncAPI(access_token)
+                      running: Callable[[], bool],
+                      cached: Optional[CacheEntry] = None) -> Tuple[webexteamssdk.Room, Optional[SpaceStats]]:
+    if not COUNT_MESSAGES:
+        # only earliest and latest message are needed
+        stats = await spacestats.message_bounds(api, room_id=space.id, room_created=str(space.created),
+                                                running=running)
+        return space, stats
+
+    if cached is not None and cached.last_activity == str(space.lastActivity):
+        # no activity in the space since the stats have been cached
+        return space, cached.stats
+
+    def progress(stats: SpaceStats) -> None:
+        # partial result for spaces with more than one page of messages
+        if stats.pages > 1:
+            channel.metric('counting messages', f'{space.title}: {stats.message_count} so far')
+
+    if cached is None:
+        # try to count all messages in the space
+        stats = await spacestats.count_messages(api, room_id=space.id, running=running, on_page=progress)
+    else:
+        # only read messages newer than the cached stats
+        stats = await spacestats.refresh_messages(api, cached=cached.stats, running=running, on_page=progress)
+    return space, stats
+
+
+async def as_list_spaces(access_token: str, running: Callable[[], bool], cache: Optional[StatsCache] = None):
+    async with WebexTeamsAsyncAPI(access_token) as api:
+        await list_spaces_with_stats(api, running, cache)
+
+
+async def list_spaces_with_stats(api: WebexTeamsAsyncAPI, running: Callable[[], bool],
+                                 cache: Optional[StatsCache] = None):
+    # stats cached by previous runs
+    if cache is not None and COUNT_MESSAGES:
+        cached = await asyncio.to_thread(cache.load)
+    else:
+        cache = None
+        cached = dict()
+
     # async for space in api.list_spaces(max=100):
     tasks = []
+    listed = set()
     async for space in api.list_spaces(p_max=100):
         if not running():
             break
-        print(f'{space.title}, {space.lastActivity}')
+        listed.add(space.id)
         # also schedule task to get space stats
-        tasks.append(asyncio.create_task(space_stats(api, space, running)))
+        tasks.append(asyncio.create_task(space_stats(api, space, running, cached.get(space.id))))
+        channel.metric('spaces', len(tasks))
+    else:
+        if cache is not None and running():
+            # complete listing: cached entries of spaces which have not been listed are gone for good
+            await asyncio.to_thread(cache.prune, cached.keys() - listed)
 
     try:
         if not running():
             raise MyException
-        for task_done in asyncio.as_completed(tasks):
+        messages = 0
+        channel.progress(0, len(tasks), label='spaces')
+        for done, task_done in enumerate(asyncio.as_completed(tasks), 1):
             if not running():
                 raise MyException
-            space, data = await task_done
+            space, stats = await task_done
             space: webexteamssdk.Room
-            print(f'space stats for {space.title} done: {data}')
+            row = dict(title=space.title, last_activity=str(space.lastActivity))
+            if stats is not None:
+                row.update(stats.as_dict())
+                messages += stats.message_count or 0
+            channel.row(row, table='spaces')
+            channel.progress(done, len(tasks), label='spaces')
+            channel.metric('messages', messages)
+            entry = cached.get(space.id)
+            if cache is not None and stats is not None and (entry is None or entry.stats is not stats):
+                cache.update(stats, last_activity=str(space.lastActivity))
+                if len(cache.updates) >= CACHE_FLUSH_SIZE:
+                    await asyncio.to_thread(cache.flush)
 
     except MyException:
         pass
     finally:
         for task in tasks:
             task.cancel()
+        if cache is not None:
+            # write whatever has been computed; even if stopped
+            await asyncio.to_thread(cache.flush)
     return
 
 
-def list_spaces(sid: str, running: Callable[[], bool], user_id: str):
+async def list_spaces(job_id: str, running: Callable[[], bool], user_id: str):
     # add a logging handler to stdout; logging output will be sent to the client via websocket
     format = logging.Formatter(fmt='{levelname:8s} list_spaces: {message}', style='{')
     handler = logging.StreamHandler(stream=sys.stdout)
@@ -75,11 +125,11 @@ def list_spaces(sid: str, running: Callable[[], bool], user_id: str):
     log.addHandler(handler)
 
     try:
-        log.debug(f'user_id={user_id}, sid={sid}')
+        log.debug(f'user_id={user_id}, job_id={job_id}')
 
         # First get an access token
         log.debug(f'trying to get access token')
-        access_token = Token.get_token(user_id=user_id)
+        access_token = await Token.aget_token(user_id=user_id)
         if access_token is None:
             log.error(f'Failed to get access token for {user_id}')
             raise MyException
@@ -89,13 +139,13 @@ def list_spaces(sid: str, running: Callable[[], bool], user_id: str):
 
         # need to make sure that the access token is good for another 10 minutes
         if lifetime_remaining.total_seconds() < 600:
-            access_token.refresh()
+            await access_token.arefresh()
             log.debug(
                 f'had to refresh access token. New lifetime: '
                 f'{timedelta(seconds=access_token.lifetime_remaining_seconds)}')
 
         # run asynchronous task
-        asyncio.run(as_list_spaces(access_token.access_token, running))
+        await as_list_spaces(access_token.access_token, running, cache=StatsCache(user_id))
         return
 
     except MyException:
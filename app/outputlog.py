@@ -0,0 +1,91 @@
+"""
+Durable output of jobs.
+
+Each batch of output emitted by a job is also appended to a capped Redis stream of the job. The stream entry id is the
+offset of the batch: a client reconnecting to a job replays all batches after the last offset it has seen and then
+continues with the live batches. Streams expire some time after the job has terminated.
+"""
+import json
+import logging
+from typing import Iterator, Optional, Tuple
+
+from redis import Redis
+
+log = logging.getLogger(__name__)
+
+# offset before the first batch of a stream
+START = '0'
+
+
+class OutputLog:
+    """
+    Output streams of jobs. W/o Redis connection output is not persisted and can't be replayed.
+    """
+    # Redis connection to persist output
+    _redis: Redis = None
+
+    # max number of batches kept per job; older batches are trimmed
+    MAX_BATCHES = 10000
+    # output of a terminated job can be replayed for this many seconds
+    TTL = 3600
+    # streams of running jobs expire this many seconds after the last append; streams of jobs of crashed processes
+    # (which never got finished) don't stay around forever
+    RUNNING_TTL = 24 * 3600
+    # number of batches read from Redis per round trip during replay
+    REPLAY_COUNT = 100
+
+    @staticmethod
+    def set_redis(redis: Redis) -> None:
+        log.debug(f'Redis connection set: {redis}')
+        OutputLog._redis = redis
+
+    @staticmethod
+    def _redis_key(job_id: str) -> str:
+        return f'Job:{job_id}:output'
+
+    @staticmethod
+    def append(job_id: str, batch: dict) -> Optional[str]:
+        """
+        Append a batch to the output stream of a job
+        :param job_id: job id
+        :param batch: batch; needs to be JSON serializable
+        :return: offset of the batch; None if output is not persisted
+        """
+        if OutputLog._redis is None:
+            return None
+        key = OutputLog._redis_key(job_id)
+        pipeline = OutputLog._redis.pipeline(transaction=False)
+        pipeline.xadd(key, {'batch': json.dumps(batch)}, maxlen=OutputLog.MAX_BATCHES, approximate=True)
+        pipeline.expire(key, OutputLog.RUNNING_TTL)
+        offset, _ = pipeline.execute()
+        return offset.decode()
+
+    @staticmethod
+    def finish(job_id: str) -> None:
+        """
+        Job has terminated; the output stream expires after TTL
+        :param job_id: job id
+        :return: None
+        """
+        if OutputLog._redis is None:
+            return
+        OutputLog._redis.expire(OutputLog._redis_key(job_id), OutputLog.TTL)
+
+    @staticmethod
+    def replay(job_id: str, after: str = START) -> Iterator[Tuple[str, dict]]:
+        """
+        Read the batches of a job following a given offset
+        :param job_id: job id
+        :param after: offset of the last batch seen
+        :return: (offset, batch) tuples
+        """
+        if OutputLog._redis is None:
+            return
+        key = OutputLog._redis_key(job_id)
+        while True:
+            entries = OutputLog._redis.xrange(key, min=f'({after}', count=OutputLog.REPLAY_COUNT)
+            for offset, fields in entries:
+                after = offset.decode()
+                yield after, json.loads(fields[b'batch'])
+            if len(entries) < OutputLog.REPLAY_COUNT:
+                break
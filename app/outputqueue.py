@@ -0,0 +1,374 @@
+"""
+Bounded per session output queue between the code running in a FlaskThread and the pipe to the pipe processor
+greenlet.
+
+Writing to the queue never blocks on the pipe: frames are sent to the pipe w/o blocking as long as the pipe accepts
+data. Frames which can't be sent immediately stay in the queue and are sent by a single process wide pump thread as
+soon as the pipe becomes writable again. If the queue is full (slow or backgrounded browser) the overflow policy of
+the queue decides what happens:
+* block: the writer blocks until there is space in the queue again. Only for targets running on a thread of their
+  own (benchmarks): coroutine targets share an executor loop with other jobs which a blocked writer would stall
+* drop_oldest: the oldest queued lines are dropped and replaced by a single "N lines skipped" marker. Structured
+  events are only dropped if there are no lines left to drop; the end frame is never dropped
+* spill: new frames are written to a temporary file and are moved back to the queue once it has drained
+"""
+import logging
+import selectors
+import socket
+import tempfile
+import threading
+import weakref
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional
+
+from . import framing
+
+log = logging.getLogger(__name__)
+
+POLICY_BLOCK = 'block'
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_SPILL = 'spill'
+POLICIES = (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_SPILL)
+
+# all live queues; used to collect metrics
+_queues: 'weakref.WeakSet[OutputQueue]' = weakref.WeakSet()
+
+
+class OutputQueue:
+    """
+    Bounded queue of frames to be sent to a pipe
+    """
+    # max number of bytes passed to a single send() call
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, pipe: socket.socket, max_lines: int, policy: str = POLICY_DROP_OLDEST,
+                 name: Optional[str] = None):
+        """
+
+        :param pipe: pipe to send frames to. The queue takes ownership of the pipe and closes the pipe after the
+        queue has been closed and all frames have been sent
+        :param max_lines: max number of frames held in memory
+        :param policy: overflow policy; one of POLICIES
+        :param name: name of the queue; used for logging and metrics
+        """
+        assert policy in POLICIES, f'unknown overflow policy: {policy}'
+        self.pipe = pipe
+        self.pipe.setblocking(False)
+        self.max_lines = max_lines
+        self.policy = policy
+        self.name = name or f'{id(self):x}'
+        self.lock = threading.Condition()
+        self.frames: Deque[bytes] = deque()
+        # remaining data of a partially sent chunk
+        self.sending = memoryview(b'')
+        # queue has been closed: no more frames will be put
+        self.closing = False
+        # the other end of the pipe is gone: everything put to the queue is discarded
+        self.broken = False
+        # lines and events dropped since the last "lines skipped" marker
+        self.skipped = 0
+        self.skipped_events = 0
+        # spill file and read/write position in spill file
+        self.spill_file = None
+        self.spill_read = 0
+        self.spill_write = 0
+        # number of frames in spill file
+        self.spill_pending = 0
+
+        # metrics
+        self.max_depth = 0
+        self.sent_frames = 0
+        self.dropped_lines = 0
+        self.dropped_events = 0
+        self.spilled_lines = 0
+        _queues.add(self)
+
+    @property
+    def depth(self) -> int:
+        """
+        Number of frames waiting to be sent (in memory and spilled to disk)
+        """
+        return len(self.frames) + self.spill_pending
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Queue metrics
+        :return: dict of metrics
+        """
+        with self.lock:
+            return dict(depth=self.depth, max_depth=self.max_depth, sent=self.sent_frames,
+                        dropped=self.dropped_lines, dropped_events=self.dropped_events, spilled=self.spilled_lines)
+
+    def put(self, frames: Iterable[bytes]) -> None:
+        """
+        Queue frames to be sent and try to send them right away
+        :param frames: encoded frames
+        :return: None
+        """
+        with self.lock:
+            if self.broken:
+                return
+            for frame in frames:
+                if self.spill_pending:
+                    # as long as there are spilled frames new frames need to go to the spill file as well to keep
+                    # the order
+                    self._spill(frame)
+                    continue
+                if len(self.frames) >= self.max_lines:
+                    if self.policy == POLICY_BLOCK:
+                        # wait for the pump to make room
+                        while len(self.frames) >= self.max_lines and not self.broken:
+                            if self._flush():
+                                break
+                            self.lock.wait()
+                        if self.broken:
+                            return
+                    elif self.policy == POLICY_DROP_OLDEST:
+                        if not (self.dropped_lines or self.dropped_events):
+                            log.warning(f'{self}: queue full, dropping oldest lines')
+                        if not self._drop_oldest(framing.FRAME_LINE):
+                            if frame[0] == framing.FRAME_LINE:
+                                # no older lines to drop: drop the new line
+                                self.skipped += 1
+                                self.dropped_lines += 1
+                                continue
+                            self._drop_oldest(framing.FRAME_EVENT)
+                    else:
+                        self._spill(frame)
+                        continue
+                self.frames.append(frame)
+            self.max_depth = max(self.max_depth, self.depth)
+            self._flush()
+
+    def _drop_oldest(self, frame_type: int) -> bool:
+        """
+        Drop the oldest queued frame of a given type. Needs to be called with the lock held
+        :param frame_type: FRAME_LINE or FRAME_EVENT
+        :return: True if a frame has been dropped
+        """
+        for i, frame in enumerate(self.frames):
+            if frame[0] == frame_type:
+                del self.frames[i]
+                if frame_type == framing.FRAME_LINE:
+                    self.skipped += 1
+                    self.dropped_lines += 1
+                else:
+                    self.skipped_events += 1
+                    self.dropped_events += 1
+                return True
+        return False
+
+    def close(self, end_frame: bytes = framing.END_FRAME) -> None:
+        """
+        Queue the end frame and close the queue. Returns immediately; the pump closes the pipe once all frames have
+        been sent.
+        :param end_frame: last frame to send
+        :return: None
+        """
+        with self.lock:
+            if self.spill_pending:
+                self._spill(end_frame)
+            else:
+                # the end frame is queued even if the queue is full
+                self.frames.append(end_frame)
+            self.closing = True
+        _pump().register(self)
+
+    def _spill(self, frame: bytes) -> None:
+        """
+        Append a frame to the spill file
+        """
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(prefix='flask-realtime-')
+            log.warning(f'{self}: queue full, spilling to disk')
+        self.spill_file.seek(self.spill_write)
+        self.spill_file.write(frame)
+        self.spill_write += len(frame)
+        self.spill_pending += 1
+        self.spilled_lines += 1
+
+    def _unspill(self) -> None:
+        """
+        Move spilled frames back to the in memory queue
+        """
+        f = self.spill_file
+        f.seek(self.spill_read)
+        while self.spill_pending and len(self.frames) < self.max_lines:
+            header = f.read(framing.HEADER.size)
+            _, length = framing.HEADER.unpack(header)
+            frame = header + f.read(length)
+            self.frames.append(frame)
+            self.spill_read += len(frame)
+            self.spill_pending -= 1
+        if not self.spill_pending:
+            # spill file completely read: start over
+            f.seek(0)
+            f.truncate()
+            self.spill_read = self.spill_write = 0
+
+    def _next_chunk(self) -> bytes:
+        """
+        Take frames from the queue to be sent with the next send()
+        :return: concatenated frames; empty if the queue is empty
+        """
+        if self.spill_pending and len(self.frames) < self.max_lines:
+            self._unspill()
+        chunk: List[bytes] = []
+        if self.skipped or self.skipped_events:
+            skipped = f'{self.skipped} lines'
+            if self.skipped_events:
+                skipped = f'{skipped} and {self.skipped_events} events'
+            chunk.append(framing.encode_line(f'... {skipped} skipped ...'))
+            self.skipped = self.skipped_events = 0
+        size = 0
+        frames = self.frames
+        while frames and size < self.CHUNK_SIZE:
+            frame = frames.popleft()
+            chunk.append(frame)
+            size += len(frame)
+        self.sent_frames += len(chunk)
+        if self.spill_pending and len(frames) < self.max_lines:
+            self._unspill()
+        # writers might be waiting for space in the queue
+        self.lock.notify_all()
+        return b''.join(chunk)
+
+    def _flush(self) -> bool:
+        """
+        Send as much as possible to the pipe w/o blocking. Needs to be called with the lock held. If not everything
+        can be sent then the queue is registered with the pump.
+        :return: True if the queue has been drained completely
+        """
+        while True:
+            if not self.sending:
+                chunk = self._next_chunk()
+                if not chunk:
+                    return True
+                self.sending = memoryview(chunk)
+            try:
+                sent = self.pipe.send(self.sending)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                # other end is gone; nobody will ever read what we have
+                log.warning(f'{self}: pipe broken: {e}')
+                self.broken = True
+                self.frames.clear()
+                self.sending = memoryview(b'')
+                self.spill_pending = 0
+                self.lock.notify_all()
+                return True
+            self.sending = self.sending[sent:]
+        # pipe is full: the pump continues as soon as the pipe becomes writable again
+        _pump().register(self)
+        return False
+
+    def pump(self) -> bool:
+        """
+        Called by the pump if the pipe is writable.
+        :return: True if the pump doesn't need to care for the queue any longer
+        """
+        with self.lock:
+            return self._flush()
+
+    def release(self) -> None:
+        """
+        Called by the pump after the queue has been unregistered. Closes the pipe if the queue has been closed and
+        all frames have been sent
+        """
+        with self.lock:
+            if self.closing and not (self.frames or self.sending or self.spill_pending):
+                log.debug(f'{self}: closed, {self.stats()}')
+                self.pipe.close()
+                if self.spill_file is not None:
+                    self.spill_file.close()
+                    self.spill_file = None
+
+    def __repr__(self):
+        return f'OutputQueue({self.name})'
+
+
+def queue_stats() -> Dict[str, Dict[str, int]]:
+    """
+    Metrics of all live output queues
+    :return: dict of metrics by queue name
+    """
+    return {q.name: q.stats() for q in list(_queues)}
+
+
+class OutputPump(threading.Thread):
+    """
+    Single daemon thread sending queued frames to all pipes which didn't accept data w/o blocking
+    """
+
+    def __init__(self):
+        super().__init__(name='output-pump', daemon=True)
+        self.selector = selectors.DefaultSelector()
+        # used to wake up the pump when new queues get registered
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        self.lock = threading.Lock()
+        self.pending: List[OutputQueue] = []
+
+    def register(self, queue: OutputQueue) -> None:
+        """
+        Make sure that the pump takes care of a queue
+        :param queue: queue
+        :return: None
+        """
+        with self.lock:
+            self.pending.append(queue)
+        try:
+            self.wakeup_w.send(b'\x00')
+        except BlockingIOError:
+            # pump has not yet read previous wakeups
+            pass
+
+    def run(self) -> None:
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj is self.wakeup_r:
+                    try:
+                        while self.wakeup_r.recv(1024):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                queue: OutputQueue = key.data
+                if queue.pump():
+                    self.selector.unregister(key.fileobj)
+                    queue.release()
+            with self.lock:
+                pending, self.pending = self.pending, []
+            for queue in pending:
+                if queue.pump():
+                    try:
+                        self.selector.unregister(queue.pipe)
+                    except (KeyError, ValueError):
+                        pass
+                    queue.release()
+                else:
+                    try:
+                        self.selector.register(queue.pipe, selectors.EVENT_WRITE, queue)
+                    except KeyError:
+                        # already registered
+                        pass
+
+
+_pump_instance: Optional[OutputPump] = None
+_pump_lock = threading.Lock()
+
+
+def _pump() -> OutputPump:
+    """
+    Get the process wide pump; the pump thread is started on first use
+    """
+    global _pump_instance
+    if _pump_instance is None:
+        with _pump_lock:
+            if _pump_instance is None:
+                _pump_instance = OutputPump()
+                _pump_instance.start()
+    return _pump_instance
@@ -0,0 +1,198 @@
+"""
+Snapshot of the people directory of an org in Redis.
+
+The snapshot is a compact Redis hash per org: field is the person id, value is the display name. It is shared by all
+jobs (of all users) in the same org and refreshed by at most one job at a time (Redis lock) once it is older than
+MAX_AGE. A refresh streams the directory page by page into a new hash which then atomically replaces the snapshot;
+neither refresh nor sampling ever holds more than a page (resp. the sample) in memory. While a stale snapshot is
+being refreshed readers keep using the stale snapshot.
+
+Random people are drawn from the snapshot by reservoir sampling over HSCAN.
+"""
+import asyncio
+import logging
+import random
+import time
+from typing import Callable, Container, List, Optional
+
+from redis import Redis
+from redis.exceptions import LockError, RedisError
+
+from . import redisclient
+from .webexteamsasyncapi import WebexTeamsAsyncAPI, record_factory, record_type
+
+log = logging.getLogger(__name__)
+
+# compact person record held in the snapshot
+PERSON_FIELDS = ('id', 'displayName')
+Person = record_type('Person', PERSON_FIELDS)
+
+
+class PeopleDirectory:
+    """
+    People directory snapshot of an org
+    """
+    # Redis connection to save the snapshot
+    _redis: Redis = None
+
+    # snapshot gets refreshed once it is older than this many seconds
+    MAX_AGE = 24 * 3600
+    # snapshot expires if not refreshed for this many seconds
+    TTL = 7 * 24 * 3600
+    # the refresh lock expires after this many seconds in case the lock holder dies
+    LOCK_TIMEOUT = 600
+    # number of people per page when reading the directory (max supported by the API)
+    PAGE_SIZE = 1000
+    # number of fields per HSCAN round trip when sampling
+    SCAN_COUNT = 1000
+
+    @staticmethod
+    def set_redis(redis: Redis) -> None:
+        log.debug(f'Redis connection set: {redis}')
+        PeopleDirectory._redis = redis
+
+    def __init__(self, org_id: str):
+        assert PeopleDirectory._redis is not None
+        self.org_id = org_id
+
+    @property
+    def redis_key(self) -> str:
+        return f'People:{self.org_id}'
+
+    @property
+    def next_key(self) -> str:
+        """
+        Key of the snapshot being built by a refresh
+        """
+        return f'People:{self.org_id}:next'
+
+    @property
+    def meta_key(self) -> str:
+        return f'People:{self.org_id}:meta'
+
+    @property
+    def lock_key(self) -> str:
+        return f'People:{self.org_id}:refresh-lock'
+
+    @property
+    def client(self):
+        return redisclient.async_client(PeopleDirectory._redis)
+
+    async def age(self) -> Optional[float]:
+        """
+        Age of the snapshot
+        :return: age in seconds; None if there is no snapshot
+        """
+        refreshed = await self.client.hget(self.meta_key, 'refreshed')
+        if refreshed is None:
+            return None
+        return time.time() - float(refreshed)
+
+    async def count(self) -> int:
+        """
+        Number of people in the snapshot
+        """
+        return await self.client.hlen(self.redis_key)
+
+    async def refresh(self, api: WebexTeamsAsyncAPI, running: Optional[Callable[[], bool]] = None,
+                      max_people: Optional[int] = None, wait: bool = False) -> bool:
+        """
+        Refresh the snapshot from the directory unless the snapshot is fresh or another refresh is in progress
+        :param api: API to read the directory
+        :param running: refresh is abandoned (snapshot not replaced) as soon as this returns False
+        :param max_people: only read the first max_people people of the directory
+        :param wait: wait for a refresh in progress instead of returning right away
+        :return: True if the snapshot has been replaced
+        """
+        running = running or (lambda: True)
+        client = self.client
+        lock = client.lock(self.lock_key, timeout=self.LOCK_TIMEOUT)
+        if not await lock.acquire(blocking=wait, blocking_timeout=self.LOCK_TIMEOUT):
+            log.debug(f'refresh: {self.redis_key}: refresh in progress')
+            return False
+        try:
+            # the snapshot might just have been refreshed by the previous lock holder
+            age = await self.age()
+            if age is not None and age < self.MAX_AGE:
+                return False
+            started = time.monotonic()
+            await client.delete(self.next_key)
+            count = 0
+            pages = api.pages(api.people_endpoint, params=dict(max=self.PAGE_SIZE),
+                              factory=record_factory('Person', PERSON_FIELDS), read_ahead=1, running=running)
+            try:
+                async for page in pages:
+                    if max_people is not None:
+                        page = page[:max_people - count]
+                    if page:
+                        pipeline = client.pipeline(transaction=False)
+                        pipeline.hset(self.next_key, mapping={p.id: p.displayName or '' for p in page})
+                        # a partial snapshot of an abandoned refresh doesn't stay around
+                        pipeline.expire(self.next_key, self.LOCK_TIMEOUT)
+                        await pipeline.execute()
+                        count += len(page)
+                    if max_people is not None and count >= max_people:
+                        break
+            finally:
+                await pages.aclose()
+            if not running():
+                log.debug(f'refresh: {self.redis_key}: abandoned after {count} people')
+                return False
+            pipeline = client.pipeline(transaction=True)
+            if count:
+                pipeline.rename(self.next_key, self.redis_key)
+                pipeline.expire(self.redis_key, self.TTL)
+            else:
+                pipeline.delete(self.redis_key)
+            pipeline.hset(self.meta_key, mapping=dict(refreshed=time.time(), count=count))
+            pipeline.expire(self.meta_key, self.TTL)
+            await pipeline.execute()
+            log.debug(f'refresh: {self.redis_key}: {count} people in {time.monotonic() - started:.1f}s')
+            return True
+        finally:
+            try:
+                await lock.release()
+            except (LockError, RedisError) as e:
+                log.warning(f'refresh: {self.redis_key}: failed to release lock: {e}')
+
+    async def ensure(self, api: WebexTeamsAsyncAPI, running: Optional[Callable[[], bool]] = None,
+                     max_people: Optional[int] = None) -> Optional[asyncio.Task]:
+        """
+        Make sure that a snapshot is available. W/o snapshot the snapshot is created (or a refresh in progress is
+        waited for); a stale snapshot is refreshed in the background.
+        :param api: API to read the directory
+        :param running: see refresh()
+        :param max_people: see refresh()
+        :return: task refreshing a stale snapshot; None if the snapshot was fresh or had to be created
+        """
+        age = await self.age()
+        if age is None:
+            await self.refresh(api, running=running, max_people=max_people, wait=True)
+            return None
+        if age < self.MAX_AGE:
+            return None
+        log.debug(f'ensure: {self.redis_key}: snapshot is {age:.0f}s old, refreshing in the background')
+        return asyncio.create_task(self.refresh(api, running=running, max_people=max_people))
+
+    async def sample(self, n: int, exclude: Container[str] = ()) -> List[Person]:
+        """
+        Draw random people from the snapshot w/o loading the whole snapshot
+        :param n: number of people to draw
+        :param exclude: ids of people not to draw
+        :return: up to n people in random order
+        """
+        reservoir: List[Person] = []
+        seen = 0
+        async for person_id, display_name in self.client.hscan_iter(self.redis_key, count=self.SCAN_COUNT):
+            person_id = person_id.decode()
+            if person_id in exclude:
+                continue
+            seen += 1
+            if len(reservoir) < n:
+                reservoir.append(Person(person_id, display_name.decode()))
+                continue
+            i = random.randrange(seen)
+            if i < n:
+                reservoir[i] = Person(person_id, display_name.decode())
+        random.shuffle(reservoir)
+        return reservoir
@@ -0,0 +1,248 @@
+"""
+Bulk provisioning of space memberships.
+
+Adding people to a space is a pipeline of two stages connected by bounded queues: the membership stage adds each
+person to the space, the message stage then posts a message for each new member. Each stage has a fixed pool of
+workers so that the number of concurrent requests is bounded independently of the number of people. Items are
+independent: a failed item is retried a few times (transient errors only) and then recorded as failed w/o affecting
+other items. People who already are members of the space are skipped.
+"""
+import asyncio
+import logging
+import time
+from collections import Counter
+from typing import Callable, Container, Coroutine, Dict, Iterable, List, Optional, Set
+
+import aiohttp
+
+from . import channel
+from .webexteamsasyncapi import WebexTeamsAsyncAPI
+
+log = logging.getLogger(__name__)
+
+# item states
+CREATED = 'created'
+EXISTING = 'existing'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+async def with_retries(coro_factory: Callable[[], 'asyncio.Future'], attempts: int, delay: float,
+                       retry_status: Container[int], on_retry: Optional[Callable[[], None]] = None):
+    """
+    Execute a request with retries on transient errors: connection errors, timeouts, and the given status codes
+    :param coro_factory: creates the coroutine executing the request
+    :param attempts: max number of attempts
+    :param delay: delay in seconds before the 1st retry; doubled for each further retry
+    :param retry_status: status codes worth retrying
+    :param on_retry: called before each retry
+    :return: result of the request
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return await coro_factory()
+        except aiohttp.ClientResponseError as e:
+            if e.status not in retry_status or attempt == attempts:
+                raise
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == attempts:
+                raise
+        if on_retry is not None:
+            on_retry()
+        await asyncio.sleep(delay)
+        delay *= 2
+
+
+async def run_stages(producer: Coroutine, workers: List[asyncio.Task]) -> None:
+    """
+    Run the producer of a pipeline until the producer and all workers have terminated. If any of them fails then
+    all others are cancelled and the exception is raised: a dead worker pool can't leave the producer blocked on a
+    full queue.
+    :param producer: coroutine feeding the queues of the workers; expected to terminate the workers
+    :param workers: worker tasks
+    :return: None
+    """
+    tasks = [asyncio.create_task(producer), *workers]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class ProvisioningSummary:
+    """
+    Results of a provisioning run
+    """
+
+    def __init__(self):
+        # number of items by stage and state
+        self.memberships: Counter = Counter()
+        self.messages: Counter = Counter()
+        self.retries = 0
+        # error message by person id
+        self.errors: Dict[str, str] = dict()
+        self.started = time.monotonic()
+        self.duration = 0.0
+
+    def as_dict(self) -> dict:
+        return dict(memberships=dict(self.memberships), messages=dict(self.messages), retries=self.retries,
+                    errors=len(self.errors), duration=round(self.duration, 3),
+                    memberships_per_second=round(self.memberships[CREATED] / self.duration, 1) if self.duration else 0)
+
+    def __repr__(self):
+        return f'ProvisioningSummary({self.as_dict()})'
+
+
+class Provisioner:
+    """
+    Add people to spaces and post a message for each new member
+    """
+    # number of workers adding memberships
+    MEMBERSHIP_WORKERS = 10
+    # number of workers posting messages
+    MESSAGE_WORKERS = 5
+    # max number of attempts per request
+    ATTEMPTS = 3
+    # delay in seconds before the 1st retry; doubled for each further retry
+    RETRY_DELAY = 1.0
+    # status codes of transient errors which are worth retrying. 429 and 502 are retried by the API already
+    RETRY_STATUS = {500, 503, 504}
+
+    def __init__(self, api: WebexTeamsAsyncAPI, running: Optional[Callable[[], bool]] = None,
+                 membership_workers: int = MEMBERSHIP_WORKERS, message_workers: int = MESSAGE_WORKERS):
+        """
+
+        :param api: API to use
+        :param running: provisioning stops taking new items as soon as this returns False
+        :param membership_workers: number of workers adding memberships
+        :param message_workers: number of workers posting messages
+        """
+        self.api = api
+        self.running = running or (lambda: True)
+        self.membership_workers = membership_workers
+        self.message_workers = message_workers
+
+    async def _attempt(self, summary: ProvisioningSummary, coro_factory: Callable[[], 'asyncio.Future'],
+                       idempotent: bool = True):
+        """
+        Execute a request with retries on transient errors
+        :param summary: summary to update
+        :param coro_factory: creates the coroutine executing the request
+        :param idempotent: request can safely be repeated; else the request is not retried at all
+        :return: result of the request
+        """
+        if not idempotent:
+            # a failed request might have been executed anyway (e.g. 504 from a gateway, timeout): a retry could
+            # execute it twice
+            return await coro_factory()
+
+        def on_retry() -> None:
+            summary.retries += 1
+
+        return await with_retries(coro_factory, attempts=self.ATTEMPTS, delay=self.RETRY_DELAY,
+                                  retry_status=self.RETRY_STATUS, on_retry=on_retry)
+
+    async def existing_members(self, space_id: str) -> Set[str]:
+        """
+        Person ids of the current members of a space
+        :param space_id: space id
+        :return: set of person ids
+        """
+        return {m.personId async for m in self.api.list_memberships(p_roomId=space_id, p_max=1000,
+                                                                      fields=('personId',))}
+
+    async def provision(self, space_id: str, people: Iterable, message: Optional[Callable[[object], str]] = None,
+                        label: str = 'memberships') -> ProvisioningSummary:
+        """
+        Add people to a space
+        :param space_id: space id
+        :param people: people to add; objects with id and displayName attributes
+        :param message: creates the text of the message posted for each new member; no messages if None
+        :param label: label of the progress reported on the job channel
+        :return: summary
+        """
+        summary = ProvisioningSummary()
+        people = list(people)
+        existing = await self.existing_members(space_id)
+        total = len(people)
+        done = 0
+        memberships: asyncio.Queue = asyncio.Queue(maxsize=2 * self.membership_workers)
+        messages: asyncio.Queue = asyncio.Queue(maxsize=2 * self.message_workers)
+
+        def item_done() -> None:
+            nonlocal done
+            done += 1
+            channel.progress(done, total, label=label)
+
+        async def membership_worker() -> None:
+            while (person := await memberships.get()) is not None:
+                if not self.running():
+                    summary.memberships[SKIPPED] += 1
+                    item_done()
+                    continue
+                try:
+                    # repeating the request is safe: a duplicate membership fails with 409
+                    await self._attempt(summary, lambda: self.api.create_membership(p_roomId=space_id,
+                                                                                    p_personId=person.id))
+                except aiohttp.ClientResponseError as e:
+                    if e.status == 409:
+                        # already a member (added concurrently)
+                        summary.memberships[EXISTING] += 1
+                    else:
+                        summary.memberships[FAILED] += 1
+                        summary.errors[person.id] = f'membership: {e.status} {e.message}'
+                        log.warning(f'failed to add {person.displayName}: {e.status} {e.message}')
+                    item_done()
+                    continue
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    summary.memberships[FAILED] += 1
+                    summary.errors[person.id] = f'membership: {e}'
+                    log.warning(f'failed to add {person.displayName}: {e}')
+                    item_done()
+                    continue
+                summary.memberships[CREATED] += 1
+                log.debug(f'Added {person.displayName} to space')
+                if message is None:
+                    item_done()
+                else:
+                    await messages.put(person)
+
+        async def message_worker() -> None:
+            while (person := await messages.get()) is not None:
+                try:
+                    # a repeated request might post the message twice
+                    await self._attempt(summary, lambda: self.api.create_message(p_roomId=space_id,
+                                                                                 p_text=message(person)),
+                                        idempotent=False)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    summary.messages[FAILED] += 1
+                    summary.errors[person.id] = f'message: {e}'
+                    log.warning(f'failed to post message for {person.displayName}: {e}')
+                else:
+                    summary.messages[CREATED] += 1
+                    log.debug(f'Posted message for {person.displayName}')
+                item_done()
+
+        async def producer() -> None:
+            for person in people:
+                if person.id in existing:
+                    summary.memberships[EXISTING] += 1
+                    item_done()
+                    continue
+                await memberships.put(person)
+            for _ in membership_tasks:
+                await memberships.put(None)
+            await asyncio.gather(*membership_tasks)
+            for _ in message_tasks:
+                await messages.put(None)
+            await asyncio.gather(*message_tasks)
+
+        membership_tasks = [asyncio.create_task(membership_worker()) for _ in range(self.membership_workers)]
+        message_tasks = [asyncio.create_task(message_worker()) for _ in range(self.message_workers)]
+        await run_stages(producer(), membership_tasks + message_tasks)
+        summary.duration = time.monotonic() - summary.started
+        return summary
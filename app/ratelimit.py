@@ -0,0 +1,149 @@
+"""
+Process wide rate limiting of Webex API requests.
+
+Requests are limited by token buckets keyed by access token and endpoint family (rooms, messages, memberships,
+...). The buckets are shared by all API instances and all job loops of the process. If any request gets a 429 the
+bucket is paused until the Retry-After time has passed so that all other tasks using the same key back off as well
+instead of running into 429s of their own.
+"""
+import asyncio
+import logging
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Token bucket. Tokens are reserved ahead of time: a reservation returns the time the caller has to wait until the
+    token is available. A pause pushes back outstanding reservations: holders of reservations check `delayed` after
+    waiting and wait for the difference.
+    """
+    __slots__ = ['rate', 'burst', 'tokens', 'updated', 'delayed']
+
+    def __init__(self, rate: float, burst: int, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        # time up to which tokens have been accounted for; in the future while the bucket is paused
+        self.updated = now
+        # total time in seconds reservations have been pushed back by pauses
+        self.delayed = 0.0
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def reserve(self, now: float) -> float:
+        """
+        Reserve a token
+        :param now: current time
+        :return: time in seconds to wait before the token can be used
+        """
+        self._refill(now)
+        self.tokens -= 1
+        wait = self.updated - now
+        if self.tokens < 0:
+            wait += -self.tokens / self.rate
+        return wait
+
+    def pause(self, now: float, seconds: float) -> None:
+        """
+        Don't hand out tokens for some time. Outstanding reservations are pushed back by the time the pause extends
+        beyond the time tokens have been accounted for (see `delayed`).
+        :param now: current time
+        :param seconds: pause duration
+        :return: None
+        """
+        self._refill(now)
+        until = now + seconds
+        if until > self.updated:
+            self.delayed += until - self.updated
+            self.updated = until
+            # no burst after the pause
+            self.tokens = min(self.tokens, 0.0)
+
+
+class RateLimiter:
+    """
+    Thread safe collection of token buckets keyed by access token and endpoint family
+    """
+    # default rate (requests/second) and burst per key
+    RATE = 50.0
+    BURST = 100
+    # buckets not used for this many seconds are removed
+    IDLE_TIMEOUT = 600
+
+    def __init__(self, rate: float = RATE, burst: int = BURST,
+                 family_limits: Optional[Dict[str, Tuple[float, int]]] = None):
+        """
+
+        :param rate: default rate in requests/second
+        :param burst: default burst
+        :param family_limits: (rate, burst) for individual endpoint families
+        """
+        self.rate = rate
+        self.burst = burst
+        self.family_limits = family_limits or dict()
+        self.buckets: Dict[Tuple[str, str], TokenBucket] = dict()
+        self.lock = threading.Lock()
+        self.last_cleanup = time.monotonic()
+
+    def _bucket(self, access_token: str, family: str, now: float) -> TokenBucket:
+        """
+        Get bucket for a key. Needs to be called with the lock held
+        """
+        key = (access_token, family)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if now - self.last_cleanup > self.IDLE_TIMEOUT:
+                self._cleanup(now)
+            rate, burst = self.family_limits.get(family, (self.rate, self.burst))
+            bucket = self.buckets[key] = TokenBucket(rate=rate, burst=burst, now=now)
+        return bucket
+
+    def _cleanup(self, now: float) -> None:
+        """
+        Remove idle buckets. Needs to be called with the lock held
+        """
+        self.buckets = {k: b for k, b in self.buckets.items() if now - b.updated < self.IDLE_TIMEOUT}
+        self.last_cleanup = now
+
+    async def acquire(self, access_token: str, family: str) -> None:
+        """
+        Wait until a request for the given key can be sent
+        :param access_token: access token used for the request
+        :param family: endpoint family
+        :return: None
+        """
+        now = time.monotonic()
+        with self.lock:
+            bucket = self._bucket(access_token, family, now)
+            wait = bucket.reserve(now)
+            delayed = bucket.delayed
+        while wait > 0:
+            await asyncio.sleep(wait)
+            # the bucket might have been paused while waiting: wait until the reservation is due again
+            with self.lock:
+                wait = bucket.delayed - delayed
+                delayed = bucket.delayed
+
+    def pause(self, access_token: str, family: str, seconds: float) -> None:
+        """
+        Pause all requests for a key; called when a request got a 429
+        :param access_token: access token used for the request
+        :param family: endpoint family
+        :param seconds: Retry-After time
+        :return: None
+        """
+        now = time.monotonic()
+        with self.lock:
+            self._bucket(access_token, family, now).pause(now, seconds)
+        log.debug(f'paused {family} requests for {seconds} seconds')
+
+
+# process wide rate limiter shared by all WebexTeamsAsyncAPI instances
+rate_limiter = RateLimiter()
@@ -0,0 +1,37 @@
+"""
+Asyncio Redis clients for code running on the job loops.
+
+redis.asyncio clients (and their connection pools) are bound to an event loop. The clients are created per loop with
+the connection parameters of the synchronous client the app has been configured with.
+"""
+import asyncio
+import logging
+from typing import Dict, Tuple
+
+from redis import Redis
+import redis.asyncio
+
+log = logging.getLogger(__name__)
+
+# connection parameters taken over from the synchronous client
+_CONNECTION_KWARGS = ('host', 'port', 'db', 'username', 'password', 'socket_timeout', 'socket_connect_timeout')
+
+_clients: Dict[Tuple[asyncio.AbstractEventLoop, int], redis.asyncio.Redis] = {}
+
+
+def async_client(sync_client: Redis) -> redis.asyncio.Redis:
+    """
+    Get an asyncio client for the running loop connecting to the same Redis as the given synchronous client
+    :param sync_client: synchronous client
+    :return: asyncio client
+    """
+    key = (asyncio.get_running_loop(), id(sync_client))
+    client = _clients.get(key)
+    if client is None:
+        kwargs = sync_client.connection_pool.connection_kwargs
+        params = {k: kwargs[k] for k in _CONNECTION_KWARGS if k in kwargs}
+        if 'path' in kwargs:
+            params['unix_socket_path'] = kwargs['path']
+        client = _clients[key] = redis.asyncio.Redis(**params)
+        log.debug(f'new asyncio client for loop {id(key[0]):x}: {params.get("host") or params.get("unix_socket_path")}')
+    return client
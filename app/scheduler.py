@@ -0,0 +1,197 @@
+"""
+Admission control for jobs.
+
+Jobs are not started right away: the scheduler only admits a job if the number of running jobs is below a global
+limit and the number of running jobs of the user is below a per user limit. Other jobs wait in a FIFO queue and are
+admitted in order when jobs terminate. Fair share is simply one job per user: a user starting a job while a job of the
+user is queued or running gets attached to that job (see events.start_job), so a single user can't monopolize the
+app. Queued jobs get their queue position and can be cancelled.
+
+The limits apply to all app processes: admission is decided atomically in Redis (see JobRegistry.admit). Each process
+queues the jobs of its own clients; the queue position only counts the jobs queued in the same process. Capacity freed
+by jobs terminating in other processes is noticed by retrying the admission of queued jobs every POLL_INTERVAL
+seconds. W/o Redis connection the limits only apply to the jobs of this process.
+
+The scheduler is only used from greenlets in the eventlet hub (socket.io event handlers and pipe processors).
+"""
+import logging
+from collections import deque
+from threading import Lock
+from typing import Deque, Dict, Optional
+
+import eventlet
+
+from . import socketio
+from .flaskthread import FlaskThread
+from .jobregistry import ADMITTED, LIMIT_REACHED, USER_LIMIT_REACHED, JobRegistry
+
+log = logging.getLogger(__name__)
+
+
+class JobScheduler:
+    """
+    Queue of jobs waiting for admission
+    """
+    # max number of jobs running concurrently in all app processes
+    MAX_RUNNING = 10
+    # max number of jobs of a single user running concurrently
+    MAX_RUNNING_PER_USER = 1
+    # interval in seconds between admission attempts for queued jobs
+    POLL_INTERVAL = 2.0
+
+    def __init__(self, max_running: int = MAX_RUNNING, max_running_per_user: int = MAX_RUNNING_PER_USER):
+        self.max_running = max_running
+        self.max_running_per_user = max_running_per_user
+        # queued jobs in order of submission
+        self.queue: Deque[FlaskThread] = deque()
+        # number of running jobs per user
+        self.running: Dict[str, int] = dict()
+        # user ids of running jobs by job id
+        self.active: Dict[str, str] = dict()
+        self.lock = Lock()
+        # admission runs in a single greenlet at a time; a dispatch requested meanwhile is done by that greenlet
+        self.dispatching = False
+        self.dispatch_pending = False
+        # timer of the next admission attempt for queued jobs
+        self.poller: Optional[eventlet.greenthread.GreenThread] = None
+
+    def submit(self, thread: FlaskThread) -> None:
+        """
+        Submit a job. The job is started right away if the limits allow; else the job is queued
+        :param thread: job
+        :return: None
+        """
+        with self.lock:
+            self.queue.append(thread)
+        log.debug(f'submit: {thread}')
+        self._dispatch()
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancel a queued job. The job still gets started but terminates immediately w/o calling the target
+        :param job_id: job id
+        :return: True if the job was queued
+        """
+        with self.lock:
+            thread = next((t for t in self.queue if t.job_id == job_id), None)
+            if thread is None:
+                return False
+            self.queue.remove(thread)
+        log.debug(f'cancel: {thread}')
+        thread.set_stop_event()
+        thread.start()
+        self._notify_positions()
+        return True
+
+    def position(self, job_id: str) -> Optional[int]:
+        """
+        Position of a job in the queue
+        :param job_id: job id
+        :return: 1-based position; None if the job is not queued
+        """
+        with self.lock:
+            return next((i for i, thread in enumerate(self.queue, 1) if thread.job_id == job_id), None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(running=len(self.active), queued=len(self.queue))
+
+    def _admit(self, thread: FlaskThread) -> int:
+        """
+        Try to admit a queued job. Must not be called with the lock held: admission is a Redis round trip
+        :return: ADMITTED, LIMIT_REACHED, or USER_LIMIT_REACHED
+        """
+        result = JobRegistry.admit(thread.job_id, thread.user_id, self.max_running, self.max_running_per_user)
+        if result is not None:
+            return result
+        # no Redis: only the jobs of this process count
+        with self.lock:
+            if len(self.active) >= self.max_running:
+                return LIMIT_REACHED
+            if self.running.get(thread.user_id, 0) >= self.max_running_per_user:
+                return USER_LIMIT_REACHED
+        return ADMITTED
+
+    def _start(self, thread: FlaskThread) -> None:
+        log.debug(f'start: {thread}, {self.stats()}')
+        # admission ends when the pipe processor of the job terminates
+        thread.green_thread.link(lambda _, job_id=thread.job_id: self._job_done(job_id))
+        socketio.emit('queue_position', {'job_id': thread.job_id, 'position': None},
+                      room=FlaskThread.room(thread.job_id))
+        thread.start()
+
+    def _admit_queued(self) -> None:
+        """
+        Start queued jobs in order as long as the limits allow
+        """
+        with self.lock:
+            queued = list(self.queue)
+        for thread in queued:
+            result = self._admit(thread)
+            if result == LIMIT_REACHED:
+                break
+            if result == USER_LIMIT_REACHED:
+                continue
+            with self.lock:
+                cancelled = thread not in self.queue
+                if not cancelled:
+                    self.queue.remove(thread)
+                    user_id = thread.user_id
+                    self.running[user_id] = self.running.get(user_id, 0) + 1
+                    self.active[thread.job_id] = user_id
+            if cancelled:
+                # cancelled while being admitted
+                JobRegistry.release(thread.job_id)
+                continue
+            self._start(thread)
+
+    def _dispatch(self) -> None:
+        """
+        Start as many queued jobs as the limits allow
+        """
+        if self.dispatching:
+            self.dispatch_pending = True
+            return
+        self.dispatching = True
+        try:
+            self.dispatch_pending = True
+            while self.dispatch_pending:
+                self.dispatch_pending = False
+                self._admit_queued()
+        finally:
+            self.dispatching = False
+        self._notify_positions()
+        with self.lock:
+            poll = bool(self.queue) and self.poller is None
+        if poll:
+            # jobs terminating in other processes don't notify this process
+            self.poller = eventlet.spawn_after(self.POLL_INTERVAL, self._poll)
+
+    def _poll(self) -> None:
+        self.poller = None
+        self._dispatch()
+
+    def _job_done(self, job_id: str) -> None:
+        with self.lock:
+            user_id = self.active.pop(job_id, None)
+            if user_id is None:
+                return
+            self.running[user_id] -= 1
+            if not self.running[user_id]:
+                del self.running[user_id]
+        JobRegistry.release(job_id)
+        self._dispatch()
+
+    def _notify_positions(self) -> None:
+        """
+        Send the current queue position to each queued job
+        """
+        with self.lock:
+            queued = list(self.queue)
+        for position, thread in enumerate(queued, 1):
+            socketio.emit('queue_position', {'job_id': thread.job_id, 'position': position},
+                          room=FlaskThread.room(thread.job_id))
+
+
+# process wide scheduler used by the socket.io event handlers
+scheduler = JobScheduler()
@@ -0,0 +1,240 @@
+"""
+Streaming aggregation of message statistics (count, earliest and latest message) of spaces.
+
+Messages are aggregated page by page: memory per space is bounded by the page size and the read-ahead of the
+pagination. Timestamps are parsed once into integers (milliseconds since epoch). If the message count is not needed
+then earliest and latest message are determined with a few single message requests using the before cursor of the
+messages API instead of reading the complete history of the space.
+"""
+import contextlib
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+
+from .webexteamsasyncapi import WebexTeamsAsyncAPI, record_factory
+
+log = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MILLISECOND = timedelta(milliseconds=1)
+
+# messages are read as compact records only holding these fields
+message_record = record_factory('Message', ('id', 'created'))
+
+
+def parse_timestamp(timestamp: str) -> int:
+    """
+    Parse a Webex timestamp ('2020-03-30T14:33:27.123Z')
+    :param timestamp: ISO 8601 timestamp
+    :return: milliseconds since epoch
+    """
+    if timestamp.endswith('Z'):
+        timestamp = f'{timestamp[:-1]}+00:00'
+    return (datetime.fromisoformat(timestamp) - EPOCH) // MILLISECOND
+
+
+def format_timestamp(ms: int) -> str:
+    """
+    Format milliseconds since epoch as Webex timestamp
+    :param ms: milliseconds since epoch
+    :return: ISO 8601 timestamp
+    """
+    dt = EPOCH + timedelta(milliseconds=ms)
+    return f'{dt:%Y-%m-%dT%H:%M:%S}.{dt.microsecond // 1000:03d}Z'
+
+
+class SpaceStats:
+    """
+    Message statistics of a space
+    """
+    __slots__ = ['room_id', 'message_count', 'earliest', 'latest', 'latest_id', 'pages', 'complete']
+
+    def __init__(self, room_id: str):
+        self.room_id = room_id
+        # None if messages are not counted
+        self.message_count: Optional[int] = 0
+        # timestamps in ms since epoch
+        self.earliest: Optional[int] = None
+        self.latest: Optional[int] = None
+        # id of the newest message
+        self.latest_id: Optional[str] = None
+        self.pages = 0
+        self.complete = False
+
+    def add_page(self, page) -> None:
+        """
+        Aggregate a page of messages. Pages have to be passed in the order returned by the API (newest first)
+        :param page: list of message records
+        :return: None
+        """
+        if not page:
+            return
+        self.pages += 1
+        self.message_count += len(page)
+        # messages are returned newest first, but don't rely on that for the min/max
+        created = [parse_timestamp(m.created) for m in page]
+        newest = max(created)
+        oldest = min(created)
+        if self.latest is None or newest > self.latest:
+            self.latest = newest
+            self.latest_id = page[created.index(newest)].id
+        if self.earliest is None or oldest < self.earliest:
+            self.earliest = oldest
+
+    def merge(self, older: 'SpaceStats') -> None:
+        """
+        Merge stats of older messages of the same space into these stats
+        :param older: stats of messages older than the messages aggregated in these stats
+        :return: None
+        """
+        self.message_count += older.message_count
+        if older.earliest is not None and (self.earliest is None or older.earliest < self.earliest):
+            self.earliest = older.earliest
+        if self.latest is None:
+            self.latest = older.latest
+            self.latest_id = older.latest_id
+
+    def as_dict(self) -> dict:
+        return dict(
+            message_count=self.message_count,
+            earliest=None if self.earliest is None else format_timestamp(self.earliest),
+            latest=None if self.latest is None else format_timestamp(self.latest)
+        )
+
+    def __repr__(self):
+        return f'SpaceStats({self.room_id}, {self.as_dict()})'
+
+
+async def count_messages(api: WebexTeamsAsyncAPI, room_id: str, running: Callable[[], bool],
+                         page_size: int = 500, read_ahead: int = 2,
+                         on_page: Optional[Callable[[SpaceStats], None]] = None) -> Optional[SpaceStats]:
+    """
+    Aggregate stats over all messages of a space
+    :param api: API to use
+    :param room_id: space id
+    :param running: aggregation stops as soon as this returns False
+    :param page_size: number of messages to request per page
+    :param read_ahead: number of pages to prefetch
+    :param on_page: called with the partial result after each page
+    :return: complete stats; None if stopped
+    """
+    stats = SpaceStats(room_id)
+    params = dict(roomId=room_id, max=page_size)
+    async for page in api.pages(api.messages_endpoint, params=params, factory=message_record,
+                                read_ahead=read_ahead, running=running):
+        stats.add_page(page)
+        if on_page is not None:
+            on_page(stats)
+    if not running():
+        return None
+    stats.complete = True
+    return stats
+
+
+async def refresh_messages(api: WebexTeamsAsyncAPI, cached: SpaceStats, running: Callable[[], bool],
+                           page_size: int = 500, read_ahead: int = 2,
+                           on_page: Optional[Callable[[SpaceStats], None]] = None) -> Optional[SpaceStats]:
+    """
+    Update cached stats of a space: only messages newer than the newest message of the cached stats (watermark) are
+    read. If the watermark message doesn't exist any more then all messages are counted again.
+    :param api: API to use
+    :param cached: complete stats from a previous run
+    :param running: aggregation stops as soon as this returns False
+    :param page_size: number of messages to request per page
+    :param read_ahead: number of pages to prefetch
+    :param on_page: called with the partial result (new messages only) after each page
+    :return: complete stats; None if stopped
+    """
+    room_id = cached.room_id
+    if cached.latest_id is None:
+        # space had no messages
+        return await count_messages(api, room_id, running, page_size=page_size, read_ahead=read_ahead,
+                                    on_page=on_page)
+    stats = SpaceStats(room_id)
+    found = False
+    params = dict(roomId=room_id, max=page_size)
+    async with contextlib.aclosing(api.pages(api.messages_endpoint, params=params, factory=message_record,
+                                             read_ahead=read_ahead, running=running)) as pages:
+        async for page in pages:
+            for i, message in enumerate(page):
+                if message.id == cached.latest_id:
+                    # reached watermark: everything from here on has been counted before
+                    stats.add_page(page[:i])
+                    found = True
+                    break
+            else:
+                stats.add_page(page)
+            if on_page is not None:
+                on_page(stats)
+            if found:
+                break
+    if not running():
+        return None
+    if not found:
+        log.debug(f'refresh_messages: {room_id}: watermark {cached.latest_id} not found, counting all messages')
+        return await count_messages(api, room_id, running, page_size=page_size, read_ahead=read_ahead,
+                                    on_page=on_page)
+    stats.merge(cached)
+    stats.complete = True
+    return stats
+
+
+async def _message_before(api: WebexTeamsAsyncAPI, room_id: str, before: Optional[int] = None):
+    """
+    Get the newest message of a space sent before a given time
+    :param before: ms since epoch; None: newest message
+    :return: message record or None
+    """
+    params = dict(roomId=room_id, max=1)
+    if before is not None:
+        params['before'] = format_timestamp(before)
+    _, data = await api.request('GET', api.messages_endpoint, params=params)
+    items = data['items']
+    return message_record(items[0]) if items else None
+
+
+async def message_bounds(api: WebexTeamsAsyncAPI, room_id: str, room_created: str,
+                         running: Callable[[], bool]) -> Optional[SpaceStats]:
+    """
+    Determine earliest and latest message of a space w/o reading all messages. The earliest message is located by a
+    binary search over time using the before cursor; this takes O(log(lifetime of the space in ms)) requests.
+    The message count of the result is None.
+    :param api: API to use
+    :param room_id: space id
+    :param room_created: creation time of the space; no message can be older
+    :param running: search stops as soon as this returns False
+    :return: stats; None if stopped
+    """
+    stats = SpaceStats(room_id)
+    stats.message_count = None
+    newest = await _message_before(api, room_id)
+    if newest is None:
+        stats.complete = True
+        return stats
+    stats.latest = parse_timestamp(newest.created)
+    stats.latest_id = newest.id
+
+    # invariant: there is no message before lo, oldest is the oldest message found so far
+    lo = parse_timestamp(room_created)
+    oldest = newest
+    oldest_created = stats.latest
+    while running():
+        mid = (lo + oldest_created) // 2
+        if mid <= lo:
+            # interval can't be split any further: check whether there is anything older than the oldest message
+            mid = oldest_created
+        message = await _message_before(api, room_id, before=mid)
+        if message is None:
+            if mid == oldest_created:
+                break
+            lo = mid
+        else:
+            oldest = message
+            oldest_created = parse_timestamp(message.created)
+    else:
+        # running() returned False
+        return None
+    log.debug(f'message_bounds: {room_id}: oldest message {oldest.id}')
+    stats.earliest = oldest_created
+    stats.complete = True
+    return stats
@@ -2,26 +2,156 @@
 $(document).ready(function(){
     let socket=io.connect();
 
-    socket.on("output", function(msg){
-        // console.log("Received new line: " + msg.data);
-        let log = document.getElementById("log");
-        let e = $('#log')
-        e.append(msg.data + '<br>');
-        e.scrollTop(log.scrollHeight);
+    // progress bars, tables and metrics (structured events) by label, table name, and metric name
+    let bars = {};
+    let tables = {};
+    let metrics = {};
+    // ids of the output batches received since the page has (re-)connected; replayed and live batches can arrive out
+    // of order
+    let seen = new Set();
+    // offset of the last batch received before the page has (re-)connected
+    let baseOffset = null;
+
+    // the job the client is attached to and the offset of the last output batch received are kept in the session
+    // storage of the tab: after a reconnect (page reload, network issues) the output is replayed from that offset
+    function compareOffsets(a, b){
+        // offsets are Redis stream ids: "<ms>-<sequence>"
+        let [a1, a2] = a.split('-').map(Number);
+        let [b1, b2] = b.split('-').map(Number);
+        return a1 === b1 ? a2 - b2 : a1 - b1;
+    }
+
+    socket.on("connect", function(){
+        seen = new Set();
+        baseOffset = sessionStorage.getItem('job_offset');
+        socket.emit('resume', {job_id: sessionStorage.getItem('job_id'), offset: sessionStorage.getItem('job_offset')});
     });
 
-    $('button#start-space-stats').on('click', function(event){
+    socket.on("job", function(msg){
+        if (msg.reset || msg.job_id !== sessionStorage.getItem('job_id')){
+            // attached to a different job or output is replayed from the start: start over
+            clearOutput();
+            sessionStorage.setItem('job_id', msg.job_id);
+        }
+    });
+
+    socket.on("queue_position", function(msg){
+        if (msg.position === null){
+            $('#queue').hide();
+        } else {
+            $('#queue').text('Waiting for other jobs to complete: position ' + msg.position + ' in queue. Press "Stop" to cancel.').show();
+        }
+    });
+
+    function escapeHtml(value){
+        return String(value === null || value === undefined ? '' : value)
+            .replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;').replace(/"/g, '&quot;');
+    }
+
+    function clearOutput(){
         $('#log').empty();
+        $('#queue').hide();
+        $('#progress').empty();
+        $('#metrics').empty();
+        $('#tables').empty();
+        // output is gone: all batches need to be shown again
+        sessionStorage.removeItem('job_offset');
+        seen = new Set();
+        baseOffset = null;
+        bars = {};
+        tables = {};
+        metrics = {};
+    }
+
+    function updateProgress(event){
+        let bar = bars[event.label];
+        if (bar === undefined){
+            let e = $('<div class="progress"><div class="progress-bar" role="progressbar" style="min-width: 6em;"></div></div>');
+            $('#progress').append(e);
+            bar = bars[event.label] = e.find('.progress-bar');
+        }
+        let text = event.label + ' ' + event.done;
+        let percent = 0;
+        if (event.total){
+            percent = Math.floor(100 * event.done / event.total);
+            text += '/' + event.total;
+        }
+        bar.css('width', percent + '%').text(text);
+    }
+
+    function updateMetric(event){
+        let e = metrics[event.name];
+        if (e === undefined){
+            let item = $('<span class="label label-default" style="margin-right: 1em;"></span>');
+            $('#metrics').append(item);
+            e = metrics[event.name] = item;
+        }
+        e.text(event.name + ': ' + event.value);
+    }
+
+    function appendRows(name, rows){
+        let table = tables[name];
+        if (table === undefined){
+            // columns are taken from the first row
+            let columns = Object.keys(rows[0]);
+            let e = $('<table class="table table-condensed table-striped"><thead><tr></tr></thead><tbody></tbody></table>');
+            e.find('tr').html(columns.map(c => '<th>' + escapeHtml(c) + '</th>').join(''));
+            $('#tables').append(e);
+            table = tables[name] = {columns: columns, body: e.find('tbody')};
+        }
+        // all rows of a batch are appended with a single DOM update
+        table.body.append(rows.map(
+            row => '<tr>' + table.columns.map(c => '<td>' + escapeHtml(row[c]) + '</td>').join('') + '</tr>'
+        ).join(''));
+    }
+
+    socket.on("output_batch", function(msg){
+        // console.log("Received " + msg.data.length + " new lines");
+        if (msg.id){
+            if (seen.has(msg.id) || (baseOffset && compareOffsets(msg.id, baseOffset) <= 0)){
+                // already seen: batch has been received live and by replay
+                return;
+            }
+            seen.add(msg.id);
+            let offset = sessionStorage.getItem('job_offset');
+            if (!offset || compareOffsets(msg.id, offset) > 0){
+                sessionStorage.setItem('job_offset', msg.id);
+            }
+        }
+        // all lines of a batch are appended with a single DOM update
+        if (msg.data.length){
+            let log = document.getElementById("log");
+            let e = $('#log')
+            e.append(msg.data.join('<br>') + '<br>');
+            e.scrollTop(log.scrollHeight);
+        }
+        let rows = {};
+        for (const event of msg.events || []){
+            if (event.type === 'progress'){
+                updateProgress(event);
+            } else if (event.type === 'metric'){
+                updateMetric(event);
+            } else if (event.type === 'row'){
+                (rows[event.table] = rows[event.table] || []).push(event.row);
+            }
+        }
+        for (const name in rows){
+            appendRows(name, rows[name]);
+        }
+    });
+
+    $('button#start-space-stats').on('click', function(event){
+        clearOutput();
         socket.emit('start_space_stats');
     });
 
     $('button#start-create-spaces').on('click', function(event){
-        $('#log').empty();
+        clearOutput();
         socket.emit('start_create_spaces');
     });
 
     $('button#start-delete-spaces').on('click', function(event){
-        $('#log').empty();
+        clearOutput();
         socket.emit('start_delete_spaces');
     });
 
@@ -31,7 +161,7 @@ $(document).ready(function(){
     });
 
     $('button#clear').on('click', function(event){
-        $('#log').empty();
+        clearOutput();
     });
 
-});
\ No newline at end of file
+});
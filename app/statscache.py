@@ -0,0 +1,123 @@
+"""
+Persistent per user cache of space statistics in Redis.
+
+All entries of a user are kept in a single Redis hash: field is the space id, value is a JSON object with message
+count, earliest and latest message, id of the newest message seen (watermark), and the last activity of the space
+at the time the stats were computed.
+"""
+import json
+import logging
+from typing import Dict, Iterable
+
+from redis import Redis
+
+from .spacestats import SpaceStats
+
+log = logging.getLogger(__name__)
+
+
+class CacheEntry:
+    """
+    Cached stats of a space
+    """
+    __slots__ = ['stats', 'last_activity']
+
+    def __init__(self, stats: SpaceStats, last_activity: str):
+        self.stats = stats
+        self.last_activity = last_activity
+
+    def to_json(self) -> str:
+        stats = self.stats
+        return json.dumps(dict(count=stats.message_count, earliest=stats.earliest, latest=stats.latest,
+                               latest_id=stats.latest_id, last_activity=self.last_activity))
+
+    @staticmethod
+    def from_json(room_id: str, json_str) -> 'CacheEntry':
+        d = json.loads(json_str)
+        stats = SpaceStats(room_id)
+        stats.message_count = d['count']
+        stats.earliest = d['earliest']
+        stats.latest = d['latest']
+        stats.latest_id = d['latest_id']
+        stats.complete = True
+        return CacheEntry(stats=stats, last_activity=d['last_activity'])
+
+
+class StatsCache:
+    """
+    Space stats cache of a user
+    """
+    # Redis connection to save stats
+    _redis: Redis = None
+
+    # cache of a user expires if not updated for this many seconds
+    TTL = 30 * 24 * 3600
+
+    @staticmethod
+    def set_redis(redis: Redis) -> None:
+        log.debug(f'Redis connection set: {redis}')
+        StatsCache._redis = redis
+
+    def __init__(self, user_id: str):
+        assert StatsCache._redis is not None
+        self.user_id = user_id
+        # updates not yet written to Redis
+        self.updates: Dict[str, str] = dict()
+
+    @property
+    def redis_key(self) -> str:
+        """
+        Key to use when storing stats in Redis
+        :return: key
+        """
+        return f'SpaceStats:{self.user_id}'
+
+    def load(self) -> Dict[str, CacheEntry]:
+        """
+        Read all cached entries of the user
+        :return: dict of cache entries by space id
+        """
+        entries = dict()
+        for room_id, json_str in StatsCache._redis.hgetall(self.redis_key).items():
+            room_id = room_id.decode()
+            try:
+                entries[room_id] = CacheEntry.from_json(room_id, json_str)
+            except (ValueError, KeyError) as e:
+                log.warning(f'load: {self.redis_key}/{room_id}: invalid entry: {e}')
+        log.debug(f'load: {self.redis_key}: {len(entries)} entries')
+        return entries
+
+    def update(self, stats: SpaceStats, last_activity: str) -> None:
+        """
+        Update the entry of a space. The update is only written to Redis with the next flush()
+        :param stats: complete stats of the space
+        :param last_activity: last activity of the space
+        :return: None
+        """
+        self.updates[stats.room_id] = CacheEntry(stats=stats, last_activity=last_activity).to_json()
+
+    def flush(self) -> None:
+        """
+        Write all pending updates to Redis with a single round trip
+        :return: None
+        """
+        updates, self.updates = self.updates, dict()
+        if not updates:
+            return
+        log.debug(f'flush: {self.redis_key}: {len(updates)} updates')
+        pipeline = StatsCache._redis.pipeline(transaction=False)
+        pipeline.hset(self.redis_key, mapping=updates)
+        pipeline.expire(self.redis_key, self.TTL)
+        pipeline.execute()
+
+    def prune(self, space_ids: Iterable[str]) -> None:
+        """
+        Remove the entries of spaces which no longer exist (or the user is no longer a member of)
+        :param space_ids: ids of the spaces to remove
+        :return: None
+        """
+        space_ids = list(space_ids)
+        if not space_ids:
+            return
+        log.debug(f'prune: {self.redis_key}: {len(space_ids)} entries')
+        StatsCache._redis.hdel(self.redis_key, *space_ids)
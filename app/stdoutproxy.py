@@ -1,43 +1,103 @@
 """
-Simple per thread proxy functionality for stdout based on werkzeug LocalProxy
+Per context proxy functionality for stdout.
+The redirection is kept in a context variable: it applies to the thread or asyncio task setting the redirection
+and is inherited by tasks created from that task. Hence many jobs sharing a single loop thread can each have their
+own stdout. Writes w/o redirection go straight to the original stdout with a single context variable lookup.
 """
 import sys
 import io
-from typing import Dict
-import threading
+import contextlib
+from contextvars import ContextVar, Token
+from typing import Iterator, Optional
 
-import werkzeug
+# non-default stdout of the current context
+_redirect: ContextVar[Optional[io.TextIOBase]] = ContextVar('stdout_redirect', default=None)
 
-# directory of non-default stdouts
-thread_proxies: Dict[int, io.TextIOBase] = {}
-
-# save the default stdout; needed by the proxy as default for threads w/o redirection
+# save the default stdout; needed by the proxy as default for contexts w/o redirection
 _default_stdout = sys.stdout
 
 
-def redirect(f: io.TextIOBase) -> io.TextIOBase:
+def redirect(f: io.TextIOBase) -> Token:
     """
-    Set stdout redirection for current thread
+    Set stdout redirection for current context (thread or asyncio task)
     :param f: file like object stdout should be redirected to
-    :return: same as input parameter
+    :return: token to pass to end_redirect() to restore the previous redirection
     """
-    ident = threading.currentThread().ident
-    thread_proxies[ident] = f
-    return thread_proxies[ident]
+    return _redirect.set(f)
 
 
-def end_redirect() -> None:
+def end_redirect(token: Optional[Token] = None) -> None:
     """
-    End stdout redirection for current thread
+    End stdout redirection for current context
+    :param token: token returned by redirect(); the redirection active before is restored. If None then
+        redirection is removed altogether
     :return: None
     """
-    ident = threading.currentThread().ident
-    thread_proxies.pop(ident, None)
+    if token is None:
+        _redirect.set(None)
+    else:
+        _redirect.reset(token)
+
+
+@contextlib.contextmanager
+def redirected(f: io.TextIOBase) -> Iterator[io.TextIOBase]:
+    """
+    Context manager redirecting stdout of the current context; redirections can be nested
+    :param f: file like object stdout should be redirected to
+    :return: f
+    """
+    token = redirect(f)
+    try:
+        yield f
+    finally:
+        end_redirect(token)
+
+
+def proxy() -> io.TextIOBase:
+    """
+    stdout of the current context
+    """
+    f = _redirect.get()
+    return _default_stdout if f is None else f
+
+
+class ContextStdout(io.TextIOBase):
+    """
+    Replacement for sys.stdout delegating to the stdout of the current context
+    """
+
+    def write(self, s: str) -> int:
+        f = _redirect.get()
+        if f is None:
+            return _default_stdout.write(s)
+        return f.write(s)
+
+    def writelines(self, lines) -> None:
+        proxy().writelines(lines)
+
+    def flush(self) -> None:
+        proxy().flush()
+
+    def fileno(self) -> int:
+        return proxy().fileno()
+
+    def isatty(self) -> bool:
+        return proxy().isatty()
+
+    def writable(self) -> bool:
+        return True
+
+    @property
+    def encoding(self) -> str:
+        return getattr(proxy(), 'encoding', None) or 'utf-8'
 
+    @property
+    def errors(self) -> Optional[str]:
+        return getattr(proxy(), 'errors', None)
 
-def proxy():
-    ident = threading.currentThread().ident
-    return thread_proxies.get(ident, _default_stdout)
+    def __getattr__(self, item):
+        # only called for attributes not defined by TextIOBase (e.g. buffer)
+        return getattr(proxy(), item)
 
 
-sys.stdout = werkzeug.local.LocalProxy(proxy)
+sys.stdout = ContextStdout()
@@ -0,0 +1,143 @@
+"""
+In-process cache of decoded Token objects.
+
+The cache is a bounded LRU cache with a time to live per entry. Whenever a token is committed to Redis the user id is
+published on an invalidation channel; a listener thread in each app process drops the cached token of that user so
+that multiple app replicas stay consistent. The TTL bounds staleness if invalidation messages get lost (e.g. while the
+listener reconnects).
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List, Optional, Tuple
+
+from redis import Redis
+from redis.exceptions import ConnectionError, TimeoutError
+
+log = logging.getLogger(__name__)
+
+# channel invalidation messages are published on
+CHANNEL = 'Token:invalidate'
+
+# identifies this process in invalidation messages; a process doesn't need to act on its own messages
+PROCESS_ID = uuid.uuid4().hex
+
+
+class TTLCache:
+    """
+    Thread safe bounded LRU cache with a time to live per entry
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        """
+
+        :param max_size: max number of entries; least recently used entries are evicted
+        :param ttl: entries expire after this many seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: 'OrderedDict[Hashable, Tuple[float, Any]]' = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Get a cached value
+        :param key: key
+        :return: value; None if not cached or expired
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """
+        Cache a value
+        :param key: key
+        :param value: value
+        :return: None
+        """
+        expires = time.monotonic() + self.ttl
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def values(self) -> List[Any]:
+        """
+        Snapshot of all values which have not expired yet
+        :return: list of values
+        """
+        now = time.monotonic()
+        with self.lock:
+            return [value for expires, value in self.entries.values() if expires >= now]
+
+    def invalidate(self, key: Hashable) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+def invalidation_message(user_id: str) -> str:
+    """
+    Message to publish on CHANNEL after the token of a user has been updated
+    :param user_id: user id
+    :return: message
+    """
+    return f'{PROCESS_ID} {user_id}'
+
+
+class InvalidationListener(threading.Thread):
+    """
+    Daemon thread listening for invalidation messages
+    """
+    # wait time before trying to reconnect after the connection to Redis got lost
+    RECONNECT_INTERVAL = 5
+
+    def __init__(self, redis: Redis, invalidate: Callable[[str], None], clear: Callable[[], None]):
+        """
+
+        :param redis: Redis connection
+        :param invalidate: called with the user id of each invalidation message from other processes
+        :param clear: called when (re-)connecting; messages might have been missed
+        """
+        super().__init__(name='token-invalidation', daemon=True)
+        self.redis = redis
+        self.invalidate = invalidate
+        self.clear = clear
+
+    def run(self) -> None:
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                self.clear()
+                log.debug(f'listening for invalidations on {CHANNEL}')
+                for message in pubsub.listen():
+                    origin, _, user_id = message['data'].decode().partition(' ')
+                    if origin != PROCESS_ID:
+                        log.debug(f'invalidating token of {user_id}')
+                        self.invalidate(user_id)
+            except (ConnectionError, TimeoutError) as e:
+                log.warning(f'lost connection to Redis: {e}')
+                time.sleep(self.RECONNECT_INTERVAL)
+            except Exception as e:
+                # w/o this thread tokens written by other processes are never invalidated; re-subscribing also
+                # clears the cache
+                log.exception(f'listener failed: {e}')
+                time.sleep(self.RECONNECT_INTERVAL)
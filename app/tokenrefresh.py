@@ -0,0 +1,138 @@
+"""
+Single-flight coordination of access token refreshes.
+
+Refreshes of the token of a user are deduplicated at two levels: within a process all callers share the future of the
+refresh in flight; across processes the refresh is serialized by a Redis lock and the refresh function is expected to
+re-read the token after acquiring the lock (another process might just have refreshed it). Refreshes run on a small
+thread pool so that asyncio callers never block their loop. A scanner thread triggers refreshes proactively for tokens
+which are about to expire.
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from redis import Redis
+from redis.exceptions import LockError, RedisError
+
+log = logging.getLogger(__name__)
+
+
+class RefreshCoordinator:
+    """
+    Coordinates token refreshes of all threads and loops of a process
+    """
+    # the Redis lock expires after this many seconds in case the lock holder dies
+    LOCK_TIMEOUT = 30
+    # max wait time for the Redis lock; after that the refresh is attempted anyway
+    LOCK_WAIT = 40
+    # interval in seconds between scans for tokens to refresh proactively
+    SCAN_INTERVAL = 30
+    # number of threads executing refreshes
+    WORKERS = 4
+
+    def __init__(self, refresh: Callable[[str], Any], due: Callable[[], Iterable[str]]):
+        """
+
+        :param refresh: called with a user id while holding the lock of that user; has to re-read the token, refresh
+            it if (still) needed, and return the token
+        :param due: returns the user ids of tokens to be refreshed proactively
+        """
+        self._refresh = refresh
+        self.due = due
+        self.pending: Dict[str, Future] = dict()
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=self.WORKERS, thread_name_prefix='token-refresh')
+        self._redis: Optional[Redis] = None
+        self.scanner: Optional[threading.Thread] = None
+
+    def set_redis(self, redis: Redis) -> None:
+        """
+        Set the Redis connection used for locking and start the proactive refresh
+        :param redis: Redis connection
+        :return: None
+        """
+        self._redis = redis
+        if self.scanner is None:
+            self.scanner = threading.Thread(target=self._scan, name='token-refresh-scanner', daemon=True)
+            self.scanner.start()
+
+    @staticmethod
+    def lock_key(user_id: str) -> str:
+        return f'Token:refresh-lock:{user_id}'
+
+    def submit(self, user_id: str) -> Future:
+        """
+        Get the future of the refresh in flight for a user; a new refresh is started if none is in flight
+        :param user_id: user id
+        :return: future with the refreshed token as result
+        """
+        with self.lock:
+            future = self.pending.get(user_id)
+            if future is not None:
+                return future
+            future = self.pending[user_id] = self.pool.submit(self._locked_refresh, user_id)
+        # outside of the lock: the callback is executed immediately if the future is already done
+        future.add_done_callback(lambda f: self._done(user_id, f))
+        return future
+
+    def _done(self, user_id: str, future: Future) -> None:
+        with self.lock:
+            if self.pending.get(user_id) is future:
+                del self.pending[user_id]
+
+    def refresh(self, user_id: str) -> Any:
+        """
+        Refresh the token of a user; blocks until the refresh is done
+        :param user_id: user id
+        :return: refreshed token
+        """
+        return self.submit(user_id).result()
+
+    async def arefresh(self, user_id: str) -> Any:
+        """
+        Refresh the token of a user; for use on asyncio loops
+        :param user_id: user id
+        :return: refreshed token
+        """
+        return await asyncio.wrap_future(self.submit(user_id))
+
+    def _locked_refresh(self, user_id: str) -> Any:
+        lock = self._redis.lock(self.lock_key(user_id), timeout=self.LOCK_TIMEOUT, blocking_timeout=self.LOCK_WAIT)
+        try:
+            locked = lock.acquire()
+        except RedisError as e:
+            log.warning(f'failed to lock {self.lock_key(user_id)}: {e}')
+            locked = False
+        if not locked:
+            log.warning(f'refreshing token of {user_id} w/o lock')
+        try:
+            return self._refresh(user_id)
+        finally:
+            if locked:
+                try:
+                    lock.release()
+                except LockError:
+                    # lock expired while refreshing
+                    log.warning(f'lock {self.lock_key(user_id)} expired during refresh')
+                except RedisError as e:
+                    # the lock expires anyway
+                    log.warning(f'failed to release {self.lock_key(user_id)}: {e}')
+
+    def _scan(self) -> None:
+        while True:
+            time.sleep(self.SCAN_INTERVAL)
+            try:
+                for user_id in self.due():
+                    log.debug(f'proactive refresh: {user_id}')
+                    self.submit(user_id).add_done_callback(self._log_error)
+            except Exception as e:
+                log.error(f'proactive refresh failed: {e}')
+
+    @staticmethod
+    def _log_error(future: Future) -> None:
+        e = future.exception()
+        if e is not None:
+            log.error(f'proactive refresh failed: {e}')
@@ -3,13 +3,28 @@ Basic asynchronous Webex Teams API helper.
 """
 from logging import getLogger
 import asyncio
+import functools
+import os
+import time
+from collections import namedtuple
 from dataclasses import dataclass
-from typing import Optional, List, AsyncIterator, Tuple, Dict, Callable
+from typing import Optional, List, AsyncIterator, Tuple, Dict, Callable, Sequence, Type
+from urllib.parse import urlsplit
 
 import webexteamssdk
 from webexteamssdk.models.immutable import ImmutableData
 import aiohttp
 
+try:
+    # optional: faster JSON parsing of response bodies
+    import orjson
+except ImportError:
+    orjson = None
+
+from . import ratelimit
+from .concurrency import AdaptiveLimit
+from .ratelimit import RateLimiter
+
 log = getLogger(__name__)
 
 
@@ -28,28 +43,105 @@ class MeetingInfo:
     callInTollNumber: str
 
 
+@functools.lru_cache(maxsize=None)
+def record_type(name: str, fields: Tuple[str, ...]) -> Type[tuple]:
+    """
+    Compact record type (named tuple: no per instance __dict__) with the given fields
+    :param name: type name
+    :param fields: field names
+    :return: record type
+    """
+    return namedtuple(f'{name}Record', fields)
+
+
+def record_factory(name: str, fields: Sequence[str]) -> Callable[[Dict], tuple]:
+    """
+    Factory for pagination() creating compact records only holding the given fields of each returned object.
+    Missing fields are set to None.
+    :param name: type name
+    :param fields: field names
+    :return: factory
+    """
+    fields = tuple(fields)
+    make = record_type(name, fields)._make
+    return lambda d: make(map(d.get, fields))
+
+
+class ConnectionPool:
+    """
+    Process wide pool of aiohttp client sessions. aiohttp sessions are bound to an event loop; hence there is one
+    session (and connector) per loop which is shared by all WebexTeamsAsyncAPI instances on that loop. The connector
+    keeps connections alive so that TCP and TLS handshakes are amortized across jobs.
+    """
+    # max number of connections per loop
+    LIMIT = 200
+    # max number of connections to the same host per loop
+    LIMIT_PER_HOST = 100
+    # DNS lookups are cached for this many seconds
+    DNS_CACHE_TTL = 300
+    # idle connections are kept open for this many seconds
+    KEEPALIVE_TIMEOUT = 60
+
+    _sessions: Dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+
+    @staticmethod
+    def session() -> aiohttp.ClientSession:
+        """
+        Get the shared session for the running loop. The session is created on first use.
+        :return: shared session
+        """
+        loop = asyncio.get_running_loop()
+        session = ConnectionPool._sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=ConnectionPool.LIMIT,
+                                             limit_per_host=ConnectionPool.LIMIT_PER_HOST,
+                                             use_dns_cache=True,
+                                             ttl_dns_cache=ConnectionPool.DNS_CACHE_TTL,
+                                             keepalive_timeout=ConnectionPool.KEEPALIVE_TIMEOUT)
+            session = aiohttp.ClientSession(connector=connector)
+            ConnectionPool._sessions[loop] = session
+            log.debug(f'ConnectionPool: new session for loop {id(loop):x}')
+        return session
+
+    @staticmethod
+    async def close() -> None:
+        """
+        Close the shared session of the running loop
+        :return: None
+        """
+        session = ConnectionPool._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+
 class WebexTeamsAsyncAPI:
     """
     Basis asynchronous Webex Teams API handler
     """
-    BASE = 'https://api.ciscospark.com/v1'
+    # WEBEX_BASE_URL allows to point the API to a different server; e.g. the mock server in bench/
+    BASE = f"{os.getenv('WEBEX_BASE_URL', 'https://api.ciscospark.com')}/v1"
     RETRIES_ON_CLIENT_CONNECTOR_ERRORS = 3
     RETRIES_ON_502 = 3
+    # initial concurrency limit per endpoint family; adjusted at runtime (see concurrency.AdaptiveLimit)
     CONCURRENT_REQUESTS = 100
+    MAX_CONCURRENT_REQUESTS = 500
     MAX_WAIT_ON_429 = 20
 
     def __init__(self, access_token: str, base=BASE, concurrent_requests=CONCURRENT_REQUESTS,
-                 session: aiohttp.ClientSession = None):
+                 session: aiohttp.ClientSession = None, rate_limiter: RateLimiter = None,
+                 max_concurrent_requests=MAX_CONCURRENT_REQUESTS):
         self.access_token = access_token
-        # semaphore to limit number of concurrent requests against the Webex Teams API
-        self.semaphore = asyncio.Semaphore(concurrent_requests)
+        # adaptive limits for the number of concurrent requests against the Webex Teams API; one per endpoint family
+        self.concurrent_requests = concurrent_requests
+        self.max_concurrent_requests = max_concurrent_requests
+        self.limits: Dict[str, AdaptiveLimit] = dict()
         self.base = base
-        if session is None:
-            self.session = aiohttp.ClientSession()
-            self.close_session = True
-        else:
-            self.session = session
-            self.close_session = False
+        self.base_path = urlsplit(base).path.rstrip('/')
+        # rate limiter shared with all other API instances
+        self.rate_limiter = ratelimit.rate_limiter if rate_limiter is None else rate_limiter
+        # if no session is passed then the API borrows the shared session of the running loop
+        self.session = ConnectionPool.session() if session is None else session
+        self.close_session = False
 
     async def close(self):
         s = self.session
@@ -79,10 +171,42 @@ class WebexTeamsAsyncAPI:
         """
         return {'Authorization': self.bearer}
 
+    def endpoint_family(self, url: str) -> str:
+        """
+        Endpoint family of an URL: 1st path element after the base path; rooms, messages, memberships, ...
+        :param url: URL
+        :return: endpoint family
+        """
+        path = urlsplit(url).path
+        if path.startswith(self.base_path):
+            path = path[len(self.base_path):]
+        return path.strip('/').split('/', 1)[0]
+
+    def concurrency_limit(self, family: str) -> AdaptiveLimit:
+        """
+        Adaptive concurrency limit for an endpoint family
+        :param family: endpoint family
+        :return: limit
+        """
+        limit = self.limits.get(family)
+        if limit is None:
+            limit = self.limits[family] = AdaptiveLimit(initial=self.concurrent_requests,
+                                                        max_limit=self.max_concurrent_requests,
+                                                        name=family)
+        return limit
+
+    @property
+    def concurrency_limits(self) -> Dict[str, int]:
+        """
+        Current concurrency limits by endpoint family; for monitoring
+        """
+        return {family: limit.limit for family, limit in self.limits.items()}
+
     async def request(self, method: str, url: str, **kwargs) -> Tuple[aiohttp.ClientResponse, dict]:
         """
         Execute one API request. Return the response and the JSON body as dict. Handles 429 and
-        spurious ClientConnectorErrors
+        spurious ClientConnectorErrors. Latency and congestion signals (429, 502) of each request adjust the
+        concurrency limit of the endpoint family.
         :param method: GET, POST, PUT, ...
         :param url: url to access
         :param kwargs: additional arguments for aiohttp.request
@@ -92,11 +216,20 @@ class WebexTeamsAsyncAPI:
         headers.update(self.auth_header)
         client_connector_errors = 0
         status_502 = 0
+        family = self.endpoint_family(url)
+        limit = self.concurrency_limit(family)
         while True:
+            # rate limiting is shared by all tasks using the same token and endpoint family
+            await self.rate_limiter.acquire(self.access_token, family)
             # limit the number of concurrent requests
-            async with self.semaphore:
+            async with limit:
                 try:
+                    start = time.monotonic()
                     async with self.session.request(method, url, ssl=False, headers=headers, **kwargs) as r:
+                        if r.status in (429, 502):
+                            limit.congestion(f'got {r.status}')
+                        else:
+                            limit.success(time.monotonic() - start)
                         if r.status == 502:
                             # sometimes requests simply fail... Retry
                             status_502 += 1
@@ -109,6 +242,8 @@ class WebexTeamsAsyncAPI:
                             r.raise_for_status()
                             if r.status == 204:
                                 data = dict()
+                            elif orjson is not None:
+                                data = orjson.loads(await r.read())
                             else:
                                 data = await r.json()
                             break
@@ -122,15 +257,16 @@ class WebexTeamsAsyncAPI:
                         continue
                     raise
 
-            # async with WebexTeamsAsyncAPI.semaphore
+            # async with limit
             # on 429 we need to wait some time and then retry
-            # waiting has to happen outside of the context protected by the semaphore: we don't want to block
-            # other tasks while we are waiting
+            # waiting has to happen outside of the context protected by the limit: we don't want to block
+            # other tasks while we are waiting. Instead of sleeping here the rate limiter pauses the token/endpoint
+            # family for all tasks in the process; the next acquire() then waits until Retry-After has passed
             retry_after = int(r.headers.get('Retry-After', '5')) or 1
             # never wait more than the defined maximum
             retry_after = min(retry_after, WebexTeamsAsyncAPI.MAX_WAIT_ON_429)
             log.warning(f'got 429: waiting for {retry_after} seconds, {method} {url} ')
-            await asyncio.sleep(retry_after)
+            self.rate_limiter.pause(self.access_token, family, retry_after)
         # while True
         return r, data
 
@@ -162,16 +298,14 @@ class WebexTeamsAsyncAPI:
         """
         return f'{self.base}/{domain}'
 
-    async def pagination(self, url: str, params: dict,
-                         factory: Callable[[Dict], ImmutableData]) -> AsyncIterator[ImmutableData]:
+    async def _pages(self, url: str, params: dict, factory: Callable[[Dict], ImmutableData],
+                     running: Optional[Callable[[], bool]]) -> AsyncIterator[List[ImmutableData]]:
         """
-        Async iterator handling RFC5988 pagination of list requests
-        :param url: start url for 1st GET
-        :param params: params to be passed to initial GET; subsequent GETs are parameterized through next URL
-        :param factory: factory method to create instances of returned objects
-        :return: object instances created by factory
+        Async iterator handling RFC5988 pagination of list requests; returns one list of objects per page
         """
         while url:
+            if running is not None and not running():
+                return
             log.debug(f'{self}.pagination: getting {url}')
             r, data = await self.request('GET', url, params=params)
 
@@ -184,22 +318,95 @@ class WebexTeamsAsyncAPI:
             except KeyError:
                 url = None
             # return all items
-            for i in data['items']:
-                r = factory(i)
-                yield r
-            # for
+            yield [factory(i) for i in data['items']]
         # while
         return
 
+    async def pages(self, url: str, params: dict, factory: Callable[[Dict], ImmutableData],
+                    read_ahead: int = 0,
+                    running: Optional[Callable[[], bool]] = None) -> AsyncIterator[List[ImmutableData]]:
+        """
+        Async iterator handling RFC5988 pagination of list requests; returns one list of objects per page.
+        With read ahead the next page is requested by a background task as soon as the next URL of the previous
+        page is known; at most read_ahead pages are fetched before the consumer gets to them.
+        :param url: start url for 1st GET
+        :param params: params to be passed to initial GET; subsequent GETs are parameterized through next URL
+        :param factory: factory method to create instances of returned objects
+        :param read_ahead: max number of pages to prefetch; 0: no prefetching
+        :param running: no more pages are fetched once this returns False
+        :return: lists of object instances created by factory
+        """
+        if read_ahead <= 0:
+            async for page in self._pages(url, params, factory, running):
+                yield page
+            return
+
+        # None signals the end of pagination; exceptions are passed to the consumer
+        queue: asyncio.Queue = asyncio.Queue(maxsize=read_ahead)
+
+        async def producer() -> None:
+            try:
+                async for page in self._pages(url, params, factory, running):
+                    await queue.put(page)
+            except Exception as e:
+                await queue.put(e)
+                return
+            await queue.put(None)
+
+        task = asyncio.create_task(producer())
+        try:
+            while True:
+                page = await queue.get()
+                if page is None:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                yield page
+        finally:
+            # consumer is done or has stopped early
+            task.cancel()
+
+    async def pagination(self, url: str, params: dict,
+                         factory: Callable[[Dict], ImmutableData],
+                         read_ahead: int = 0,
+                         running: Optional[Callable[[], bool]] = None) -> AsyncIterator[ImmutableData]:
+        """
+        Async iterator handling RFC5988 pagination of list requests
+        :param url: start url for 1st GET
+        :param params: params to be passed to initial GET; subsequent GETs are parameterized through next URL
+        :param factory: factory method to create instances of returned objects
+        :param read_ahead: max number of pages to prefetch; see pages()
+        :param running: no more pages are fetched once this returns False
+        :return: object instances created by factory
+        """
+        async for page in self.pages(url, params, factory, read_ahead=read_ahead, running=running):
+            for r in page:
+                yield r
+        return
+
+    @staticmethod
+    def _factory(factory: Callable[[Dict], ImmutableData],
+                 fields: Optional[Sequence[str]]) -> Callable[[Dict], ImmutableData]:
+        """
+        Factory for list methods: if fields are given then compact records only holding these fields are created
+        instead of full SDK objects
+        """
+        if not fields:
+            return factory
+        return record_factory(factory.__name__, fields)
+
     # Spaces
     @property
     def rooms_endpoint(self):
         return self.endpoint('rooms')
 
-    def list_spaces(self, p_max: Optional[int] = None) -> AsyncIterator[webexteamssdk.Room]:
+    def list_spaces(self, p_max: Optional[int] = None, read_ahead: int = 0,
+                    fields: Optional[Sequence[str]] = None,
+                    running: Optional[Callable[[], bool]] = None) -> AsyncIterator[webexteamssdk.Room]:
         url = self.rooms_endpoint
         params = {k[2:]: v for k, v in locals().items() if k.startswith('p_') and v is not None}
-        return self.pagination(url=url, params=params, factory=webexteamssdk.Room)
+        factory = self._factory(webexteamssdk.Room, fields)
+        return self.pagination(url=url, params=params, factory=factory, read_ahead=read_ahead, running=running)
 
     async def create_space(self, p_title: str, p_teamId: Optional[str] = None) -> webexteamssdk.Room:
         url = self.rooms_endpoint
@@ -235,10 +442,13 @@ class WebexTeamsAsyncAPI:
 
     def list_memberships(self, p_roomId: Optional[str] = None, p_personId: Optional[str] = None,
                          p_personEmail: Optional[str] = None,
-                         p_max: Optional[int] = None) -> AsyncIterator[webexteamssdk.Membership]:
+                         p_max: Optional[int] = None, read_ahead: int = 0,
+                         fields: Optional[Sequence[str]] = None,
+                         running: Optional[Callable[[], bool]] = None) -> AsyncIterator[webexteamssdk.Membership]:
         url = self.membership_endpoint
         params = {k[2:]: v for k, v in locals().items() if k.startswith('p_') and v is not None}
-        return self.pagination(url=url, params=params, factory=webexteamssdk.Membership)
+        factory = self._factory(webexteamssdk.Membership, fields)
+        return self.pagination(url=url, params=params, factory=factory, read_ahead=read_ahead, running=running)
 
     async def create_membership(self, p_roomId: str, p_personId: Optional[str] = None,
                                 p_personEmail: Optional[str] = None,
@@ -269,10 +479,13 @@ class WebexTeamsAsyncAPI:
 
     def list_people(self, p_email: Optional[str] = None, p_displayName: Optional[str] = None,
                     p_id: Optional[str] = None,
-                    p_orgId: Optional[str] = None, p_max: Optional[int] = None) -> AsyncIterator[webexteamssdk.Person]:
+                    p_orgId: Optional[str] = None, p_max: Optional[int] = None, read_ahead: int = 0,
+                    fields: Optional[Sequence[str]] = None,
+                    running: Optional[Callable[[], bool]] = None) -> AsyncIterator[webexteamssdk.Person]:
         url = self.people_endpoint
         params = {k[2:]: v for k, v in locals().items() if k.startswith('p_') and v is not None}
-        return self.pagination(url=url, params=params, factory=webexteamssdk.Person)
+        factory = self._factory(webexteamssdk.Person, fields)
+        return self.pagination(url=url, params=params, factory=factory, read_ahead=read_ahead, running=running)
 
     async def create_person(self, p_emails: List[str], p_displayName: Optional[str] = None,
                             p_firstName: Optional[str] = None,
@@ -319,9 +532,13 @@ class WebexTeamsAsyncAPI:
                       p_mentionedPeople: Optional[List[str]] = None,
                       p_before: Optional[str] = None,
                       p_beforeMessage: Optional[str] = None,
-                      p_max: Optional[int] = None) -> AsyncIterator[webexteamssdk.Message]:
+                      p_max: Optional[int] = None, read_ahead: int = 0,
+                      fields: Optional[Sequence[str]] = None,
+                      running: Optional[Callable[[], bool]] = None) -> AsyncIterator[webexteamssdk.Message]:
         params = {k[2:]: v for k, v in locals().items() if k.startswith('p_') and v is not None}
-        return self.pagination(url=self.messages_endpoint, params=params, factory=webexteamssdk.Message)
+        factory = self._factory(webexteamssdk.Message, fields)
+        return self.pagination(url=self.messages_endpoint, params=params, factory=factory, read_ahead=read_ahead,
+                               running=running)
 
     def list_direct_messages(self, p_personId: Optional[str] = None,
                              p_personEmail: Optional[str] = None) -> AsyncIterator[webexteamssdk.Message]:
@@ -0,0 +1,196 @@
+"""
+End-to-end load benchmark.
+
+Drives a number of simulated browser clients against a running app instance: each client logs in through the OAuth
+flow (against the mock Webex API, see bench/mockwebex.py), connects via socket.io, starts a job, and collects the
+output of the job. Reports latency percentiles (job start to first output and to end of job), output lines and bytes
+per second, the number of structured events, and the requests per second the mock API has seen.
+
+    python -m bench.mockwebex --port 8090 --latency 0.02 --p429 0.01 --p502 0.01 &
+    WEBEX_BASE_URL=http://localhost:8090 CLIENT_ID=mock CLIENT_SECRET=mock SCOPE=spark:all \\
+        REDIRECT_URI=http://localhost:5000/redirect python test.py &
+    python -m bench.loadtest --clients 20 --job space_stats
+
+Results are printed as JSON (and optionally written to a file) so that runs can be compared.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import time
+from typing import List, Optional
+
+import aiohttp
+import socketio
+
+log = logging.getLogger(__name__)
+
+# start events by job name
+JOBS = {
+    'space_stats': 'start_space_stats',
+    'create_spaces': 'start_create_spaces',
+    'delete_spaces': 'start_delete_spaces',
+}
+
+
+def percentiles(values: List[float]) -> Optional[dict]:
+    """
+    Nearest rank percentiles of a list of values
+    """
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(p: float) -> float:
+        return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+    return dict(p50=round(rank(50), 4), p90=round(rank(90), 4), p99=round(rank(99), 4), max=round(values[-1], 4))
+
+
+class SimulatedClient:
+    """
+    A browser running a single job
+    """
+
+    def __init__(self, app_url: str, job: str, duration: Optional[float]):
+        """
+
+        :param app_url: base URL of the app
+        :param job: job to run; see JOBS
+        :param duration: stop the job after this many seconds; None: wait for the job to end
+        """
+        self.app_url = app_url
+        self.job = job
+        self.duration = duration
+        self.lines = 0
+        self.bytes = 0
+        # structured events (progress, rows, metrics)
+        self.events = 0
+        self.batches = 0
+        self.started: Optional[float] = None
+        self.first_output: Optional[float] = None
+        self.ended: Optional[float] = None
+        self.error: Optional[str] = None
+        self.done = asyncio.Event()
+
+    async def login(self, http: aiohttp.ClientSession) -> None:
+        """
+        Run the OAuth flow: the app redirects to the (mock) authorize endpoint which redirects back to the app
+        """
+        async with http.get(self.app_url) as r:
+            r.raise_for_status()
+
+    def on_output_batch(self, batch: dict) -> None:
+        now = time.monotonic()
+        self.batches += 1
+        self.events += len(batch.get('events') or ())
+        if batch['data']:
+            self.lines += len(batch['data'])
+            self.bytes += sum(len(line) for line in batch['data'])
+            if self.first_output is None:
+                self.first_output = now
+        if batch.get('end'):
+            self.ended = now
+            self.done.set()
+
+    async def run(self, timeout: float) -> None:
+        jar = aiohttp.CookieJar(unsafe=True)
+        async with aiohttp.ClientSession(cookie_jar=jar) as http:
+            await self.login(http)
+            cookie = '; '.join(f'{c.key}={c.value}' for c in jar)
+        sio = socketio.AsyncClient(reconnection=False)
+        sio.on('output_batch', self.on_output_batch)
+        await sio.connect(self.app_url, headers={'Cookie': cookie}, transports=['websocket'])
+        try:
+            self.started = time.monotonic()
+            await sio.emit(JOBS[self.job])
+            if self.duration is not None:
+                try:
+                    await asyncio.wait_for(self.done.wait(), self.duration)
+                except asyncio.TimeoutError:
+                    await sio.emit('stop_request')
+            await asyncio.wait_for(self.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.error = 'timeout'
+        finally:
+            await sio.disconnect()
+
+    @property
+    def latency(self) -> Optional[float]:
+        return None if self.ended is None else self.ended - self.started
+
+    @property
+    def first_output_latency(self) -> Optional[float]:
+        return None if self.first_output is None else self.first_output - self.started
+
+
+async def mock_stats(mock_url: Optional[str], reset: bool = False) -> Optional[dict]:
+    if not mock_url:
+        return None
+    async with aiohttp.ClientSession() as http:
+        if reset:
+            async with http.post(f'{mock_url}/_stats/reset') as r:
+                r.raise_for_status()
+        async with http.get(f'{mock_url}/_stats') as r:
+            r.raise_for_status()
+            return await r.json()
+
+
+async def run(args) -> dict:
+    clients = [SimulatedClient(args.app, args.job, args.duration) for _ in range(args.clients)]
+    await mock_stats(args.mock, reset=True)
+    started = time.monotonic()
+    results = await asyncio.gather(*[c.run(args.timeout) for c in clients], return_exceptions=True)
+    elapsed = time.monotonic() - started
+    api = await mock_stats(args.mock)
+    errors = [repr(r) for r in results if isinstance(r, Exception)] + [c.error for c in clients if c.error]
+    lines = sum(c.lines for c in clients)
+    output_bytes = sum(c.bytes for c in clients)
+    report = dict(
+        job=args.job,
+        clients=args.clients,
+        elapsed=round(elapsed, 3),
+        completed=sum(1 for c in clients if c.ended is not None),
+        errors=errors,
+        latency=percentiles([c.latency for c in clients if c.latency is not None]),
+        first_output_latency=percentiles([c.first_output_latency for c in clients
+                                          if c.first_output_latency is not None]),
+        lines=lines,
+        lines_per_second=round(lines / elapsed, 1),
+        bytes_per_second=round(output_bytes / elapsed, 1),
+        events=sum(c.events for c in clients),
+        batches=sum(c.batches for c in clients),
+    )
+    if api is not None:
+        report['api'] = dict(requests=api['requests'], requests_per_second=round(api['requests'] / elapsed, 1),
+                             status=api['status'], by_endpoint=api['by_endpoint'])
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end load benchmark')
+    parser.add_argument('--app', default='http://localhost:5000', help='base URL of the app')
+    parser.add_argument('--mock', default='http://localhost:8090',
+                        help='base URL of the mock Webex API; empty to skip API stats')
+    parser.add_argument('--clients', type=int, default=10, help='number of simulated clients')
+    parser.add_argument('--job', choices=sorted(JOBS), default='space_stats', help='job to run')
+    parser.add_argument('--duration', type=float, default=None,
+                        help='stop jobs after this many seconds; default: wait for jobs to end')
+    parser.add_argument('--timeout', type=float, default=300, help='max time to wait for the end of a job')
+    parser.add_argument('--output', default=None, help='also write the JSON report to this file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.job == 'create_spaces' and args.duration is None:
+        parser.error('create_spaces runs until stopped: --duration is required')
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+"""
+Mock Webex API server for benchmarks.
+
+Serves the subset of the Webex API used by the app: OAuth (authorize, access_token), people, rooms, memberships, and
+messages. List requests are paginated with RFC5988 Link headers. A configurable share of the requests fails with
+429 (with Retry-After) or 502 and each request can be delayed to simulate API latency.
+
+Data is generated from a seed: each user logging in through the mock OAuth flow is a new person of the mock org and
+gets its own set of spaces with a varying number of messages. Spaces, memberships, and messages created through the
+API are kept in memory.
+
+Point the app to the mock server by setting WEBEX_BASE_URL, e.g.:
+
+    python -m bench.mockwebex --port 8090
+    WEBEX_BASE_URL=http://localhost:8090 python test.py
+
+GET /_stats returns request counters; POST /_stats/reset resets them.
+"""
+import argparse
+import asyncio
+import logging
+import random
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from urllib.parse import urlencode
+
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+ORG_ID = 'mock-org'
+# timestamp of the newest generated message
+NOW = datetime(2020, 6, 1, tzinfo=timezone.utc)
+
+
+def timestamp(dt: datetime) -> str:
+    return f'{dt:%Y-%m-%dT%H:%M:%S}.{dt.microsecond // 1000:03d}Z'
+
+
+class MockData:
+    """
+    In memory data of the mock server
+    """
+
+    def __init__(self, seed: int, people: int, spaces: int, messages: int):
+        """
+
+        :param seed: seed for the generated data
+        :param people: number of people in the org (not counting users logged in)
+        :param spaces: number of spaces per user
+        :param messages: average number of messages per space
+        """
+        self.seed = seed
+        self.spaces_per_user = spaces
+        self.messages_per_space = messages
+        self.people: List[dict] = [self._person(f'person-{i}', f'Person {i}') for i in range(people)]
+        self.people_by_id: Dict[str, dict] = {p['id']: p for p in self.people}
+        # person id by access/refresh token and authorization code
+        self.tokens: Dict[str, str] = dict()
+        self.codes: Dict[str, str] = dict()
+        self.users = 0
+        # space ids by user id; spaces by id; messages by space id (newest first); memberships by space id
+        self.user_spaces: Dict[str, List[str]] = dict()
+        self.spaces: Dict[str, dict] = dict()
+        self.messages: Dict[str, List[dict]] = dict()
+        self.memberships: Dict[str, Dict[str, dict]] = dict()
+
+    @staticmethod
+    def _person(person_id: str, name: str) -> dict:
+        return dict(id=person_id, displayName=name, emails=[f'{person_id}@mock.example.com'], orgId=ORG_ID,
+                    type='person', created=timestamp(NOW))
+
+    def new_user(self) -> str:
+        """
+        Create a user with a set of generated spaces
+        :return: authorization code of the user
+        """
+        self.users += 1
+        person = self._person(f'user-{self.users}', f'User {self.users}')
+        self.people.append(person)
+        self.people_by_id[person['id']] = person
+        rnd = random.Random(f'{self.seed}-{person["id"]}')
+        for i in range(self.spaces_per_user):
+            space = self.create_space(person['id'], f'Space {i} of {person["displayName"]}')
+            # number of messages varies between 0 and twice the average
+            count = rnd.randint(0, 2 * self.messages_per_space)
+            created = NOW - timedelta(days=rnd.randint(1, 1000))
+            space['created'] = timestamp(created)
+            step = (NOW - created) / (count + 1)
+            self.messages[space['id']] = [
+                dict(id=f'{space["id"]}-m{j}', roomId=space['id'], roomType='group', text=f'message {j}',
+                     personId=person['id'], created=timestamp(NOW - step * (count - j)))
+                for j in reversed(range(count))]
+            if count:
+                space['lastActivity'] = self.messages[space['id']][0]['created']
+        code = uuid.uuid4().hex
+        self.codes[code] = person['id']
+        return code
+
+    def create_space(self, person_id: str, title: str) -> dict:
+        space_id = f'space-{uuid.uuid4().hex}'
+        created = timestamp(datetime.now(timezone.utc))
+        space = dict(id=space_id, title=title, type='group', isLocked=False, lastActivity=created,
+                     creatorId=person_id, created=created)
+        self.spaces[space_id] = space
+        self.messages[space_id] = []
+        self.memberships[space_id] = dict()
+        self.user_spaces.setdefault(person_id, []).append(space_id)
+        self.add_membership(space_id, person_id)
+        return space
+
+    def add_membership(self, space_id: str, person_id: str) -> Optional[dict]:
+        """
+        Add a person to a space
+        :return: membership; None if the person already is a member
+        """
+        members = self.memberships[space_id]
+        if person_id in members:
+            return None
+        person = self.people_by_id.get(person_id) or self._person(person_id, person_id)
+        membership = members[person_id] = dict(
+            id=f'{space_id}:{person_id}', roomId=space_id, personId=person_id,
+            personEmail=person['emails'][0], personDisplayName=person['displayName'], personOrgId=ORG_ID,
+            isModerator=False, created=timestamp(datetime.now(timezone.utc)))
+        return membership
+
+    def issue_tokens(self, person_id: str) -> dict:
+        access_token = f'mock-access-{uuid.uuid4().hex}'
+        refresh_token = f'mock-refresh-{uuid.uuid4().hex}'
+        self.tokens[access_token] = person_id
+        self.tokens[refresh_token] = person_id
+        return dict(access_token=access_token, expires_in=14 * 24 * 3600, refresh_token=refresh_token,
+                    refresh_token_expires_in=90 * 24 * 3600)
+
+
+class MockWebex:
+    """
+    aiohttp application serving the mock API
+    """
+
+    def __init__(self, data: MockData, p429: float = 0.0, p502: float = 0.0, retry_after: int = 1,
+                 latency: float = 0.0):
+        """
+
+        :param data: data to serve
+        :param p429: share of API requests failing with 429
+        :param p502: share of API requests failing with 502
+        :param retry_after: Retry-After in seconds sent with 429s
+        :param latency: average latency in seconds added to each API request
+        """
+        self.data = data
+        self.p429 = p429
+        self.p502 = p502
+        self.retry_after = retry_after
+        self.latency = latency
+        self.requests: Counter = Counter()
+        self.status: Counter = Counter()
+        self.started = time.monotonic()
+        self.app = web.Application(middlewares=[self.middleware])
+        self.app.add_routes([
+            web.get('/_stats', self.stats),
+            web.post('/_stats/reset', self.reset),
+            web.get('/v1/authorize', self.authorize),
+            web.post('/v1/access_token', self.access_token),
+            web.get('/v1/people', self.list_people),
+            web.get('/v1/people/me', self.me),
+            web.get('/v1/people/{id}', self.person),
+            web.get('/v1/rooms', self.list_rooms),
+            web.post('/v1/rooms', self.create_room),
+            web.get('/v1/rooms/{id}', self.room),
+            web.delete('/v1/rooms/{id}', self.delete_room),
+            web.get('/v1/memberships', self.list_memberships),
+            web.post('/v1/memberships', self.create_membership),
+            web.delete('/v1/memberships/{id}', self.delete_membership),
+            web.get('/v1/messages', self.list_messages),
+            web.post('/v1/messages', self.create_message),
+        ])
+
+    @web.middleware
+    async def middleware(self, request: web.Request, handler):
+        if request.path.startswith('/_stats'):
+            return await handler(request)
+        family = request.path.split('/')[2] if request.path.count('/') >= 2 else request.path
+        self.requests[f'{request.method} {family}'] += 1
+        if self.latency:
+            await asyncio.sleep(random.expovariate(1 / self.latency))
+        if not request.path.startswith(('/v1/authorize', '/v1/access_token')):
+            r = random.random()
+            if r < self.p429:
+                response = web.json_response(dict(message='Too Many Requests'), status=429,
+                                             headers={'Retry-After': str(self.retry_after)})
+            elif r < self.p429 + self.p502:
+                response = web.json_response(dict(message='Bad Gateway'), status=502)
+            else:
+                response = None
+            if response is not None:
+                self.status[response.status] += 1
+                return response
+        try:
+            response = await handler(request)
+        except web.HTTPException as e:
+            self.status[e.status] += 1
+            raise
+        self.status[response.status] += 1
+        return response
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(dict(requests=sum(self.requests.values()), by_endpoint=dict(self.requests),
+                                      status={str(k): v for k, v in self.status.items()},
+                                      elapsed=time.monotonic() - self.started))
+
+    async def reset(self, request: web.Request) -> web.Response:
+        self.requests.clear()
+        self.status.clear()
+        self.started = time.monotonic()
+        return web.json_response(dict())
+
+    def user(self, request: web.Request) -> str:
+        """
+        Person id of the user authenticated by the bearer token of a request
+        """
+        token = request.headers.get('Authorization', '').partition(' ')[2]
+        person_id = self.data.tokens.get(token)
+        if person_id is None:
+            raise web.HTTPUnauthorized(text='{"message": "invalid token"}', content_type='application/json')
+        return person_id
+
+    @staticmethod
+    def page(request: web.Request, items: list, default_max: int = 100) -> web.Response:
+        """
+        Paginated list response; the next page is referenced by a Link header
+        """
+        max_items = min(int(request.query.get('max', default_max)), 1000)
+        start = int(request.query.get('cursor', 0))
+        end = start + max_items
+        headers = dict()
+        if end < len(items):
+            query = dict(request.query)
+            query['cursor'] = str(end)
+            headers['Link'] = f'<{request.url.with_query(query)}>; rel="next"'
+        return web.json_response(dict(items=items[start:end]), headers=headers)
+
+    # OAuth
+    async def authorize(self, request: web.Request) -> web.Response:
+        # every authorization is a new user
+        code = self.data.new_user()
+        query = urlencode(dict(code=code, state=request.query.get('state', '')))
+        raise web.HTTPFound(f'{request.query["redirect_uri"]}?{query}')
+
+    async def access_token(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        if form.get('grant_type') == 'authorization_code':
+            person_id = self.data.codes.pop(form.get('code'), None)
+        else:
+            person_id = self.data.tokens.get(form.get('refresh_token'))
+        if person_id is None:
+            raise web.HTTPBadRequest(text='{"message": "invalid grant"}', content_type='application/json')
+        return web.json_response(self.data.issue_tokens(person_id))
+
+    # people
+    async def list_people(self, request: web.Request) -> web.Response:
+        self.user(request)
+        return self.page(request, self.data.people)
+
+    async def me(self, request: web.Request) -> web.Response:
+        return web.json_response(self.data.people_by_id[self.user(request)])
+
+    async def person(self, request: web.Request) -> web.Response:
+        self.user(request)
+        person = self.data.people_by_id.get(request.match_info['id'])
+        if person is None:
+            raise web.HTTPNotFound()
+        return web.json_response(person)
+
+    # rooms
+    async def list_rooms(self, request: web.Request) -> web.Response:
+        user_id = self.user(request)
+        spaces = [self.data.spaces[s] for s in self.data.user_spaces.get(user_id, []) if s in self.data.spaces]
+        if request.query.get('sortBy') == 'created':
+            spaces.sort(key=lambda s: s['created'], reverse=True)
+        elif request.query.get('sortBy') == 'lastactivity':
+            spaces.sort(key=lambda s: s['lastActivity'], reverse=True)
+        return self.page(request, spaces)
+
+    async def create_room(self, request: web.Request) -> web.Response:
+        user_id = self.user(request)
+        body = await request.json()
+        return web.json_response(self.data.create_space(user_id, body.get('title', '')))
+
+    async def room(self, request: web.Request) -> web.Response:
+        self.user(request)
+        space = self.data.spaces.get(request.match_info['id'])
+        if space is None:
+            raise web.HTTPNotFound()
+        return web.json_response(space)
+
+    async def delete_room(self, request: web.Request) -> web.Response:
+        self.user(request)
+        space_id = request.match_info['id']
+        space = self.data.spaces.pop(space_id, None)
+        if space is None:
+            raise web.HTTPNotFound()
+        self.data.user_spaces[space['creatorId']].remove(space_id)
+        self.data.messages.pop(space_id, None)
+        self.data.memberships.pop(space_id, None)
+        return web.Response(status=204)
+
+    # memberships
+    async def list_memberships(self, request: web.Request) -> web.Response:
+        self.user(request)
+        members = self.data.memberships.get(request.query.get('roomId'))
+        if members is None:
+            raise web.HTTPNotFound()
+        return self.page(request, list(members.values()))
+
+    async def create_membership(self, request: web.Request) -> web.Response:
+        self.user(request)
+        body = await request.json()
+        space_id = body.get('roomId')
+        if space_id not in self.data.spaces:
+            raise web.HTTPNotFound()
+        membership = self.data.add_membership(space_id, body.get('personId'))
+        if membership is None:
+            raise web.HTTPConflict(text='{"message": "already a member"}', content_type='application/json')
+        return web.json_response(membership)
+
+    async def delete_membership(self, request: web.Request) -> web.Response:
+        self.user(request)
+        space_id, _, person_id = request.match_info['id'].partition(':')
+        if self.data.memberships.get(space_id, dict()).pop(person_id, None) is None:
+            raise web.HTTPNotFound()
+        return web.Response(status=204)
+
+    # messages
+    async def list_messages(self, request: web.Request) -> web.Response:
+        self.user(request)
+        messages = self.data.messages.get(request.query.get('roomId'))
+        if messages is None:
+            raise web.HTTPNotFound()
+        if before := request.query.get('before'):
+            messages = [m for m in messages if m['created'] < before]
+        if before_message := request.query.get('beforeMessage'):
+            index = next((i for i, m in enumerate(messages) if m['id'] == before_message), None)
+            if index is None:
+                raise web.HTTPNotFound()
+            messages = messages[index + 1:]
+        return self.page(request, messages, default_max=50)
+
+    async def create_message(self, request: web.Request) -> web.Response:
+        user_id = self.user(request)
+        body = await request.json()
+        space_id = body.get('roomId')
+        messages = self.data.messages.get(space_id)
+        if messages is None:
+            raise web.HTTPNotFound()
+        created = timestamp(datetime.now(timezone.utc))
+        message = dict(id=f'{space_id}-m{uuid.uuid4().hex}', roomId=space_id, roomType='group',
+                       text=body.get('text') or body.get('markdown'), personId=user_id, created=created)
+        messages.insert(0, message)
+        self.data.spaces[space_id]['lastActivity'] = created
+        return web.json_response(message)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock Webex API server')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--seed', type=int, default=0, help='seed for the generated data')
+    parser.add_argument('--people', type=int, default=2000, help='number of people in the org')
+    parser.add_argument('--spaces', type=int, default=50, help='number of spaces per user')
+    parser.add_argument('--messages', type=int, default=200, help='average number of messages per space')
+    parser.add_argument('--p429', type=float, default=0.0, help='share of requests failing with 429')
+    parser.add_argument('--p502', type=float, default=0.0, help='share of requests failing with 502')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After of 429s in seconds')
+    parser.add_argument('--latency', type=float, default=0.0, help='average latency per request in seconds')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    data = MockData(seed=args.seed, people=args.people, spaces=args.spaces, messages=args.messages)
+    mock = MockWebex(data, p429=args.p429, p502=args.p502, retry_after=args.retry_after, latency=args.latency)
+    web.run_app(mock.app, host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+"""
+Microbenchmarks of the output path of jobs:
+
+    print -> stdoutproxy -> PipeIO.write -> output queue -> socketpair -> _pipe_processor -> OutputBatcher -> emit
+
+* pipeio: PipeIO.write on a native thread, frames drained by a FrameReader on the other end of the pipe
+* end_to_end: a FlaskThread job printing lines; measures throughput and the latency from print() to the emit of
+  the batch containing the line. Emits are recorded instead of being sent to socket.io clients
+* codec: encode_line -> FrameReader -> OutputBatcher.add on a single thread; transient (peak) and retained memory per
+  line measured with tracemalloc. CPython has no allocation counter: peak and retained memory are the best proxies
+* stdoutproxy: cost of a write through the stdout proxy on a thread w/o redirection compared to writing to the
+  target directly
+
+Each benchmark runs for a set of line lengths and line kinds: ascii, unicode (non-ASCII, multi byte UTF-8), and
+partial (lines written in small chunks followed by a separate \\n). Results are printed as JSON:
+
+    python -m bench.outputpath --lines 100000 --output result.json
+"""
+import argparse
+import json
+import logging
+import math
+import platform
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+from app import flaskthread, framing, outputqueue, stdoutproxy
+from app.flaskthread import FlaskThread, OutputBatcher, PipeIO
+
+log = logging.getLogger(__name__)
+
+KINDS = ('ascii', 'unicode', 'partial')
+# chunk size of partial writes
+PARTIAL_CHUNK = 7
+UNICODE_TEXT = 'äöü€ß✓😀'
+
+
+def make_line(seq: int, length: int, kind: str) -> str:
+    """
+    Line of a given length (in characters) starting with a sequence number
+    """
+    prefix = f'{seq:08d} '
+    fill = UNICODE_TEXT if kind == 'unicode' else 'x'
+    body = fill * (max(length - len(prefix), 0) // len(fill) + 1)
+    return (prefix + body)[:max(length, len(prefix))]
+
+
+def write_line(write: Callable[[str], int], line: str, kind: str) -> None:
+    if kind == 'partial':
+        for i in range(0, len(line), PARTIAL_CHUNK):
+            write(line[i:i + PARTIAL_CHUNK])
+        write('\n')
+    else:
+        write(f'{line}\n')
+
+
+def percentiles(values: List[float]) -> Optional[dict]:
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(p: float) -> float:
+        return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+    return {k: round(v * 1e3, 3) for k, v in
+            dict(p50_ms=rank(50), p90_ms=rank(90), p99_ms=rank(99), max_ms=values[-1]).items()}
+
+
+def bench_pipeio(lines: int, length: int, kind: str) -> dict:
+    """
+    PipeIO.write throughput; the other end of the pipe is drained by a FrameReader
+    """
+    text = [make_line(i, length, kind) for i in range(lines)]
+    s1, s2 = socket.socketpair()
+    pipe_io = PipeIO(s1, max_lines=FlaskThread.OUTPUT_QUEUE_LINES, policy=outputqueue.POLICY_BLOCK,
+                     name='bench')
+    received = 0
+    received_bytes = 0
+
+    def drain() -> None:
+        nonlocal received, received_bytes
+        reader = framing.FrameReader(s2)
+        while reader.read():
+            for frame_type, data in reader.frames():
+                if frame_type == framing.FRAME_END:
+                    return
+                received += 1
+                received_bytes += len(data.encode())
+
+    reader_thread = threading.Thread(target=drain)
+    reader_thread.start()
+    started = time.perf_counter()
+    for line in text:
+        write_line(pipe_io.write, line, kind)
+    pipe_io.shutdown()
+    reader_thread.join()
+    elapsed = time.perf_counter() - started
+    s2.close()
+    assert received == lines, f'received {received} of {lines} lines'
+    return dict(lines_per_second=round(lines / elapsed), bytes_per_second=round(received_bytes / elapsed),
+                elapsed=round(elapsed, 4))
+
+
+def bench_end_to_end(lines: int, length: int, kind: str) -> dict:
+    """
+    FlaskThread job printing lines; latency from print() to emit
+    """
+    text = [make_line(i, length, kind) for i in range(lines)]
+    printed = [0.0] * lines
+    emitted = [0.0] * lines
+    batches = 0
+    emitted_lines = 0
+    emitted_bytes = 0
+
+    def record(event, batch, room=None) -> None:
+        nonlocal batches, emitted_lines, emitted_bytes
+        now = time.perf_counter()
+        batches += 1
+        for line in batch['data']:
+            emitted[int(line[:8])] = now
+            emitted_lines += 1
+            emitted_bytes += len(line.encode())
+
+    def target(job_id: str, running: Callable[[], bool]) -> None:
+        write = sys.stdout.write
+        for i, line in enumerate(text):
+            printed[i] = time.perf_counter()
+            write_line(write, line, kind)
+
+    emit = flaskthread.socketio.emit
+    flaskthread.socketio.emit = record
+    try:
+        thread = FlaskThread.for_job(job_id=f'bench-{kind}-{length}', target=target)
+        # exact counts: block instead of dropping lines if the pipe processor falls behind. Fine for a thread target
+        thread.OUTPUT_OVERFLOW_POLICY = outputqueue.POLICY_BLOCK
+        started = time.perf_counter()
+        thread.start()
+        # run the eventlet hub (pipe processor) until the job has terminated
+        thread.green_thread.wait()
+        elapsed = time.perf_counter() - started
+    finally:
+        flaskthread.socketio.emit = emit
+    assert emitted_lines == lines, f'emitted {emitted_lines} of {lines} lines'
+    return dict(lines_per_second=round(lines / elapsed), bytes_per_second=round(emitted_bytes / elapsed),
+                elapsed=round(elapsed, 4), batches=batches,
+                latency=percentiles([e - p for p, e in zip(printed, emitted)]))
+
+
+class _BufferSocket:
+    """
+    Socket stand-in for FrameReader serving data from a bytes buffer
+    """
+
+    def __init__(self, data: bytes):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def recv_into(self, buffer) -> int:
+        n = min(len(buffer), len(self.data) - self.offset)
+        buffer[:n] = self.data[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+
+def bench_codec(lines: int, length: int, kind: str) -> dict:
+    """
+    Memory per line of encoding, decoding, and batching
+    """
+    # one batch worth of lines; larger batches would only measure the batch list
+    lines = min(lines, 1000)
+    text = [make_line(i, length, kind) for i in range(lines)]
+    batcher = OutputBatcher('bench', interval=FlaskThread.OUTPUT_BATCH_INTERVAL, max_bytes=sys.maxsize)
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        data = b''.join(map(framing.encode_line, text))
+        reader = framing.FrameReader(_BufferSocket(data))
+        while reader.read():
+            for _, line in reader.frames():
+                batcher.add(line)
+        del data, reader
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return dict(lines=lines, peak_bytes_per_line=round((peak - before) / lines, 1),
+                retained_bytes_per_line=round((current - before) / lines, 1))
+
+
+class _NullWriter:
+    def write(self, s: str) -> int:
+        return len(s)
+
+
+def bench_stdoutproxy(lines: int, length: int, kind: str) -> dict:
+    """
+    Overhead of the stdout proxy on a thread w/o redirection
+    """
+    text = [make_line(i, length, kind) for i in range(lines)]
+    sink = _NullWriter()
+    proxy = stdoutproxy.ContextStdout()
+    results: Dict[str, float] = dict()
+
+    def run() -> None:
+        for name, write in (('direct', sink.write), ('proxy', proxy.write)):
+            best = None
+            for _ in range(3):
+                started = time.perf_counter()
+                for line in text:
+                    write_line(write, line, kind)
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            results[name] = best
+
+    default_stdout = stdoutproxy._default_stdout
+    stdoutproxy._default_stdout = sink
+    try:
+        # other threads: the redirection is per context, a new thread has none
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+    finally:
+        stdoutproxy._default_stdout = default_stdout
+    writes = lines * (len(range(0, length, PARTIAL_CHUNK)) + 1 if kind == 'partial' else 1)
+    return dict(direct_ns_per_write=round(results['direct'] / writes * 1e9, 1),
+                proxy_ns_per_write=round(results['proxy'] / writes * 1e9, 1),
+                overhead_ns_per_write=round((results['proxy'] - results['direct']) / writes * 1e9, 1))
+
+
+BENCHMARKS = {
+    'pipeio': bench_pipeio,
+    'end_to_end': bench_end_to_end,
+    'codec': bench_codec,
+    'stdoutproxy': bench_stdoutproxy,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Output path microbenchmarks')
+    parser.add_argument('--lines', type=int, default=20000, help='number of lines per run')
+    parser.add_argument('--lengths', default='16,128,1024', help='comma separated line lengths (characters)')
+    parser.add_argument('--kinds', default=','.join(KINDS), help='comma separated line kinds')
+    parser.add_argument('--benchmarks', default=','.join(BENCHMARKS), help='comma separated benchmarks to run')
+    parser.add_argument('--output', default=None, help='also write the JSON report to this file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    lengths = [int(length) for length in args.lengths.split(',')]
+    results = []
+    for name in args.benchmarks.split(','):
+        for kind in args.kinds.split(','):
+            if name == 'codec' and kind == 'partial':
+                # partial writes are joined by PipeIO; the frames are the same as for ascii lines
+                continue
+            for length in lengths:
+                result = BENCHMARKS[name](args.lines, length, kind)
+                results.append(dict(dict(benchmark=name, kind=kind, length=length, lines=args.lines), **result))
+                print(f'{name} {kind} {length}: {result}', file=sys.stderr)
+    report = dict(python=sys.version.split()[0], platform=platform.platform(),
+                  settings=dict(batch_interval=FlaskThread.OUTPUT_BATCH_INTERVAL,
+                                batch_bytes=FlaskThread.OUTPUT_BATCH_BYTES),
+                  results=results)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
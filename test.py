@@ -9,11 +9,19 @@ from app import create_app, socketio
 from redis import Redis
 
 from app.interactive import Token
+from app.jobregistry import JobRegistry
+from app.outputlog import OutputLog
+from app.peopledirectory import PeopleDirectory
+from app.statscache import StatsCache
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     redis_session = Redis()
     Token.set_redis(redis_session)
+    StatsCache.set_redis(redis_session)
+    JobRegistry.set_redis(redis_session)
+    OutputLog.set_redis(redis_session)
+    PeopleDirectory.set_redis(redis_session)
     config = dict(
         SESSION_REDIS=redis_session
     )
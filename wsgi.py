@@ -1,6 +1,12 @@
 import logging
 import os
 
+# multiple app processes exchange socket.io messages via Redis; the message queue requires a green socket library.
+# Only sockets are patched: jobs keep running on native threads (see app/executor.py)
+import eventlet
+
+eventlet.monkey_patch(socket=True)
+
 # load parameters of Webex Integration to be used
 # The Dockerfile makes sure that the webexintegration.env from the project root is copied to the webexintegration
 # directory
@@ -16,6 +22,10 @@ from app import create_app, socketio
 from redis import Redis
 
 from app.interactive import Token
+from app.jobregistry import JobRegistry
+from app.outputlog import OutputLog
+from app.peopledirectory import PeopleDirectory
+from app.statscache import StatsCache
 
 # logging.basicConfig(level=logging.DEBUG)
 
@@ -24,9 +34,14 @@ logging.getLogger('engineio.server').setLevel(logging.WARNING)
 
 redis_session = Redis(host='redis')
 Token.set_redis(redis_session)
+StatsCache.set_redis(redis_session)
+JobRegistry.set_redis(redis_session)
+OutputLog.set_redis(redis_session)
+PeopleDirectory.set_redis(redis_session)
 
 config = dict(
-    SESSION_REDIS=redis_session
+    SESSION_REDIS=redis_session,
+    SOCKETIO_MESSAGE_QUEUE=os.getenv('SOCKETIO_MESSAGE_QUEUE', 'redis://redis:6379/0')
 )
 
 app = create_app(config)